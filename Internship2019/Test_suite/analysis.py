@@ -5,13 +5,20 @@
 This file can be imported as a module and contains the following functions:
     * read_counts - read the tables of group counts results for a given count type (e.g. 'univariate categorical')
     * combine counts - join the tables of group counts into a single table for a given count type
+    * align_counts - align the counts of several tables of group counts on shared integer codes of their join columns
+Reading and joining are recorded by the `instrument` module, for each table and pair of tables, when it is enabled.
 """
 
 # Third-party imports
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 # Local packages
-from params import filepath_dictionary, key_list, comparison_pairs
+import cache
+import instrument
+import storage
+from params import filepath_dictionary, columnar_filepath_dictionary, key_list, comparison_pairs
 
 
 __author__ = 'Edward Pearce'
@@ -24,34 +31,52 @@ __email__ = 'edward.pearce@phe.gov.uk'
 __status__ = 'Production'
 
 
-def read_counts(count_type):
+def read_counts(count_type, use_cache=True, columnar=False, keys=None):
     r"""Read the tables of group counts results for a given count type (e.g. 'univariate categorical')
     
     Returns a dictionary of pandas DataFrame objects whose keys are table aliases and values are tables of group counts.
+    If `use_cache` is True, counts are read from the cache (see the `cache` module) where there is an entry for the current
+    population query and field list, and otherwise from the filepaths in `filepath_dictionary`. A file which was written after
+    the cache entry (e.g. regenerated from a local extract) is read in preference to the entry.
+    If `columnar` is True, counts are instead memory-mapped from the directories in `columnar_filepath_dictionary`,
+    which are written by `storage.convert_counts`. This avoids parsing the .csv files, and text columns are categorical.
+    If `keys` is given, only the tables for those aliases are read.
     """
+    keys = keys if keys is not None else list(filepath_dictionary[count_type].keys())
+    if columnar:
+        counts_tables = dict()
+        for key in keys:
+            with instrument.stage('read_counts', count_type, key) as current:
+                counts_tables[key] = storage.load_counts_table(columnar_filepath_dictionary[count_type][key])
+                current.set(rows_out=counts_tables[key].shape[0])
+        return counts_tables
     # Initialise the dictionary where we will store the tables of group counts data
     counts_tables = dict()
     # Get the filepaths where we will be reading the data from
-    filepaths = filepath_dictionary[count_type]
+    filepaths = {key: filepath_dictionary[count_type][key] for key in keys}
+    if use_cache:
+        filepaths = {key: cache.lookup(count_type, key, filepath=filepath) or filepath for key, filepath in filepaths.items()}
     # Read the group counts data according to the count type we chose into a DataFrame for each source table
     for key, filepath in filepaths.items():
-        if count_type == 'univariate_categorical':        
-            counts_tables[key] = pd.read_csv(filepath, dtype={'column_name': 'category', 'counts_'+key: 'uint32'})
-        elif count_type == 'univariate_dates': 
-            counts_tables[key] = pd.read_csv(filepath, parse_dates=[1], infer_datetime_format=True,
-                                             dtype={'column_name': 'category', 'counts_'+key: 'uint32'})
-        elif count_type == 'bivariate_categorical': 
-            counts_tables[key] = pd.read_csv(filepath,
-                                             dtype={'column_name1': 'category', 'column_name2': 'category', 'counts_'+key: 'uint32'})
-        elif count_type in ['categorical_cross_diagnosis_date', 'categorical_cross_surgery_date']: 
-            counts_tables[key] = pd.read_csv(filepath, usecols=[0, 2, 3, 4],
-                                             parse_dates=[2], infer_datetime_format=True,
-                                             dtype={'column_name1': 'category', 'counts_'+key: 'uint32'})
-        elif count_type == 'surgery_date_cross_diagnosis_date': 
-            counts_tables[key] = pd.read_csv(filepath, usecols=[2, 3, 4],
-                                             parse_dates={'DATE_FIRST_SURGERY': [0], 'DIAGNOSISDATEBEST': [1]},
-                                             infer_datetime_format=True,
-                                             dtype={'counts_'+key: 'uint32'})
+        with instrument.stage('read_counts', count_type, key) as current:
+            if count_type == 'univariate_categorical':        
+                counts_tables[key] = pd.read_csv(filepath, dtype={'column_name': 'category', 'counts_'+key: 'uint32'})
+            elif count_type == 'univariate_dates': 
+                counts_tables[key] = pd.read_csv(filepath, parse_dates=[1], infer_datetime_format=True,
+                                                 dtype={'column_name': 'category', 'counts_'+key: 'uint32'})
+            elif count_type == 'bivariate_categorical': 
+                counts_tables[key] = pd.read_csv(filepath,
+                                                 dtype={'column_name1': 'category', 'column_name2': 'category', 'counts_'+key: 'uint32'})
+            elif count_type in ['categorical_cross_diagnosis_date', 'categorical_cross_surgery_date']: 
+                counts_tables[key] = pd.read_csv(filepath, usecols=[0, 2, 3, 4],
+                                                 parse_dates=[2], infer_datetime_format=True,
+                                                 dtype={'column_name1': 'category', 'counts_'+key: 'uint32'})
+            elif count_type == 'surgery_date_cross_diagnosis_date': 
+                counts_tables[key] = pd.read_csv(filepath, usecols=[2, 3, 4],
+                                                 parse_dates={'DATE_FIRST_SURGERY': [0], 'DIAGNOSISDATEBEST': [1]},
+                                                 infer_datetime_format=True,
+                                                 dtype={'counts_'+key: 'uint32'})
+            current.set(rows_out=counts_tables[key].shape[0])
     return counts_tables
 
 
@@ -64,19 +89,83 @@ join_cols = {'univariate_categorical': ['column_name', 'val'],
               'surgery_date_cross_diagnosis_date': ['DATE_FIRST_SURGERY', 'DIAGNOSISDATEBEST']}
 
 
-def combine_counts(count_type, counts_tables):
+def _shared_codes(columns):
+    # Encodes a join column of several tables as integer codes shared across the tables, in sort order of the values, with nulls
+    # where an outer `pd.merge` puts them: first for dates (NaT sorts as the smallest datetime64 value), and last otherwise.
+    # Returns the codes, the number of distinct codes (including nulls), and the concatenated values from which to take the output column.
+    if all(isinstance(column.dtype, pd.CategoricalDtype) for column in columns):
+        # Categorical columns are encoded from their (small) sets of categories, without hashing every value
+        values = union_categoricals([column.values for column in columns], sort_categories=True, ignore_order=True)
+        codes, num_values = values.codes.astype(np.int64), len(values.categories)
+    else:
+        values = pd.concat([column.astype(object) if isinstance(column.dtype, pd.CategoricalDtype) else column for column in columns],
+                           ignore_index=True)
+        codes, uniques = pd.factorize(values, sort=True)
+        codes, num_values = codes.astype(np.int64), len(uniques)
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return codes + 1, num_values + 1, values
+    return np.where(codes < 0, num_values, codes), num_values + 1, values
+
+
+def align_counts(counts_tables, on):
+    r"""Align the counts of several tables of group counts on shared integer codes of their join columns.
+    
+    This is an equivalent of an outer join of the tables on the columns `on`, followed by filling in missing counts with 0.
+    Each join column is encoded as integer codes shared by all of the tables (and in sort order of its values), and the codes of
+    the join columns are packed into a single `int64` key by mixed-radix arithmetic. The tables are then aligned by a sorted merge
+    of the packed keys (`np.unique`), and the counts of each table are scattered into a dense, zero-filled `uint32` array.
+    Null values in the join columns match each other, as in `pd.merge`.
+    
+    Parameters
+    ----------
+    counts_tables : dictionary of pandas DataFrames
+        Tables of group counts keyed by table alias, each with the columns `on` and a column `counts_{alias}`
+    on : list of str
+        The join columns, e.g. `join_cols[count_type]`
+    
+    Returns
+    -------
+    pandas DataFrame
+        The columns `on`, sorted by their values with nulls placed as in an outer `pd.merge` (first for dates and last otherwise), followed by a `counts_{alias}` column for each table, in the order of `counts_tables`
+    """
+    keys = list(counts_tables.keys())
+    sizes = [counts_tables[key].shape[0] for key in keys]
+    packed = np.zeros(sum(sizes), dtype=np.int64)
+    radix_product = 1
+    values = dict()
+    for col_label in on:
+        codes, radix, values[col_label] = _shared_codes([counts_tables[key][col_label] for key in keys])
+        if radix_product * radix >= 2**62:
+            # Renumber the keys packed so far densely before they would overflow, which preserves their order
+            unique_keys, packed = np.unique(packed, return_inverse=True)
+            packed, radix_product = packed.astype(np.int64), len(unique_keys)
+        packed = packed * radix + codes
+        radix_product *= radix
+    # Sorted merge of the packed keys: the cells of the joined table and the cell of each row of each table
+    unique_keys, first_rows, cells = np.unique(packed, return_index=True, return_inverse=True)
+    cells = cells.reshape(-1)
+    combined = pd.DataFrame({col_label: values[col_label].take(first_rows) if isinstance(values[col_label], pd.Categorical)
+                             else values[col_label].values.take(first_rows) for col_label in on}, columns=on)
+    starts = np.r_[0, np.cumsum(sizes)]
+    for key, start, stop in zip(keys, starts[:-1], starts[1:]):
+        counts = counts_tables[key]['counts_'+key].values.astype(np.float64)
+        combined['counts_'+key] = np.bincount(cells[start:stop], weights=counts, minlength=len(unique_keys)).astype('uint32')
+    return combined
+
+
+def combine_counts(count_type, counts_tables, pairs=None):
     r"""Join pairs of counts tables for comparison for a given count type.
     
     Returns a dictionary of pandas DataFrames whose keys are pairs of table aliases and values are joined tables of group counts data.
-    Uses the module parameter `comparison_pairs` to decide which tables to join.
+    Uses the module parameter `comparison_pairs` to decide which tables to join, unless a list of `pairs` is given.
+    The tables are joined with `align_counts` on the columns in `join_cols`, rather than with an outer `pd.merge` on the values.
     """
     comparison_tables = dict()
-    for pair in comparison_pairs:
-        # First, join the counts tables in the pairs we want to compare
-        comparison_tables[pair] = pd.merge(counts_tables[pair[1]], counts_tables[pair[0]], 
-                                           on=join_cols[count_type], how='outer')
-        # Fill in missing count values with 0
-        count_cols = ['counts_'+name for name in pair]
-        comparison_tables[pair][count_cols] = comparison_tables[pair][count_cols].fillna(0, axis=1).astype('uint32')
+    for pair in (pairs if pairs is not None else comparison_pairs):
+        with instrument.stage('combine_counts', count_type, pair,
+                              rows_in=counts_tables[pair[1]].shape[0] + counts_tables[pair[0]].shape[0]) as current:
+            # Join the counts tables in the pairs we want to compare, with missing count values filled in with 0
+            comparison_tables[pair] = align_counts({pair[1]: counts_tables[pair[1]], pair[0]: counts_tables[pair[0]]}, join_cols[count_type])
+            current.set(rows_out=comparison_tables[pair].shape[0])
     return comparison_tables
 
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following:
+    * chow_liu_tree - Learns a tree-shaped network structure from the mutual information of every pair of fields
+    * BayesianNetwork - A Bayesian network over the categorical fields, whose conditional probability tables are learned from counts
+    * fit_network - Fits a Bayesian network to the cached counts of a cohort
+
+A Bayesian network over discrete fields is fitted from the counts of each field together with its parents, which are exactly the
+group counts extracted by this suite: the univariate counts for fields without parents, the bivariate counts (see
+`contingency.ContingencyTables`) for fields with one parent, and the k-way marginals (see `marginals.MarginalTables`) for fields with
+more parents. So a model of a cohort is fitted without row-level access to the cohort, and the structure can be changed and refitted
+from the stored counts in seconds, without querying the database again.
+
+The conditional probability table (CPT) of each field has one row per configuration of its parents' values observed in the counts,
+computed with a single `np.bincount` over the packed codes of the parents and the field, plus a final row, the marginal distribution
+of the field, used for configurations which were not observed. Probabilities are smoothed with a Dirichlet prior with a total of
+`alpha` pseudo-counts spread evenly over each row (the BDeu prior). Null values are treated as a value of each field.
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from analysis import read_counts
+from contingency import ContingencyTables
+from dependence import compute_dependence, dependence_matrix
+from params import categorical_cols
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def chow_liu_tree(tables, count_col=None, root=None, fields=None):
+    r"""Learns a tree-shaped network structure from the mutual information of every pair of fields (the Chow–Liu algorithm).
+
+    The tree is the maximum spanning tree of the complete graph on the fields weighted by mutual information, found with Prim's
+    algorithm, and is directed away from the root. Among trees, it maximizes the likelihood of the counts.
+
+    Parameters
+    ----------
+    tables : ContingencyTables or pandas DataFrame
+        The bivariate counts, as accepted by `dependence.compute_dependence`
+    count_col : str, optional
+        The counts column to use. Defaults to the first counts column.
+    root : str, optional
+        The field at the root of the tree. Defaults to the first field.
+    fields : list of str, optional
+        The fields of the network. Defaults to `params.categorical_cols`.
+
+    Returns
+    -------
+    dictionary
+        Maps each field to the tuple of its parents (empty for the root), in an order where parents come before their children
+    """
+    fields = list(fields if fields is not None else categorical_cols)
+    weights = np.nan_to_num(dependence_matrix(compute_dependence(tables, count_col), 'mutual_information', fields).values)
+    root = root if root is not None else fields[0]
+    in_tree = np.zeros(len(fields), dtype=bool)
+    in_tree[fields.index(root)] = True
+    # The best edge into the tree found so far for each field outside it
+    best_weight, best_parent = weights[fields.index(root)].copy(), np.full(len(fields), fields.index(root))
+    structure = {root: tuple()}
+    for _ in range(len(fields) - 1):
+        child = int(np.argmax(np.where(in_tree, -np.inf, best_weight)))
+        structure[fields[child]] = (fields[best_parent[child]],)
+        in_tree[child] = True
+        closer = weights[child] > best_weight
+        best_weight, best_parent = np.where(closer, weights[child], best_weight), np.where(closer, child, best_parent)
+    return structure
+
+
+def _label_codes(labels, values):
+    # The codes of values in an array of labels, matching on their string forms, since counts read from different files may
+    # hold the same value as a number or as a string. Values which are not labels get the code -1.
+    return pd.Index(pd.Series(labels, dtype=object).astype(str)).get_indexer(pd.Series(values, dtype=object).astype(str))
+
+
+def _topological_order(structure):
+    # Orders the fields so that parents come before their children, raising an error if the structure has a cycle
+    order, placed = list(), set()
+    remaining = dict(structure)
+    while remaining:
+        ready = [field for field, parents in remaining.items() if all(parent in placed for parent in parents)]
+        if not ready:
+            raise ValueError('The network structure has a cycle among the fields {}'.format(sorted(remaining)))
+        for field in ready:
+            order.append(field)
+            placed.add(field)
+            del remaining[field]
+    return order
+
+
+class BayesianNetwork(object):
+    r"""A Bayesian network over the categorical fields, whose conditional probability tables are learned from counts.
+
+    Parameters
+    ----------
+    structure : dictionary
+        Maps each field to a tuple of its parent fields, e.g. as returned by `chow_liu_tree`. Every parent must also be a key.
+    """
+    def __init__(self, structure):
+        self.structure = {field: tuple(parents) for field, parents in structure.items()}
+        self.fields = _topological_order(self.structure)
+        self.labels = dict()
+        self.cpts = dict()
+        self.num_rows = None
+        self.log_likelihood = None
+
+    def _joint_counts(self, field, tables, univariate, marginals, count_col):
+        # The counts of the values of a field together with its parents, as an integer array of codes (one column per parent,
+        # then the field) into `self.labels`, and an array of counts
+        parents = self.structure[field]
+        if not parents and univariate is not None and field in set(univariate['column_name'].astype(str)):
+            frame = univariate.loc[(univariate['column_name'].astype(str) == field).values]
+            codes = _label_codes(self.labels[field], frame['val'].values)[:, np.newaxis]
+            counts = frame[count_col if count_col is not None else [col_label for col_label in frame.columns if col_label.startswith('counts_')][0]].values
+        elif len(parents) <= 1:
+            # Any pair of fields including the field gives its marginal counts
+            other = parents[0] if parents else next(field2 if field1 == field else field1 for field1, field2 in tables.pairs if field in (field1, field2))
+            rows, cols, counts = tables.sparse(other, field, count_col)
+            codes = np.column_stack([rows, cols]) if parents else cols[:, np.newaxis]
+            if not parents:
+                codes, inverse = np.unique(codes, axis=0, return_inverse=True)
+                counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(codes))
+        else:
+            fields = list(parents) + [field]
+            field_set = next((field_set for field_set in (marginals.field_sets if marginals is not None else list())
+                              if set(fields) <= set(field_set)), None)
+            if field_set is None:
+                raise ValueError('No marginal counts for the field {} with its parents {}'.format(field, parents))
+            codes, counts = marginals.margin(field_set, fields, count_col)
+            # Map the labels of the marginal tables to the labels of the network
+            codes = np.column_stack([_label_codes(self.labels[col_name], marginals.labels[col_name][codes[:, i]])
+                                     for i, col_name in enumerate(fields)])
+        valid = (codes >= 0).all(axis=1)
+        return codes[valid], np.asarray(counts, dtype=np.float64)[valid]
+
+    def fit(self, tables, univariate=None, marginals=None, count_col=None, alpha=1.0):
+        r"""Learns the conditional probability table of every field from counts.
+
+        Parameters
+        ----------
+        tables : ContingencyTables or pandas DataFrame
+            The bivariate counts, e.g. from `analysis.read_counts('bivariate_categorical')`, which also give the labels of each field
+        univariate : pandas DataFrame, optional
+            The univariate counts, e.g. from `analysis.read_counts('univariate_categorical')`, used for fields without parents.
+            Otherwise their counts are the margins of the bivariate counts.
+        marginals : MarginalTables, optional
+            The k-way marginals (see `marginals.compute_marginals`), required for fields with two or more parents
+        count_col : str, optional
+            The counts column to use, e.g. 'counts_av2017'. Defaults to the first counts column.
+        alpha : float, defaults to 1.0
+            The total number of pseudo-counts of the Dirichlet prior of each conditional probability table
+
+        Returns
+        -------
+        BayesianNetwork
+            The fitted network, with the attributes `cpts`, `labels`, `num_rows` and `log_likelihood` (of the counts, under the fitted network)
+        """
+        if not isinstance(tables, ContingencyTables):
+            tables = ContingencyTables.from_long(tables)
+        self.labels = {field: tables.labels[field] for field in self.fields}
+        self.log_likelihood = 0.0
+        for field in self.fields:
+            codes, counts = self._joint_counts(field, tables, univariate, marginals, count_col)
+            num_values = len(self.labels[field])
+            # Pack the codes of the parents into a single key, and number the observed configurations of the parents
+            radixes = [len(self.labels[parent]) for parent in self.structure[field]]
+            keys = np.ravel_multi_index(codes[:, :-1].T, radixes) if radixes else np.zeros(len(codes), dtype=np.int64)
+            configs, rows = np.unique(keys, return_inverse=True)
+            rows = rows.ravel()
+            table = np.bincount(rows * num_values + codes[:, -1], weights=counts, minlength=len(configs) * num_values).reshape(-1, num_values)
+            marginal = np.bincount(codes[:, -1], weights=counts, minlength=num_values)
+            num_configs = int(np.prod(radixes)) if radixes else 1
+            smoothed = np.vstack([table + alpha / (num_configs * num_values), marginal + alpha / num_values])
+            probabilities = smoothed / smoothed.sum(axis=1, keepdims=True)
+            self.cpts[field] = (configs, probabilities)
+            self.log_likelihood += float(np.dot(counts, np.log(probabilities[rows, codes[:, -1]])))
+            if not radixes:
+                self.num_rows = int(counts.sum())
+        return self
+
+    @property
+    def num_parameters(self):
+        r"""The number of free parameters of the observed rows of the conditional probability tables."""
+        return sum((len(configs) or 1) * (probabilities.shape[1] - 1) for configs, probabilities in self.cpts.values())
+
+    def bic(self):
+        r"""The Bayesian information criterion of the fitted network, `-2 log L + p log n`, for comparing structures (lower is better)."""
+        return -2 * self.log_likelihood + self.num_parameters * np.log(self.num_rows)
+
+    def cpt(self, field):
+        r"""Returns the conditional probability table of a field as a pandas DataFrame, with one row per observed configuration
+        of its parents (and a final row labelled 'unobserved' for the others) and one column per value of the field."""
+        configs, probabilities = self.cpts[field]
+        parents = self.structure[field]
+        if parents:
+            codes = np.unravel_index(configs, [len(self.labels[parent]) for parent in parents])
+            index = pd.MultiIndex.from_arrays([self.labels[parent][code] for parent, code in zip(parents, codes)], names=parents)
+            index = index.append(pd.MultiIndex.from_tuples([('unobserved',) * len(parents)], names=parents))
+        else:
+            index = pd.Index(['all', 'unobserved'])
+        return pd.DataFrame(probabilities, index=index, columns=self.labels[field])
+
+    def sample(self, num_rows, seed=None):
+        r"""Generates a synthetic table of `num_rows` rows from the fitted network, by ancestral sampling.
+
+        The fields are sampled in an order where parents come before their children. For each field, the row of its conditional
+        probability table is found for every sampled row at once, and values are drawn by a single binary search of uniform
+        random numbers in the cumulative probabilities of all rows of the table, offset so that the rows do not overlap.
+        """
+        rng = np.random.default_rng(seed)
+        codes = dict()
+        for field in self.fields:
+            configs, probabilities = self.cpts[field]
+            parents = self.structure[field]
+            if parents:
+                keys = np.ravel_multi_index([codes[parent] for parent in parents], [len(self.labels[parent]) for parent in parents])
+                rows = np.minimum(np.searchsorted(configs, keys), len(configs) - 1)
+                # Configurations which were not observed use the final row, the marginal distribution of the field
+                rows = np.where(configs[rows] == keys, rows, len(configs))
+            else:
+                rows = np.zeros(num_rows, dtype=np.int64)
+            num_values = probabilities.shape[1]
+            cumulative = (np.cumsum(probabilities, axis=1) + 2 * np.arange(len(probabilities))[:, np.newaxis]).ravel()
+            draws = np.searchsorted(cumulative, rng.random(num_rows) + 2 * rows, side='right') - rows * num_values
+            codes[field] = np.minimum(draws, num_values - 1)
+        return pd.DataFrame({field: self.labels[field][codes[field]] for field in self.fields}, columns=self.fields)
+
+
+def fit_network(key, structure=None, root=None, marginals=None, alpha=1.0, use_cache=True):
+    r"""Fits a Bayesian network to the cached counts of a cohort.
+
+    Parameters
+    ----------
+    key : str
+        The table alias of the cohort, e.g. 'av2017'
+    structure : dictionary, optional
+        The network structure, as accepted by `BayesianNetwork`. Defaults to the Chow–Liu tree of the cohort's bivariate counts.
+    root : str, optional
+        The root of the Chow–Liu tree, if it is learned
+    marginals : MarginalTables, optional
+        The cohort's k-way marginals, for fields with two or more parents
+    alpha : float, defaults to 1.0
+        The total number of pseudo-counts of the Dirichlet prior of each conditional probability table
+    use_cache : Boolean, defaults to True
+        Passed to `analysis.read_counts`
+
+    Returns
+    -------
+    BayesianNetwork
+        The fitted network
+    """
+    tables = ContingencyTables.from_long(read_counts('bivariate_categorical', use_cache=use_cache, keys=[key])[key])
+    univariate = read_counts('univariate_categorical', use_cache=use_cache, keys=[key])[key]
+    structure = structure if structure is not None else chow_liu_tree(tables, root=root, fields=[field for field in categorical_cols if field in tables.labels])
+    return BayesianNetwork(structure).fit(tables, univariate, marginals, 'counts_'+key, alpha)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * generate_population - Generates a synthetic encoded population with the fields and cardinalities of SIM_AV_TUMOUR
+    * measure - Runs a function, recording its wall time and peak memory allocation
+    * run_benchmark - Times and memory-profiles every stage of the pipeline on synthetic cohorts of the given sizes
+    * save_baseline - Writes benchmark results and details of the environment to a .json baseline file
+    * compare_to_baseline - Compares benchmark results with a baseline file, flagging regressions
+This module also contains the parameter `field_cardinalities`, the number of distinct values and fraction of null values of each categorical field.
+
+The benchmark does not need access to the SQL database or to real data. The synthetic populations are generated directly in the
+encoded format of `local_counts` (see `local_counts.encode_population`), with skewed (Zipf-like) distributions over the values of each field.
+A pair of cohorts is generated for each size, the second with a different seed and skew, and each stage is run in turn:
+count generation (`write_results.get_totals_from_population`), cleaning and sorting (`write_results.clean_counts`), joining
+(`analysis.combine_counts`), each function of `compute_stats` and the figure builders of `plots`.
+"""
+
+# Standard library imports
+import json
+import platform
+import time
+import tracemalloc
+from datetime import datetime
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+import analysis
+import compute_stats
+import plots
+import write_results
+from params import categorical_cols, date_cols, field_list_dict, benchmark_filepath
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# The number of distinct (non-null) values and the fraction of null values of each categorical field, approximately as in SIM_AV_TUMOUR.
+# DIAGNOSISMONTHBEST and MONTH_FIRST_SURGERY are derived from the generated dates instead.
+field_cardinalities = {'QUINTILE_2015': (5, 0.01), 'CREG_CODE': (9, 0.0), 'GRADE': (8, 0.35), 'SEX': (3, 0.0),
+                       'SITE_ICD10_O2': (1200, 0.0), 'SITE_ICD10_O2_3CHAR': (150, 0.0), 'MORPH_ICD10_O2': (900, 0.0),
+                       'BEHAVIOUR_ICD10_O2': (5, 0.0), 'T_BEST': (60, 0.55), 'N_BEST': (30, 0.55), 'M_BEST': (20, 0.55),
+                       'STAGE_BEST': (60, 0.4), 'STAGE_BEST_SYSTEM': (10, 0.4), 'SCREENINGSTATUSFULL_CODE': (10, 0.85),
+                       'ER_STATUS': (4, 0.85), 'ER_SCORE': (10, 0.9), 'PR_STATUS': (4, 0.9), 'PR_SCORE': (10, 0.92),
+                       'HER2_STATUS': (4, 0.88), 'LATERALITY': (5, 0.3), 'GLEASON_PRIMARY': (5, 0.93), 'GLEASON_SECONDARY': (5, 0.93),
+                       'GLEASON_TERTIARY': (5, 0.97), 'GLEASON_COMBINED': (10, 0.93), 'CANCERCAREPLANINTENT': (5, 0.25),
+                       'PERFORMANCESTATUS': (6, 0.6), 'CNS': (4, 0.7), 'ACE27': (5, 0.7), 'AGE': (106, 0.0)}
+
+# The range of diagnosis dates, and the fraction of tumours without a date of first surgery
+diagnosis_date_range = ('2013-01-01', '2015-12-31')
+surgery_null_fraction = 0.45
+
+
+def _encode_dates(days):
+    # Encodes an array of datetime64[D] values (NaT for nulls) as sorted 'YYYY-MM-DD' labels, and their derived 'YYYY-MM' months
+    nulls = np.isnat(days)
+    uniques, codes = np.unique(days[~nulls], return_inverse=True)
+    labels = np.r_[np.datetime_as_string(uniques, unit='D'), ['None']].astype(str)
+    full_codes = np.full(len(days), len(uniques), dtype=np.int32)
+    full_codes[~nulls] = codes.ravel()
+    month_labels, month_relabel = np.unique(np.char.ljust(labels.astype('<U10'), 10).astype('<U7'), return_inverse=True)
+    return (full_codes, labels), (month_relabel.ravel()[full_codes].astype(np.int32), month_labels)
+
+
+def generate_population(num_rows, seed=0, skew=1.1):
+    r"""Generates a synthetic encoded population with the fields and cardinalities of SIM_AV_TUMOUR.
+
+    The values of each categorical field follow a Zipf-like distribution, with probabilities proportional to `1 / rank^skew`
+    over the values in a random order, and null values (labelled 'None') in the fraction given by `field_cardinalities`.
+    Diagnosis dates are uniform over `diagnosis_date_range`, and dates of first surgery follow with an exponential delay.
+
+    Parameters
+    ----------
+    num_rows : int
+        The number of rows (tumours) in the population
+    seed : int, defaults to 0
+        Seeds the random number generator
+    skew : float, defaults to 1.1
+        The exponent of the Zipf-like distributions
+
+    Returns
+    -------
+    dictionary
+        The encoded population, a dictionary of `(codes, labels)` pairs keyed by field name, as returned by `local_counts.encode_population`
+    """
+    rng = np.random.default_rng(seed)
+    population = dict()
+    for col_name, (num_values, null_fraction) in field_cardinalities.items():
+        if col_name == 'AGE':
+            values = [str(age) for age in range(num_values)]
+        elif col_name == 'QUINTILE_2015':
+            values = [str(quintile) for quintile in range(1, num_values + 1)]
+        else:
+            values = ['{}{:04d}'.format(col_name[0], position) for position in range(num_values)]
+        labels = np.array(sorted(values + ['None']))
+        weights = 1 / np.arange(1, num_values + 1)**skew
+        probabilities = np.r_[(1 - null_fraction) * rng.permutation(weights) / weights.sum(), null_fraction]
+        # The codes of the values in `values` order (and null) in the sorted labels
+        positions = np.searchsorted(labels, values + ['None']).astype(np.int32)
+        population[col_name] = (positions[rng.choice(num_values + 1, size=num_rows, p=probabilities)], labels)
+    start, stop = np.datetime64(diagnosis_date_range[0]), np.datetime64(diagnosis_date_range[1])
+    diagnosis = start + rng.integers(0, (stop - start).astype(int) + 1, size=num_rows).astype('timedelta64[D]')
+    surgery = diagnosis + rng.exponential(40, size=num_rows).astype(np.int64).astype('timedelta64[D]')
+    surgery[rng.random(num_rows) < surgery_null_fraction] = np.datetime64('NaT')
+    population['DIAGNOSISDATEBEST'], population['DIAGNOSISMONTHBEST'] = _encode_dates(diagnosis)
+    population['DATE_FIRST_SURGERY'], population['MONTH_FIRST_SURGERY'] = _encode_dates(surgery)
+    return {col_name: population[col_name] for col_name in categorical_cols + date_cols}
+
+
+def measure(stage, function, *args, trace_memory=True, **kwargs):
+    r"""Runs a function, recording its wall time and (if `trace_memory`) the peak memory allocated while it runs.
+
+    Returns
+    -------
+    tuple
+        The pair `(result, record)`, where `record` is a dictionary with keys 'stage', 'seconds' and 'peak_mb'
+    """
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else np.nan
+    finally:
+        # Stop tracing even if the stage fails, since tracing slows down everything run after it
+        if trace_memory:
+            tracemalloc.stop()
+    return result, {'stage': stage, 'seconds': seconds, 'peak_mb': peak / 2**20}
+
+
+def _as_read(frame, count_type):
+    # The layout of a cleaned table of group counts as read by `analysis.read_counts`, which drops the field names of date columns
+    if count_type in ['categorical_cross_diagnosis_date', 'categorical_cross_surgery_date']:
+        return frame.drop(columns='column_name2')
+    elif count_type == 'surgery_date_cross_diagnosis_date':
+        return frame.drop(columns=['column_name1', 'column_name2']).rename(columns={'val1': 'DATE_FIRST_SURGERY', 'val2': 'DIAGNOSISDATEBEST'})
+    return frame
+
+
+def _rows(frame):
+    return int(frame.shape[0]) if hasattr(frame, 'shape') else None
+
+
+def run_benchmark(sizes=(1000000, 2500000, 10000000), count_types=None, seed=0, trace_memory=True, num_plot_pairs=5, pair=('benchsim', 'benchreal')):
+    r"""Times and memory-profiles every stage of the pipeline on synthetic cohorts of the given sizes.
+
+    Parameters
+    ----------
+    sizes : tuple of int, defaults to (1000000, 2500000, 10000000)
+        The numbers of rows in the synthetic cohorts
+    count_types : list of str, optional
+        The count types to benchmark. Defaults to all count types.
+    seed : int, defaults to 0
+        Seeds the generation of the synthetic cohorts
+    trace_memory : Boolean, defaults to True
+        Set to False to skip memory profiling with `tracemalloc`, which slows down the stages it measures
+    num_plot_pairs : int, defaults to 5
+        The number of pairs of fields for which `plots.plot_bivariate_categorical_results` is timed
+    pair : tuple of str, defaults to ('benchsim', 'benchreal')
+        The aliases of the synthetic cohorts. Their sizes are recorded in `compute_stats.pop_sizes` while the benchmark runs,
+        and the previous entries (if any) are restored afterwards.
+
+    Returns
+    -------
+    pandas DataFrame
+        One row per size, count type, cohort (or pair of cohorts) and stage, with columns for the wall time in seconds, the peak memory in MB, and the numbers of rows in and out
+    """
+    count_types = count_types if count_types is not None else list(field_list_dict.keys())
+    # The entries of `compute_stats.pop_sizes` for the synthetic cohorts, which are restored when the benchmark ends
+    saved_pop_sizes = {key: compute_stats.pop_sizes[key] for key in pair if key in compute_stats.pop_sizes}
+    records = list()
+
+    def record(num_rows, count_type, key, rows_in, rows_out, stage, function, *args, **kwargs):
+        result, entry = measure(stage, function, *args, trace_memory=trace_memory, **kwargs)
+        entry.update({'num_rows': num_rows, 'count_type': count_type, 'key': key, 'rows_in': rows_in,
+                      'rows_out': _rows(result) if rows_out is None else rows_out})
+        records.append(entry)
+        print('{num_rows} rows, {key}, {count_type}, {stage}: {seconds:.2f}s, {peak_mb:.0f} MB'.format(**entry))
+        return result
+
+    comparison = ' vs. '.join(pair)
+    try:
+        for num_rows in sizes:
+            counts_tables = {count_type: dict() for count_type in count_types}
+            for position, key in enumerate(pair):
+                compute_stats.pop_sizes[key] = num_rows
+                population = record(num_rows, '', key, None, num_rows, 'generate_population', generate_population, num_rows,
+                                    seed=seed + position, skew=1.1 + 0.05 * position)
+                for count_type in count_types:
+                    frame = record(num_rows, count_type, key, num_rows, None, 'count_generation',
+                                   write_results.get_totals_from_population, count_type, key, population)
+                    frame = record(num_rows, count_type, key, _rows(frame), None, 'clean_counts', write_results.clean_counts, frame, count_type, key)
+                    counts_tables[count_type][key] = _as_read(frame, count_type)
+                del population
+
+            for count_type in count_types:
+                rows_in = sum(_rows(frame) for frame in counts_tables[count_type].values())
+                comparison_table = record(num_rows, count_type, comparison, rows_in, None, 'combine_counts',
+                                          analysis.combine_counts, count_type, counts_tables[count_type], [pair])[pair]
+                rows_in = _rows(comparison_table)
+                grouping = 'univariate' if count_type.startswith('univariate') else 'bivariate'
+                z_table = record(num_rows, count_type, comparison, rows_in, None, 'compute_z_test', compute_stats.compute_z_test, pair, comparison_table)
+                if count_type in ['univariate_categorical', 'bivariate_categorical']:
+                    chi2_table = record(num_rows, count_type, comparison, rows_in, None, 'compute_chi2_test', compute_stats.compute_chi2_test, pair, comparison_table, grouping)
+                if count_type in ['univariate_dates', 'categorical_cross_diagnosis_date', 'categorical_cross_surgery_date']:
+                    record(num_rows, count_type, comparison, rows_in, None, 'compute_ks_test', compute_stats.compute_ks_test, pair, comparison_table, grouping)
+                if count_type != 'surgery_date_cross_diagnosis_date':
+                    record(num_rows, count_type, comparison, rows_in, None, 'compute_all_tests', compute_stats.compute_all_tests, pair, comparison_table, grouping)
+
+                if count_type == 'univariate_categorical':
+                    record(num_rows, count_type, comparison, rows_in, len(categorical_cols), 'plot_univariate_categorical_results',
+                           lambda: [plots.plot_univariate_categorical_results({pair: z_table}, col_name) for col_name in categorical_cols])
+                    record(num_rows, count_type, comparison, _rows(chi2_table), 1, 'plot_univariate_chi2_test_results',
+                           plots.plot_univariate_chi2_test_results, {pair: chi2_table})
+                elif count_type == 'bivariate_categorical':
+                    field_pairs = field_list_dict['bivariate_categorical'][:num_plot_pairs]
+                    record(num_rows, count_type, comparison, rows_in, len(field_pairs), 'plot_bivariate_categorical_results',
+                           lambda: [plots.plot_bivariate_categorical_results({pair: z_table}, col_name1, col_name2, display=False)
+                                    for col_name1, col_name2 in field_pairs])
+                    record(num_rows, count_type, comparison, _rows(chi2_table), 1, 'plot_bivariate_chi2_results',
+                           plots.plot_bivariate_chi2_results, {pair: chi2_table}, display=False)
+            del counts_tables
+    finally:
+        for key in pair:
+            compute_stats.pop_sizes.pop(key, None)
+        compute_stats.pop_sizes.update(saved_pop_sizes)
+    return pd.DataFrame(records, columns=['num_rows', 'count_type', 'key', 'stage', 'seconds', 'peak_mb', 'rows_in', 'rows_out'])
+
+
+def save_baseline(results, filepath=benchmark_filepath):
+    r"""Writes benchmark results, as returned by `run_benchmark`, and details of the environment to a .json baseline file."""
+    baseline = {'created': datetime.now().isoformat(timespec='seconds'),
+                'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+                                'numpy': np.__version__, 'pandas': pd.__version__},
+                'results': json.loads(results.to_json(orient='records'))}
+    with open(filepath, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+    return filepath
+
+
+def compare_to_baseline(results, filepath=benchmark_filepath, tolerance=1.25):
+    r"""Compares benchmark results with a baseline file, flagging regressions.
+
+    Returns a pandas DataFrame indexed by size, count type, cohort (or pair of cohorts) and stage, with the baseline and current wall times and peak memory,
+    their ratios, and a column `regression` which is True where either ratio exceeds `tolerance`.
+    """
+    with open(filepath) as baseline_file:
+        baseline = pd.DataFrame(json.load(baseline_file)['results'])
+    index_cols = ['num_rows', 'count_type', 'key', 'stage']
+    comparison = pd.merge(baseline[index_cols + ['seconds', 'peak_mb']], results[index_cols + ['seconds', 'peak_mb']],
+                          on=index_cols, how='inner', suffixes=('_baseline', '_current')).set_index(index_cols)
+    comparison['seconds_ratio'] = comparison['seconds_current'] / comparison['seconds_baseline']
+    comparison['peak_mb_ratio'] = comparison['peak_mb_current'] / comparison['peak_mb_baseline']
+    comparison['regression'] = (comparison['seconds_ratio'] > tolerance) | (comparison['peak_mb_ratio'] > tolerance)
+    return comparison
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * cache_key - Computes the content address of a table of group counts from the query, field list and count type that produce it
+    * lookup - Finds the cached table of group counts for a given count type and cohort, if there is one
+    * store - Writes a table of group counts and its metadata to the cache
+    * list_entries - Reads the metadata of every entry in the cache into a pandas DataFrame
+    * evict - Removes cache entries by age and/or total size
+
+Each cache entry consists of a .csv file of group counts, in the same format as the files in `params.filepath_dictionary`,
+and a .json file of metadata, both named after the entry's cache key. The cache key is a hash of the population SQL query
+in `populations.pop_queries`, the list of fields (or pairs of fields) for the count type, the count type itself and an optional
+database snapshot label, so a change to any of these produces a new entry rather than reusing a stale one.
+Looking up an entry records the time of access as the modification time of its .csv file (with `os.utime`), so the metadata
+is only written once, by `store`, and is replaced atomically so that concurrent readers never see a partly written file.
+"""
+
+# Standard library imports
+import hashlib
+import json
+import os
+import time
+
+# Third-party imports
+import pandas as pd
+
+# Local packages
+from params import field_list_dict, cache_directory, db_snapshots
+from populations import pop_queries
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def cache_key(count_type, key):
+    r"""Computes the content address of a table of group counts from the query, field list and count type that produce it."""
+    content = json.dumps({'pop_query': pop_queries[key],
+                          'field_list': [list(field) if isinstance(field, tuple) else field for field in field_list_dict[count_type]],
+                          'count_type': count_type,
+                          'snapshot': db_snapshots.get(key, '')}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _paths(digest, directory):
+    return os.path.join(directory, digest + '.csv'), os.path.join(directory, digest + '.json')
+
+
+def _read_metadata(meta_path):
+    # The metadata of an entry, or None if the file is missing or cannot be read (e.g. it was left partly written)
+    try:
+        with open(meta_path) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+
+def lookup(count_type, key, directory=cache_directory, filepath=None):
+    r"""Finds the cached table of group counts for a given count type and cohort, if there is one.
+
+    Returns the filepath of the cached .csv file, or None if there is no entry for the current query and field list,
+    or if its metadata cannot be read. Looking up an entry records the time of access, which is used when evicting entries by size.
+    If `filepath` is given and the file there was written after the entry was stored, None is returned, since the file holds
+    newer counts: the cache key does not include the source of the counts, and the local writers (e.g. `streaming.write_counts_to_csv`)
+    only write the file.
+    """
+    data_path, meta_path = _paths(cache_key(count_type, key), directory)
+    metadata = _read_metadata(meta_path) if os.path.exists(data_path) else None
+    if metadata is None:
+        return None
+    if filepath is not None and os.path.exists(filepath) and os.path.getmtime(filepath) > metadata.get('created', 0):
+        return None
+    try:
+        os.utime(data_path)
+    except OSError:
+        # The entry was evicted in the meantime
+        return None
+    return data_path
+
+
+def store(frame, count_type, key, directory=cache_directory):
+    r"""Writes a table of group counts and its metadata to the cache.
+
+    Parameters
+    ----------
+    frame : pandas DataFrame
+        The cleaned and sorted table of group counts, as written by `write_results.write_counts_to_csv`
+    count_type : str
+        The type of fields or pairs of fields that the counts are grouped by
+    key : str
+        A key indicating the cohort from which the group counts were calculated
+    directory : str, defaults to `params.cache_directory`
+        The directory in which cache entries are stored
+
+    Returns
+    -------
+    str
+        The filepath of the cached .csv file
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    digest = cache_key(count_type, key)
+    data_path, meta_path = _paths(digest, directory)
+    # Each file is written under a temporary name and then moved into place, so that a lookup never finds a partly written entry
+    frame.to_csv(data_path + '.tmp', index=False)
+    os.replace(data_path + '.tmp', data_path)
+    metadata = {'cache_key': digest,
+                'count_type': count_type,
+                'key': key,
+                'snapshot': db_snapshots.get(key, ''),
+                'pop_query_sha256': hashlib.sha256(pop_queries[key].encode('utf-8')).hexdigest(),
+                'num_fields': len(field_list_dict[count_type]),
+                'rows': frame.shape[0],
+                'bytes': os.path.getsize(data_path),
+                'created': time.time()}
+    with open(meta_path + '.tmp', 'w') as meta_file:
+        json.dump(metadata, meta_file, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+    return data_path
+
+
+def list_entries(directory=cache_directory):
+    r"""Reads the metadata of every entry in the cache into a pandas DataFrame, one row per entry.
+
+    The column 'last_accessed' is the modification time of the entry's .csv file, as set by `store` and `lookup`.
+    Entries whose metadata cannot be read, or whose .csv file is missing, are left out.
+    """
+    entries = list()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.json'):
+                metadata = _read_metadata(os.path.join(directory, filename))
+                if metadata is None:
+                    continue
+                try:
+                    metadata['last_accessed'] = os.stat(_paths(metadata['cache_key'], directory)[0]).st_mtime
+                except OSError:
+                    continue
+                entries.append(metadata)
+    return pd.DataFrame(entries)
+
+
+def evict(max_bytes=None, max_age_days=None, directory=cache_directory):
+    r"""Removes cache entries by age and/or total size.
+
+    Entries created more than `max_age_days` days ago are removed first. Then, while the total size of the remaining
+    entries exceeds `max_bytes`, the least recently accessed entry is removed.
+
+    Returns
+    -------
+    list of str
+        The cache keys of the removed entries
+    """
+    entries = list_entries(directory)
+    if entries.empty:
+        return []
+    expired = pd.Series(False, index=entries.index)
+    if max_age_days is not None:
+        expired |= entries['created'] < time.time() - max_age_days * 86400
+    if max_bytes is not None:
+        # Keep the most recently accessed entries which fit within the size limit
+        by_access = entries.loc[~expired].sort_values(by='last_accessed', ascending=False)
+        over_limit = by_access['bytes'].cumsum() > max_bytes
+        expired.loc[over_limit[over_limit].index] = True
+    removed = list()
+    for digest in entries.loc[expired, 'cache_key']:
+        for path in _paths(digest, directory):
+            if os.path.exists(path):
+                os.remove(path)
+        removed.append(digest)
+    return removed
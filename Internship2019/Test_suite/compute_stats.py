@@ -8,6 +8,10 @@ This file can be imported as a module and contains the following functions:
     * compute_chi2_test - Compute Pearson's chi-squared test statistics based on value counts data from two populations
     * compute_cdf - Compute cumulative distribution functions (CDF) based on ordered value counts data for a pair of populations
     * compute_ks_test - Compute Kolmogorov-Smirnov test statistics based on ordered value counts data by field from two populations
+    * compute_all_tests - Compute proportions, z-tests, chi-squared, likelihood-ratio (G) and Kolmogorov-Smirnov tests in one pass
+    * make_field_matrix - Arrange a column of results indexed by pairs of fields into a symmetric field-by-field matrix
+    * compute_chi2_matrices - Arrange bivariate chi-squared test results into symmetric field-by-field matrices of statistics and hovertext
+Each test is recorded as a stage by the `instrument` module when it is enabled.
 This module also contains the parameter `pop_sizes` which is a dictionary containing the number of data entries (rows) in the source cohort tables.
 """
 
@@ -15,6 +19,9 @@ This module also contains the parameter `pop_sizes` which is a dictionary contai
 import numpy as np
 import pandas as pd
 
+# Local packages
+import instrument
+from params import field_list_dict
 
 __author__ = 'Edward Pearce'
 __copyright__ = 'Copyright 2019, Simulacrum Test Suite'
@@ -27,6 +34,7 @@ __status__ = 'Development'
 
 
 # Population sizes: The number of data entries (rows) in the source cohort tables. Used to calculate proportions and other statistics.
+# These are the sizes of the original cohorts; the sizes of cohorts added with `registry.register_cohort` are recorded here in place.
 pop_sizes = {'sim1': 1402817, 'av2015': 1462158, 'sim2': 2371686, 'av2017': 2483089}
 
 
@@ -41,6 +49,7 @@ def compute_proportions(pair, comparison_table):
     return table
 
 
+@instrument.instrumented()
 def compute_z_test(pair, comparison_table):
     r"""Compute z-test statistics based on value counts data from two populations.
     
@@ -55,6 +64,7 @@ def compute_z_test(pair, comparison_table):
     return table
 
 
+@instrument.instrumented()
 def compute_chi2_test(pair, comparison_table, grouping='univariate'):
     r"""Compute Pearson's chi-squared test statistics based on value counts data from two populations.
     
@@ -114,6 +124,7 @@ def compute_cdf(pair, comparison_table, grouping='univariate'):
     return results
 
 
+@instrument.instrumented()
 def compute_ks_test(pair, comparison_table, grouping='univariate'):
     r"""Compute Kolmogorov-Smirnov test statistics based on ordered value counts data by field from two populations.
     
@@ -134,3 +145,155 @@ def compute_ks_test(pair, comparison_table, grouping='univariate'):
     results['p_value'] = np.exp(-2 * np.square(results['ks_scaled']))
     return results
 
+
+def _group_codes(table, group_cols):
+    # Integer codes identifying the group of each row, from one factorization of the grouping columns
+    if len(group_cols) == 1:
+        codes, uniques = pd.factorize(table[group_cols[0]])
+        return codes, pd.Index(uniques, name=group_cols[0])
+    codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([table[col] for col in group_cols]))
+    return codes, pd.MultiIndex.from_tuples(list(uniques), names=group_cols)
+
+
+def _drop_null_groups(results):
+    # Groups with a null key are dropped, as in `pd.DataFrame.groupby`
+    mask = results.index.to_frame().notnull().all(axis=1).values
+    return results.loc[mask].sort_index()
+
+
+@instrument.instrumented()
+def compute_all_tests(pair, comparison_table, grouping='univariate', tests=('z', 'chi2', 'ks')):
+    r"""Compute proportions, z-tests, chi-squared, likelihood-ratio (G) and Kolmogorov-Smirnov tests in one pass.
+    
+    This is a fused equivalent of `compute_z_test`, `compute_chi2_test` and `compute_ks_test`. The comparison table is
+    read once as numpy arrays and is neither copied nor modified. Proportions, expected counts and the grouping of rows by
+    field are computed once and shared between the tests.
+    
+    Parameters
+    ----------
+    pair : tuple of str
+        The pair of table aliases being compared, e.g. ('sim2', 'av2017')
+    comparison_table : pandas DataFrame
+        The joined table of counts for the pair, as returned by `analysis.combine_counts`
+    grouping : str, defaults to 'univariate'
+        Either 'univariate' or 'bivariate', as in `compute_chi2_test` and `compute_ks_test`
+    tests : tuple of str, defaults to ('z', 'chi2', 'ks')
+        The tests to compute. 'chi2' computes both Pearson's chi-squared and likelihood-ratio (G) tests.
+    
+    Returns
+    -------
+    dictionary
+        The results bundle, with keys:
+        * 'cells' - a DataFrame with the same index as `comparison_table` and columns for proportions, 
+          expected counts, the z-test and the chi-squared and G-test summands, for each row of the comparison table
+        * 'chi2' - a DataFrame indexed by field (or pair of fields) as returned by `compute_chi2_test`, 
+          with additional columns for the G-test statistic and its Wilson–Hilferty score
+        * 'ks' - a DataFrame indexed by field as returned by `compute_ks_test`
+    """
+    assert grouping in ['univariate', 'bivariate']
+    n0, n1 = pop_sizes[pair[0]], pop_sizes[pair[1]]
+    counts0 = comparison_table['counts_'+pair[0]].values.astype(np.float64)
+    counts1 = comparison_table['counts_'+pair[1]].values.astype(np.float64)
+    proportion0, proportion1 = counts0 / n0, counts1 / n1
+    cells = {'proportion_'+pair[0]: proportion0, 'proportion_'+pair[1]: proportion1}
+    results = dict()
+    
+    if 'z' in tests:
+        p_ave = (counts0 + counts1) / (n0 + n1)
+        cells['p_diff'] = proportion0 - proportion1
+        cells['p_ave'] = p_ave
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cells['z_test'] = cells['p_diff'] / np.sqrt(p_ave * (1 - p_ave) * ((1/n0) + (1/n1)))
+    
+    if 'chi2' in tests:
+        expected = n0 * proportion1
+        # Avoid divide-by-zero errors for categories absent from the reference population, as in `compute_chi2_test`
+        safe_expected = np.where(expected != 0, expected, 0.5)
+        cells['expected_count_'+pair[0]] = expected
+        cells['pearson_chi2_test'] = np.square(counts0 - expected) / safe_expected
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cells['g_test'] = np.where(counts0 > 0, 2 * counts0 * np.log(counts0 / safe_expected), 0)
+        # Sum the summands by field (or pair of fields) with a single grouping of the rows
+        group_cols = ['column_name'] if grouping == 'univariate' else [col for col in ['column_name1', 'column_name2'] if col in comparison_table]
+        codes, groups = _group_codes(comparison_table, group_cols)
+        chi2 = pd.DataFrame({'category_size': np.bincount(codes, minlength=len(groups)),
+                             'pearson_chi2_test': np.bincount(codes, weights=cells['pearson_chi2_test'], minlength=len(groups))},
+                            index=groups)
+        chi2['degrees_of_freedom'] = chi2['category_size'] - 1
+        chi2['normalized_score'] = (chi2['pearson_chi2_test'] - chi2['degrees_of_freedom']) / np.sqrt(2 * chi2['degrees_of_freedom'])
+        chi2['g_test'] = np.bincount(codes, weights=cells['g_test'], minlength=len(groups))
+        for statistic, score in [('pearson_chi2_test', 'Wilson–Hilferty_score'), ('g_test', 'g_test_Wilson–Hilferty_score')]:
+            chi2[score] = (np.cbrt(chi2[statistic]/chi2['degrees_of_freedom'])
+                           - (1 - 2/(9 * chi2['degrees_of_freedom']))) / (2/(9 * chi2['degrees_of_freedom']))
+        results['chi2'] = _drop_null_groups(chi2)
+    
+    if 'ks' in tests:
+        group_cols, val_col = (['column_name'], 'val') if grouping == 'univariate' else (['column_name1', 'val1'], 'val2')
+        codes, groups = _group_codes(comparison_table, group_cols)
+        # Rank values in sort order, with nulls last as in `pd.DataFrame.sort_values`
+        ranks = pd.factorize(comparison_table[val_col], sort=True)[0]
+        ranks = np.where(ranks < 0, ranks.max() + 1, ranks)
+        order = np.lexsort((ranks, codes))
+        sorted_codes = codes[order]
+        # Cumulative sums of proportions within each group, from one cumulative sum over the sorted rows
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        cdf_diff = np.zeros(len(order))
+        for proportion, sign in [(proportion0, 1), (proportion1, -1)]:
+            cumsum = np.cumsum(proportion[order])
+            offsets = np.r_[0, cumsum[starts[1:] - 1]]
+            cdf_diff += sign * (cumsum - np.repeat(offsets, np.diff(np.r_[starts, len(order)])))
+        ks = pd.DataFrame({'ks_test_statistic': np.maximum.reduceat(np.abs(cdf_diff), starts)},
+                          index=groups[sorted_codes[starts]])
+        ks = _drop_null_groups(ks).dropna()
+        ks['ks_scaled'] = ks['ks_test_statistic'] * np.sqrt((n0 * n1)/(n0 + n1))
+        ks['p_value'] = np.exp(-2 * np.square(ks['ks_scaled']))
+        results['ks'] = ks
+    
+    results['cells'] = pd.DataFrame(cells, index=comparison_table.index)
+    return results
+
+
+def make_field_matrix(results, column, fields=None, fill_value=np.nan):
+    r"""Arrange a column of results indexed by pairs of fields into a symmetric field-by-field matrix.
+    
+    `results` is indexed by pairs of fields, e.g. a table returned by `compute_chi2_test(..., grouping='bivariate')`.
+    The rows and columns are ordered as in `fields`, which defaults to `field_list_dict['univariate_categorical']`.
+    The diagonal and any pairs of fields without results are filled with `fill_value`.
+    """
+    fields = list(fields if fields is not None else field_list_dict['univariate_categorical'])
+    position = {col_name: i for i, col_name in enumerate(fields)}
+    values = results[column].to_numpy()
+    matrix = np.full((len(fields), len(fields)), fill_value, dtype=np.float64 if np.issubdtype(values.dtype, np.number) else object)
+    field1 = results.index.get_level_values(0).astype(str)
+    field2 = results.index.get_level_values(1).astype(str)
+    mask = field1.isin(fields) & field2.isin(fields)
+    rows, cols = field1[mask].map(position).values, field2[mask].map(position).values
+    matrix[rows, cols] = matrix[cols, rows] = values[mask]
+    return pd.DataFrame(matrix, index=fields, columns=fields)
+
+
+def compute_chi2_matrices(results, fields=None, hovertext_columns=('pearson_chi2_test', 'degrees_of_freedom', 'normalized_score', 'Wilson–Hilferty_score')):
+    r"""Arrange bivariate chi-squared test results into symmetric field-by-field matrices of statistics and hovertext.
+    
+    Parameters
+    ----------
+    results : pandas DataFrame
+        The chi-squared test results indexed by pair of fields, as returned by `compute_chi2_test(..., grouping='bivariate')`
+        or under the key 'chi2' of `compute_all_tests(..., grouping='bivariate')`
+    fields : list of str, optional
+        The order of the rows and columns of the matrices. Defaults to `field_list_dict['univariate_categorical']`.
+    hovertext_columns : tuple of str
+        The columns listed in the hovertext of each pair of fields, as '{column}={value}<br>' for each column
+    
+    Returns
+    -------
+    dictionary
+        Maps each column of `results` to its matrix, and 'hovertext' to a matrix of hovertext strings (empty where there are no results).
+        The matrices are pandas DataFrames with one row and one column per field.
+    """
+    matrices = {column: make_field_matrix(results, column, fields) for column in results.columns}
+    hovertext = pd.Series('', index=results.index)
+    for column in hovertext_columns:
+        hovertext = hovertext + column + '=' + results[column].astype(str) + '<br>'
+    matrices['hovertext'] = make_field_matrix(hovertext.to_frame('hovertext'), 'hovertext', fields, fill_value='')
+    return matrices
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following:
+    * ContingencyTables - Stores the counts of value pairs for every pair of fields as sparse 2D arrays over shared per-field category dictionaries
+
+A table of bivariate counts in long format (columns `column_name1, column_name2, val1, val2, counts_*`) repeats the field names
+and values as strings on every row, and every lookup of a pair of fields is a scan with string comparisons.
+A ContingencyTables object instead holds one sorted array of labels per field, and for each pair of fields the non-zero cells
+as integer row codes, column codes and counts (coordinate format). Any pair's table, or its margins, are then obtained by
+dictionary lookup and array operations, without re-aggregation.
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def _sorted_labels(values):
+    # Labels are sorted within a field. Values of a single field share a type, so they can be compared with each other.
+    # Null values, if any, are given the last label.
+    uniques = pd.unique(values)
+    nulls = pd.isnull(uniques)
+    return np.concatenate([np.sort(uniques[~nulls]), uniques[nulls][:1]]).astype(object)
+
+
+class ContingencyTables(object):
+    r"""Stores the counts of value pairs for every pair of fields as sparse 2D arrays over shared per-field category dictionaries.
+
+    Parameters
+    ----------
+    labels : dictionary
+        Maps each field name to a numpy array of its distinct values (labels), shared by every pair involving the field
+    cells : dictionary
+        Maps each pair of fields to a tuple `(rows, cols, counts)`, where `rows` and `cols` are integer arrays of codes into the
+        labels of the first and second field, and `counts` is a 2D array with one column per entry of `count_cols`
+    count_cols : list of str
+        The names of the counts columns, e.g. `['counts_sim2', 'counts_av2017']`
+    """
+    def __init__(self, labels, cells, count_cols):
+        self.labels = labels
+        self.cells = cells
+        self.count_cols = list(count_cols)
+
+    @classmethod
+    def from_long(cls, frame, count_cols=None):
+        r"""Builds the contingency tables from a table of bivariate counts in long format.
+
+        Parameters
+        ----------
+        frame : pandas DataFrame
+            A table with columns `column_name1, column_name2, val1, val2` and one or more columns of counts,
+            e.g. a table from `analysis.read_counts('bivariate_categorical')` or `analysis.combine_counts`
+        count_cols : list of str, optional
+            The columns of counts to store. Defaults to every column whose name begins with 'counts_'.
+        """
+        if count_cols is None:
+            count_cols = [col_label for col_label in frame.columns if col_label.startswith('counts_')]
+        names1 = frame['column_name1'].astype(str).values
+        names2 = frame['column_name2'].astype(str).values
+        vals1 = frame['val1'].values
+        vals2 = frame['val2'].values
+
+        # Build the shared dictionary of labels for each field, and encode the values of every row
+        labels, codes1, codes2 = dict(), np.zeros(len(frame), dtype=np.int32), np.zeros(len(frame), dtype=np.int32)
+        positions1 = pd.Series(np.arange(len(frame))).groupby(names1).indices
+        positions2 = pd.Series(np.arange(len(frame))).groupby(names2).indices
+        for field in set(positions1) | set(positions2):
+            index1 = positions1.get(field, np.array([], dtype=np.int64))
+            index2 = positions2.get(field, np.array([], dtype=np.int64))
+            labels[field] = _sorted_labels(np.concatenate([vals1[index1], vals2[index2]]))
+            lookup = pd.Index(labels[field])
+            codes1[index1] = lookup.get_indexer(vals1[index1])
+            codes2[index2] = lookup.get_indexer(vals2[index2])
+
+        # Group the rows by pair of fields, sorting cells within each pair by row code and then column code
+        pair_codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([names1, names2]))
+        order = np.lexsort((codes2, codes1, pair_codes))
+        boundaries = np.searchsorted(pair_codes[order], np.arange(len(pairs) + 1))
+        counts = np.column_stack([frame[col_label].values for col_label in count_cols])[order]
+        cells = {tuple(pair): (codes1[order[start:stop]], codes2[order[start:stop]], counts[start:stop])
+                 for pair, start, stop in zip(pairs, boundaries[:-1], boundaries[1:])}
+        return cls(labels, cells, count_cols)
+
+    def to_long(self):
+        r"""Converts the contingency tables back to a table of bivariate counts in long format."""
+        frames = list()
+        for (field1, field2), (rows, cols, counts) in self.cells.items():
+            frame = pd.DataFrame({'column_name1': field1, 'column_name2': field2,
+                                  'val1': self.labels[field1][rows], 'val2': self.labels[field2][cols]})
+            for position, col_label in enumerate(self.count_cols):
+                frame[col_label] = counts[:, position]
+            frames.append(frame)
+        frame = pd.concat(frames, ignore_index=True)
+        frame[['column_name1', 'column_name2']] = frame[['column_name1', 'column_name2']].astype('category')
+        return frame
+
+    @property
+    def pairs(self):
+        r"""The list of pairs of fields for which counts are stored."""
+        return list(self.cells.keys())
+
+    def _count_position(self, count_col):
+        return 0 if count_col is None else self.count_cols.index(count_col)
+
+    def sparse(self, field1, field2, count_col=None):
+        r"""Returns the non-zero cells of the table for a pair of fields as `(rows, cols, counts)`, in O(1).
+
+        The pair may be given in either order; the codes are swapped to match. `count_col` defaults to the first counts column.
+        """
+        position = self._count_position(count_col)
+        if (field1, field2) in self.cells:
+            rows, cols, counts = self.cells[(field1, field2)]
+        else:
+            cols, rows, counts = self.cells[(field2, field1)]
+        return rows, cols, counts[:, position]
+
+    def dense(self, field1, field2, count_col=None):
+        r"""Returns the table of counts for a pair of fields as a dense 2D array, indexed by the labels of `field1` and `field2`."""
+        rows, cols, counts = self.sparse(field1, field2, count_col)
+        table = np.zeros((len(self.labels[field1]), len(self.labels[field2])), dtype=counts.dtype)
+        table[rows, cols] = counts
+        return table
+
+    def margins(self, field1, field2, count_col=None):
+        r"""Returns the row and column margins (totals by value of `field1` and of `field2`) of the table for a pair of fields."""
+        rows, cols, counts = self.sparse(field1, field2, count_col)
+        return (np.bincount(rows, weights=counts, minlength=len(self.labels[field1])).astype(np.int64),
+                np.bincount(cols, weights=counts, minlength=len(self.labels[field2])).astype(np.int64))
+
+    def nbytes(self):
+        r"""Returns the number of bytes used by the arrays of codes and counts."""
+        return sum(rows.nbytes + cols.nbytes + counts.nbytes for rows, cols, counts in self.cells.values())
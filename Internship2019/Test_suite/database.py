@@ -1,10 +1,12 @@
 from sqlalchemy import create_engine
 from params import params
 
-def connect(username, password):
+def connect(username, password, pool_size=5, max_overflow=0, **kwargs):
     p = params.copy()
     p['username'] = username
     p['password'] = password
 
-    db = create_engine('{dialect}+{driver}://{username}:{password}@{server}:{port}/{database}'.format(**p))
+    # The connection pool is bounded at `pool_size` + `max_overflow` connections, so concurrent queries share a fixed number of sessions
+    db = create_engine('{dialect}+{driver}://{username}:{password}@{server}:{port}/{database}'.format(**p),
+                       pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True, **kwargs)
     return db
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * compute_dependence - Compute Cramér's V and (normalized) mutual information for every pair of fields in one batched pass
+    * dependence_matrix - Arrange a measure of dependence for every pair of fields into a symmetric field-by-field matrix
+    * compare_dependence - Compute the measures of dependence for both populations of a comparison and their real-minus-sim differences
+    * compute_dependence_matrices - Compute field-by-field matrices of the measures of dependence for each cohort
+
+The comparisons in `compute_stats` are of the proportions in each cell of the bivariate tables. Here we compare how strongly
+each pair of fields is associated within each cohort, which summarizes the dependence structure of the data at a glance.
+The cells of every pair of fields are concatenated into flat arrays (see `contingency.ContingencyTables`), with the row and column
+codes of each pair offset so that the margins of all pairs are obtained from one `np.bincount` each.
+For a pair of fields with n rows, observed proportions p, row margins r and column margins c:
+    * Pearson's chi-squared statistic for independence is `n * (sum(p^2 / (r c)) - 1)`, summed over the non-zero cells
+    * Cramér's V is `sqrt(chi2 / (n * (min(k_r, k_c) - 1)))`, where k_r and k_c are the numbers of observed values of each field
+    * The mutual information is `sum(p log(p / (r c)))`, normalized by `sqrt(H(r) H(c))` where H is entropy
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from compute_stats import make_field_matrix
+from contingency import ContingencyTables
+from params import categorical_cols, comparison_pairs
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# The measures of dependence computed for each pair of fields
+dependence_measures = ['cramers_v', 'mutual_information', 'normalized_mutual_information']
+
+
+def _entropy(proportions, ids, minlength):
+    # The entropy of each group of proportions, given the group id of each proportion
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summands = np.where(proportions > 0, -proportions * np.log(proportions), 0)
+    return np.bincount(ids, weights=summands, minlength=minlength)
+
+
+def compute_dependence(tables, count_col=None):
+    r"""Compute Cramér's V and (normalized) mutual information for every pair of fields in one batched pass.
+
+    Parameters
+    ----------
+    tables : ContingencyTables or pandas DataFrame
+        The bivariate counts, either as a `contingency.ContingencyTables` object or a table of counts in long format
+        (e.g. from `analysis.read_counts('bivariate_categorical')` or `analysis.combine_counts`)
+    count_col : str, optional
+        The counts column to use, e.g. 'counts_av2017'. Defaults to the first counts column.
+
+    Returns
+    -------
+    pandas DataFrame
+        Indexed by pair of fields, with columns for the population size, the numbers of observed values of each field,
+        Pearson's chi-squared statistic for independence and the measures in `dependence_measures`
+    """
+    if not isinstance(tables, ContingencyTables):
+        tables = ContingencyTables.from_long(tables)
+    pairs = tables.pairs
+    # Concatenate the cells of every pair, offsetting the codes of each pair so that the margins of every pair are distinct
+    row_sizes = np.array([len(tables.labels[field1]) for field1, field2 in pairs])
+    col_sizes = np.array([len(tables.labels[field2]) for field1, field2 in pairs])
+    row_offsets, col_offsets = np.r_[0, np.cumsum(row_sizes)], np.r_[0, np.cumsum(col_sizes)]
+    sparse = [tables.sparse(field1, field2, count_col) for field1, field2 in pairs]
+    pair_ids = np.repeat(np.arange(len(pairs)), [len(counts) for rows, cols, counts in sparse])
+    row_ids = np.concatenate([rows for rows, cols, counts in sparse]) + row_offsets[pair_ids]
+    col_ids = np.concatenate([cols for rows, cols, counts in sparse]) + col_offsets[pair_ids]
+    counts = np.concatenate([counts for rows, cols, counts in sparse]).astype(np.float64)
+
+    # Proportions of each cell and margin within its pair of fields
+    num_rows = np.bincount(pair_ids, weights=counts, minlength=len(pairs))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportions = counts / num_rows[pair_ids]
+        row_margins = np.bincount(row_ids, weights=proportions, minlength=row_offsets[-1])
+        col_margins = np.bincount(col_ids, weights=proportions, minlength=col_offsets[-1])
+        independent = row_margins[row_ids] * col_margins[col_ids]
+        nonzero = proportions > 0
+        chi2 = num_rows * (np.bincount(pair_ids[nonzero], weights=np.square(proportions[nonzero]) / independent[nonzero], minlength=len(pairs)) - 1)
+        mutual_information = np.bincount(pair_ids[nonzero], weights=proportions[nonzero] * np.log(proportions[nonzero] / independent[nonzero]),
+                                         minlength=len(pairs))
+    row_pair_ids = np.repeat(np.arange(len(pairs)), row_sizes)
+    col_pair_ids = np.repeat(np.arange(len(pairs)), col_sizes)
+    results = pd.DataFrame({'num_rows': num_rows.astype(np.int64),
+                            'num_values1': np.bincount(row_pair_ids, weights=row_margins > 0, minlength=len(pairs)).astype(np.int64),
+                            'num_values2': np.bincount(col_pair_ids, weights=col_margins > 0, minlength=len(pairs)).astype(np.int64),
+                            'chi2_independence': np.maximum(chi2, 0)},
+                           index=pd.MultiIndex.from_tuples(pairs, names=['column_name1', 'column_name2']))
+    min_values = np.minimum(results['num_values1'], results['num_values2'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['cramers_v'] = np.where(min_values > 1, np.sqrt(results['chi2_independence'] / (results['num_rows'] * (min_values - 1))), 0)
+        results['mutual_information'] = np.maximum(mutual_information, 0)
+        entropies = np.sqrt(_entropy(row_margins, row_pair_ids, len(pairs)) * _entropy(col_margins, col_pair_ids, len(pairs)))
+        results['normalized_mutual_information'] = np.where(entropies > 0, results['mutual_information'] / entropies, 0)
+    return results
+
+
+def dependence_matrix(results, measure='cramers_v', fields=None):
+    r"""Arrange a measure of dependence for every pair of fields into a symmetric field-by-field matrix.
+
+    `results` is a table as returned by `compute_dependence` (or a column of `compare_dependence`, by passing its name in `measure`).
+    The rows and columns are ordered as in `fields`, which defaults to `params.categorical_cols`. The diagonal and any pairs
+    without counts are left as NaN.
+    """
+    return make_field_matrix(results, measure, fields if fields is not None else categorical_cols)
+
+
+def compare_dependence(pair, comparison_table):
+    r"""Compute the measures of dependence for both populations of a comparison and their real-minus-sim differences.
+
+    Parameters
+    ----------
+    pair : tuple of str
+        The pair of table aliases being compared, simulated first, e.g. ('sim2', 'av2017')
+    comparison_table : ContingencyTables or pandas DataFrame
+        The joined bivariate counts for the pair, e.g. as returned by `analysis.combine_counts('bivariate_categorical', ...)`
+
+    Returns
+    -------
+    pandas DataFrame
+        Indexed by pair of fields, with columns `{measure}_{key}` for each measure and population, and `{measure}_diff`
+        for the value in the real population (`pair[1]`) minus the value in the simulated population (`pair[0]`)
+    """
+    tables = comparison_table if isinstance(comparison_table, ContingencyTables) else ContingencyTables.from_long(comparison_table)
+    results = dict()
+    for key in pair:
+        measures = compute_dependence(tables, 'counts_'+key)
+        for measure in dependence_measures:
+            results[measure+'_'+key] = measures[measure]
+    for measure in dependence_measures:
+        results[measure+'_diff'] = results[measure+'_'+pair[1]] - results[measure+'_'+pair[0]]
+    return pd.DataFrame(results)
+
+
+def compute_dependence_matrices(counts_tables, pairs=None, fields=None):
+    r"""Compute field-by-field matrices of the measures of dependence for each cohort, and of their differences for each comparison.
+
+    Parameters
+    ----------
+    counts_tables : dictionary
+        Tables of bivariate counts keyed by table alias, as returned by `analysis.read_counts('bivariate_categorical')`
+    pairs : list of tuples, optional
+        The comparisons for which the matrices of real-minus-sim differences are computed. Defaults to `params.comparison_pairs`.
+    fields : list of str, optional
+        The order of the rows and columns of the matrices. Defaults to `params.categorical_cols`.
+
+    Returns
+    -------
+    dictionary
+        Maps each table alias, and each pair in `pairs`, to a dictionary of matrices keyed by measure
+    """
+    pairs = pairs if pairs is not None else [pair for pair in comparison_pairs if pair[0] in counts_tables and pair[1] in counts_tables]
+    measures = {key: compute_dependence(frame) for key, frame in counts_tables.items()}
+    matrices = {key: {measure: dependence_matrix(results, measure, fields) for measure in dependence_measures}
+                for key, results in measures.items()}
+    for pair in pairs:
+        matrices[pair] = {measure: matrices[pair[1]][measure] - matrices[pair[0]][measure] for measure in dependence_measures}
+    return matrices
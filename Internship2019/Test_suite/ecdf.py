@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * to_day_offsets - Maps dates to integer day offsets from an origin date, with null values mapped to -1
+    * compute_ecdfs - Compute dense empirical cumulative distribution functions over a daily axis for each field, for a pair of populations
+    * compute_ks_test - Compute two-sample Kolmogorov-Smirnov test statistics for date fields from dense ECDFs
+    * kolmogorov_sf - The survival function of the Kolmogorov distribution, Q_KS
+    * compute_ks_2d_test - Compute the two-dimensional, two-sample Kolmogorov-Smirnov test of Fasano and Franceschini for a pair of date fields
+
+`compute_stats.compute_cdf` sorts tables of counts on their (mixed type) `val` column and takes a grouped cumulative sum per field.
+Here, dates are instead mapped to integer day offsets, which index dense arrays of counts with one row per field (or per field and value
+for the 'bivariate' grouping, as in the `categorical_cross_*_date` count types) and one column per day, plus a final column for null values.
+The ECDFs are then prefix sums along each row, and the KS statistic is the largest absolute difference between them.
+
+For the `surgery_date_cross_diagnosis_date` count type, the counts of each population form a dense two-dimensional grid over days, and the
+2D cumulative sum of the grid gives, for every cell, the number of points in each of the four quadrants around it in constant time.
+The Fasano–Franceschini statistic is then evaluated at every occupied cell at once, rather than by a scan over all pairs of points.
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from compute_stats import pop_sizes, _group_codes, _drop_null_groups
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# The largest number of cells in a dense array of counts built at once. Groups of rows are processed in blocks below this size.
+max_block_cells = 2**24
+
+
+def to_day_offsets(values, origin=None):
+    r"""Maps dates to integer day offsets from an origin date, with null values mapped to -1.
+
+    Parameters
+    ----------
+    values : array-like
+        Dates, as datetime64 values, a categorical of dates, or strings in 'YYYY-MM-DD' format
+    origin : numpy datetime64, optional
+        The date mapped to offset 0. Defaults to the earliest date in `values`.
+
+    Returns
+    -------
+    tuple
+        The pair `(offsets, origin)`, where `offsets` is an integer array of day offsets
+    """
+    days = pd.to_datetime(pd.Series(np.asarray(values, dtype=object)), format='%Y-%m-%d', errors='coerce').values.astype('datetime64[D]')
+    nulls = np.isnat(days)
+    if origin is None:
+        origin = days[~nulls].min() if (~nulls).any() else np.datetime64('1970-01-01', 'D')
+    offsets = (days - np.datetime64(origin, 'D')).astype(np.int64)
+    offsets[nulls] = -1
+    return offsets, np.datetime64(origin, 'D')
+
+
+def _dense_counts(codes, offsets, counts, num_groups, width):
+    # A dense array of counts with one row per group and one column per day offset, with null values in a final column
+    positions = codes.astype(np.int64) * (width + 1) + np.where(offsets < 0, width, offsets)
+    return np.bincount(positions, weights=counts, minlength=num_groups * (width + 1)).reshape(num_groups, width + 1)
+
+
+def _group_layout(comparison_table, grouping):
+    # The group of each row, the index of the groups, and the name of the column of dates
+    group_cols, val_col = (['column_name'], 'val') if grouping == 'univariate' else (['column_name1', 'val1'], 'val2')
+    codes, groups = _group_codes(comparison_table, group_cols)
+    return codes, groups, val_col
+
+
+def compute_ecdfs(pair, comparison_table, grouping='univariate'):
+    r"""Compute dense empirical cumulative distribution functions over a daily axis for each field, for a pair of populations.
+
+    Parameters
+    ----------
+    pair : tuple of str
+        The pair of table aliases being compared, e.g. ('sim2', 'av2017')
+    comparison_table : pandas DataFrame
+        The joined table of counts for the pair of a date count type, as returned by `analysis.combine_counts`
+    grouping : str, defaults to 'univariate'
+        Either 'univariate' (one ECDF per field, e.g. for 'univariate_dates') or 'bivariate' (one ECDF per field and value,
+        e.g. for 'categorical_cross_diagnosis_date'), as in `compute_stats.compute_cdf`
+
+    Returns
+    -------
+    dictionary
+        With keys 'groups' (the index of fields, or of fields and values), 'dates' (the dates of the columns, with NaT for the final
+        column of null values), and 'cdf_{key}' for each population, a 2D array with one row per group and one column per date.
+        Proportions are relative to the population sizes in `compute_stats.pop_sizes`, as in `compute_stats.compute_cdf`.
+    """
+    assert grouping in ['univariate', 'bivariate']
+    codes, groups, val_col = _group_layout(comparison_table, grouping)
+    offsets, origin = to_day_offsets(comparison_table[val_col])
+    width = int(offsets.max()) + 1 if len(offsets) else 0
+    valid = codes >= 0
+    results = {'groups': groups,
+               'dates': np.r_[origin + np.arange(width), np.datetime64('NaT', 'D')]}
+    for key in pair:
+        counts = comparison_table['counts_'+key].values[valid].astype(np.float64) / pop_sizes[key]
+        results['cdf_'+key] = np.cumsum(_dense_counts(codes[valid], offsets[valid], counts, len(groups), width), axis=1)
+    return results
+
+
+def compute_ks_test(pair, comparison_table, grouping='univariate'):
+    r"""Compute two-sample Kolmogorov-Smirnov test statistics for date fields from dense ECDFs.
+
+    This is an equivalent of `compute_stats.compute_ks_test` for date fields. The counts are laid out on a dense daily axis
+    in blocks of groups (see `max_block_cells`), and the ECDFs of each block are computed with prefix sums.
+    Returns a pandas DataFrame indexed by field (or field and value), with the same columns as `compute_stats.compute_ks_test`.
+    """
+    assert grouping in ['univariate', 'bivariate']
+    codes, groups, val_col = _group_layout(comparison_table, grouping)
+    offsets, origin = to_day_offsets(comparison_table[val_col])
+    width = int(offsets.max()) + 1 if len(offsets) else 0
+    weights = [comparison_table['counts_'+key].values.astype(np.float64) / pop_sizes[key] for key in pair]
+    # Sort the rows by group once, so that each block of groups is a contiguous slice of rows
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    block_size = max(1, max_block_cells // (width + 1))
+    statistics = np.zeros(len(groups))
+    for start in range(0, len(groups), block_size):
+        stop = min(start + block_size, len(groups))
+        rows = order[np.searchsorted(sorted_codes, start):np.searchsorted(sorted_codes, stop)]
+        cdf_diff = np.cumsum(_dense_counts(codes[rows] - start, offsets[rows], weights[0][rows] - weights[1][rows], stop - start, width), axis=1)
+        statistics[start:stop] = np.abs(cdf_diff).max(axis=1)
+    results = _drop_null_groups(pd.DataFrame({'ks_test_statistic': statistics}, index=groups))
+    results['ks_scaled'] = results['ks_test_statistic'] * np.sqrt((pop_sizes[pair[0]] * pop_sizes[pair[1]])/(pop_sizes[pair[0]] + pop_sizes[pair[1]]))
+    results['p_value'] = np.exp(-2 * np.square(results['ks_scaled']))
+    return results
+
+
+def kolmogorov_sf(values, num_terms=100):
+    r"""The survival function of the Kolmogorov distribution, `Q_KS(x) = 2 * sum_{j>=1} (-1)^(j-1) exp(-2 j^2 x^2)`, clipped to [0, 1]."""
+    values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+    j = np.arange(1, num_terms + 1)[:, np.newaxis]
+    series = 2 * np.sum((-1.0)**(j - 1) * np.exp(-2 * np.square(j * values)), axis=0)
+    return np.clip(np.where(values < 0.2, 1, series), 0, 1)
+
+
+def _weighted_correlation(x, y, weights):
+    # Pearson's correlation coefficient of points (x, y) with the given weights (counts)
+    total = weights.sum()
+    mean_x, mean_y = np.dot(weights, x) / total, np.dot(weights, y) / total
+    cov = np.dot(weights, (x - mean_x) * (y - mean_y))
+    var_x, var_y = np.dot(weights, np.square(x - mean_x)), np.dot(weights, np.square(y - mean_y))
+    return cov / np.sqrt(var_x * var_y) if var_x > 0 and var_y > 0 else 0.0
+
+
+def _ks_2d_statistics(x, y, counts, num_points):
+    # The statistics D_0 and D_1 and the correlation coefficients of two populations of points with the given counts
+    width_x, width_y = int(x.max()) + 1, int(y.max()) + 1
+    grids, cumulative, correlations = list(), list(), list()
+    for weights in counts:
+        grids.append(np.bincount(x * width_y + y, weights=weights, minlength=width_x * width_y).reshape(width_x, width_y))
+        cumulative.append(grids[-1].cumsum(axis=0).cumsum(axis=1))
+        correlations.append(_weighted_correlation(x, y, weights))
+
+    def quadrant_fractions(position, rows, cols):
+        # The fractions of a population in the quadrants (<=x, <=y), (<=x, >y), (>x, <=y) and (>x, >y) around each cell
+        table = cumulative[position]
+        lower_left, left, lower = table[rows, cols], table[rows, -1], table[-1, cols]
+        return np.stack([lower_left, left - lower_left, lower - lower_left, num_points[position] - left - lower + lower_left]) / num_points[position]
+
+    statistics = list()
+    for position in range(len(counts)):
+        rows, cols = np.nonzero(grids[position])
+        statistics.append(np.abs(quadrant_fractions(0, rows, cols) - quadrant_fractions(1, rows, cols)).max())
+    return statistics, correlations
+
+
+def compute_ks_2d_test(pair, comparison_table, x_col='DATE_FIRST_SURGERY', y_col='DIAGNOSISDATEBEST'):
+    r"""Compute the two-dimensional, two-sample Kolmogorov-Smirnov test of Fasano and Franceschini for a pair of date fields.
+
+    For each occupied cell of the grid of day offsets, the fractions of each population in the four quadrants around the cell are
+    obtained from the 2D cumulative sums of the grids of counts. The statistic D_k is the largest absolute difference between the
+    fractions over the cells occupied by population k and over the four quadrants, and the test statistic is the average of D_0 and D_1.
+    The p-value uses the approximation of Press et al. (Numerical Recipes), which accounts for the correlation between the two fields.
+    Rows with a null value in either field are left out, since they cannot be placed in the plane. If either population then has
+    no points, the statistics and p-value are NaN.
+
+    Parameters
+    ----------
+    pair : tuple of str
+        The pair of table aliases being compared, e.g. ('sim2', 'av2017')
+    comparison_table : pandas DataFrame
+        The joined table of counts for the pair, as returned by `analysis.combine_counts('surgery_date_cross_diagnosis_date', ...)`
+    x_col, y_col : str
+        The columns of the two date fields
+
+    Returns
+    -------
+    pandas DataFrame
+        Indexed by the pair of fields, with columns for the statistics D_0 and D_1, the test statistic, the numbers of points
+        and correlation coefficients of each population, the scaled statistic and the p-value
+    """
+    x, x_origin = to_day_offsets(comparison_table[x_col])
+    y, y_origin = to_day_offsets(comparison_table[y_col])
+    valid = (x >= 0) & (y >= 0)
+    x, y = x[valid], y[valid]
+    counts = [comparison_table['counts_'+key].values[valid].astype(np.float64) for key in pair]
+    num_points = [weights.sum() for weights in counts]
+    if min(num_points) == 0:
+        # A population with no points in the plane (e.g. an empty table, or null dates in every row) cannot be tested
+        statistics, correlations = [np.nan, np.nan], [np.nan, np.nan]
+    else:
+        statistics, correlations = _ks_2d_statistics(x, y, counts, num_points)
+    results = pd.DataFrame({'ks_2d_statistic_'+pair[0]: statistics[0], 'ks_2d_statistic_'+pair[1]: statistics[1]},
+                           index=pd.MultiIndex.from_tuples([(x_col, y_col)], names=['column_name1', 'column_name2']))
+    results['ks_2d_test_statistic'] = (statistics[0] + statistics[1]) / 2
+    for key, points, correlation in zip(pair, num_points, correlations):
+        results['num_points_'+key] = int(points)
+        results['correlation_'+key] = correlation
+    sqrt_num = np.sqrt(num_points[0] * num_points[1] / (num_points[0] + num_points[1])) if min(num_points) > 0 else np.nan
+    mean_correlation = (correlations[0] + correlations[1]) / 2
+    results['ks_scaled'] = results['ks_2d_test_statistic'] * sqrt_num / (1 + np.sqrt(1 - mean_correlation**2) * (0.25 - 0.75 / sqrt_num))
+    results['p_value'] = kolmogorov_sf(results['ks_scaled'].values)
+    return results
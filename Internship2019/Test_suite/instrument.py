@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following:
+    * enable - Switches instrumentation on, optionally writing each record to a file of JSON lines
+    * disable - Switches instrumentation off
+    * stage - A context manager recording the wall time, rows in and out and peak RSS of a stage of the pipeline
+    * instrumented - A decorator recording each call of a function as a stage
+    * summary - Summarizes the records by stage, count type and key into a pandas DataFrame
+    * clear - Discards the records
+This module also contains the list `records`, which holds a dictionary for each stage run while instrumentation was enabled.
+
+The modules `write_results`, `analysis`, `compute_stats` and `plots` mark their stages (extraction, fetching, cleaning, saving,
+reading, merging, statistics and plotting) with `stage` and `instrumented`. Each record holds the stage name, the count type and
+key (the table alias, or the pair of aliases being compared), the wall time in seconds, the numbers of rows in and out, and the
+peak resident set size (RSS) of the process at the end of the stage, with its increase during the stage. Stages nested in another
+stage of the same thread inherit its count type and key. The peak RSS is read with `resource.getrusage`, and is left empty where that is not available.
+
+Instrumentation is disabled by default, in which case `stage` returns a shared object that does nothing and `instrumented` functions
+call straight through, so the cost is a single check of the module variable `enabled`.
+"""
+
+# Standard library imports
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Third-party imports
+import pandas as pd
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# Whether stages are recorded. Switch with `enable` and `disable`
+enabled = False
+# The records of the stages run while instrumentation was enabled
+records = list()
+# The file to which each record is appended as a line of JSON, if any, and whether to print a line for each record
+log_filepath = None
+echo = False
+# The stack of stages currently running in each thread, from which nested stages inherit their count type and key.
+# Extraction jobs run on a thread pool (see the `scheduler` module), so each thread keeps its own stack.
+_local = threading.local()
+# Serializes the appends to `records` and to the file of JSON lines from different threads
+_lock = threading.Lock()
+
+
+def _running():
+    # The stack of stages currently running in this thread
+    if not hasattr(_local, 'stack'):
+        _local.stack = list()
+    return _local.stack
+
+
+def enable(filepath=None, verbose=False):
+    r"""Switches instrumentation on, optionally appending each record to `filepath` as a line of JSON, and printing it if `verbose`."""
+    global enabled, log_filepath, echo
+    enabled, log_filepath, echo = True, filepath, verbose
+
+
+def disable():
+    r"""Switches instrumentation off. The records so far are kept (see `clear`)."""
+    global enabled
+    enabled = False
+
+
+def clear():
+    r"""Discards the records."""
+    del records[:]
+
+
+def _peak_rss_mb():
+    # The peak resident set size of the process so far, in MB (ru_maxrss is in kilobytes on Linux and bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _num_rows(value):
+    # The number of rows of a table, or the total number of rows of a dictionary (or list) of tables, if known
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.shape[0]
+    if isinstance(value, dict) and value and all(isinstance(item, (pd.DataFrame, pd.Series)) for item in value.values()):
+        return sum(item.shape[0] for item in value.values())
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, (pd.DataFrame, pd.Series)) for item in value):
+        return sum(item.shape[0] for item in value)
+    return None
+
+
+def _key_label(key):
+    # Pairs of table aliases are recorded as e.g. 'sim2 vs. av2017'
+    return ' vs. '.join(key) if isinstance(key, tuple) else key
+
+
+class _Stage(object):
+    # A running stage, which becomes a record when it exits
+
+    def __init__(self, name, count_type, key, rows_in):
+        self.record = {'stage': name, 'count_type': count_type, 'key': _key_label(key), 'rows_in': rows_in, 'rows_out': None}
+
+    def set(self, **values):
+        r"""Sets fields of the record, e.g. `rows_out`, or `rows_in` when it is only known once the stage has started."""
+        self.record.update(values)
+
+    def __enter__(self):
+        running = _running()
+        if running:
+            for field in ['count_type', 'key']:
+                if self.record[field] is None:
+                    self.record[field] = running[-1].record[field]
+        running.append(self)
+        self._rss_start = _peak_rss_mb()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self._start
+        running = _running()
+        running.pop()
+        peak_rss = _peak_rss_mb()
+        self.record.update({'seconds': seconds, 'peak_rss_mb': peak_rss,
+                            'peak_rss_increase_mb': peak_rss - self._rss_start if peak_rss is not None else None,
+                            'depth': len(running), 'failed': exc_type is not None, 'timestamp': time.time()})
+        with _lock:
+            records.append(self.record)
+            if log_filepath is not None:
+                with open(log_filepath, 'a') as log_file:
+                    log_file.write(json.dumps(self.record, default=str) + '\n')
+        if echo:
+            print('[{stage}] {count_type} {key}: {seconds:.2f}s, rows {rows_in} -> {rows_out}, peak RSS {peak_rss_mb} MB'.format(**self.record))
+        return False
+
+
+class _NullStage(object):
+    # Stands in for a stage while instrumentation is disabled
+
+    def set(self, **values):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name, count_type=None, key=None, rows_in=None):
+    r"""A context manager recording the wall time, rows in and out and peak RSS of a stage of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, e.g. 'fetch' or 'merge'
+    count_type : str, optional
+        The count type being processed. Defaults to the count type of the enclosing stage, if any.
+    key : str or tuple of str, optional
+        The table alias, or pair of aliases, being processed. Defaults to the key of the enclosing stage, if any.
+    rows_in : int, optional
+        The number of rows going into the stage
+
+    Returns
+    -------
+    A context manager, whose `set` method sets fields of the record, e.g. `rows_out`:
+
+        with instrument.stage('merge', count_type, pair, rows_in=n) as current:
+            table = ...
+            current.set(rows_out=table.shape[0])
+    """
+    if not enabled:
+        return _null_stage
+    return _Stage(name, count_type, key, rows_in)
+
+
+def instrumented(name=None):
+    r"""A decorator recording each call of a function as a stage, named after the function unless `name` is given.
+
+    The count type and key are taken from the arguments named `count_type` and `key` (or `pair`), if the function has them.
+    The rows in are those of the first table (or dictionary of tables) among the arguments, and the rows out those of the result.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            rows_in = next((rows for rows in map(_num_rows, arguments.values()) if rows is not None), None)
+            with _Stage(name or function.__name__, arguments.get('count_type'), arguments.get('key', arguments.get('pair')), rows_in) as current:
+                result = function(*args, **kwargs)
+                current.set(rows_out=_num_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def summary(by=('stage', 'count_type', 'key')):
+    r"""Summarizes the records by stage, count type and key (or the fields in `by`) into a pandas DataFrame.
+
+    The columns are the number of calls, the total and largest wall time in seconds, the total numbers of rows in and out,
+    and the largest peak RSS and increase in peak RSS in MB. Rows are sorted by total wall time, longest first.
+    """
+    by = list(by)
+    columns = ['calls', 'seconds', 'max_seconds', 'rows_in', 'rows_out', 'peak_rss_mb', 'peak_rss_increase_mb']
+    if not records:
+        return pd.DataFrame(columns=columns)
+    frame = pd.DataFrame(records)
+    frame[by] = frame[by].fillna('')
+    for col_label in ['rows_in', 'rows_out', 'peak_rss_mb', 'peak_rss_increase_mb']:
+        frame[col_label] = pd.to_numeric(frame[col_label], errors='coerce')
+    grouped = frame.groupby(by=by, sort=False)
+    results = pd.concat([grouped.size(), grouped['seconds'].sum(), grouped['seconds'].max(),
+                         grouped['rows_in'].sum(min_count=1), grouped['rows_out'].sum(min_count=1),
+                         grouped['peak_rss_mb'].max(), grouped['peak_rss_increase_mb'].max()], axis=1)
+    results.columns = columns
+    return results.sort_values(by='seconds', ascending=False)
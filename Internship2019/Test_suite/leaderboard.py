@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following:
+    * Leaderboard - Keeps the global and per-field top-k worst-fitting cells, streamed from comparison tables through bounded heaps
+    * benjamini_hochberg - Compute Benjamini–Hochberg adjusted p-values for selected tests in a family of tests
+    * rank_cells - Streams the comparison tables of several count types and pairs through a Leaderboard
+
+`compute_stats.compute_z_test` and `compute_chi2_test` add proportion, z-score and chi-squared columns to every cell of a comparison table
+before anything is sorted. Here, the z-score and Pearson's chi-squared summand of each cell are computed from the counts in chunks of rows,
+and only the cells which may enter the top k (found with `np.argpartition`) are turned into records and pushed onto bounded heaps.
+Cells are scored by the squared z-score or by the chi-squared summand; either way, the score is compared with a chi-squared
+distribution with one degree of freedom, so the p-value of a cell is `erfc(sqrt(score / 2))`.
+For the Benjamini–Hochberg adjustment across the whole family of tests, the score of every cell is kept as a `float32`,
+which is a small fraction of the memory of the intermediate columns.
+"""
+
+# Standard library imports
+import heapq
+import itertools
+import math
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from analysis import read_counts, combine_counts
+from compute_stats import pop_sizes
+from params import comparison_pairs
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# Vectorized complementary error function, used for the p-values of the selected cells only
+_erfc = np.frompyfunc(math.erfc, 1, 1)
+
+
+def _p_values(scores):
+    # The p-values of scores distributed as chi-squared with one degree of freedom under the null hypothesis
+    return _erfc(np.sqrt(np.asarray(scores, dtype=np.float64) / 2)).astype(np.float64)
+
+
+def benjamini_hochberg(scores, selected):
+    r"""Compute Benjamini–Hochberg adjusted p-values for selected tests in a family of tests.
+
+    The adjusted p-value of the i-th smallest p-value is `min_{j >= i} m p_(j) / j`, over the m tests of the family.
+    Since `m p_(j) / j >= p_(j)`, the minimum only needs the p-values up to the first one exceeding the running minimum,
+    so p-values are computed in blocks of the sorted scores until that point, rather than for the whole family.
+
+    Parameters
+    ----------
+    scores : numpy array
+        The scores of every test in the family, as squared z-scores or chi-squared summands
+    selected : numpy array
+        The scores of the tests to adjust, which should be members of `scores` (of the same data type)
+
+    Returns
+    -------
+    numpy array
+        The adjusted p-values of the selected tests
+    """
+    num_tests = len(scores)
+    if num_tests == 0 or len(selected) == 0:
+        return np.array([])
+    sorted_scores = -np.sort(-scores)
+    ranks = np.minimum(np.searchsorted(-sorted_scores, -np.asarray(selected, dtype=scores.dtype), side='left'), num_tests - 1)
+    num_top = int(ranks.max()) + 1
+    ratios = list()
+    start, stop = 0, num_top
+    while True:
+        p_values = _p_values(sorted_scores[start:stop])
+        ratios.append(num_tests * p_values / np.arange(start + 1, stop + 1))
+        bound = np.concatenate(ratios)[num_top - 1:].min()
+        if stop == num_tests or _p_values(sorted_scores[stop:stop + 1])[0] >= bound:
+            break
+        start, stop = stop, min(num_tests, stop + 2 * stop)
+    adjusted = np.minimum.accumulate(np.concatenate(ratios)[::-1])[::-1]
+    return np.minimum(adjusted[ranks], 1)
+
+
+class Leaderboard(object):
+    r"""Keeps the global and per-field top-k worst-fitting cells, streamed from comparison tables through bounded heaps.
+
+    Parameters
+    ----------
+    k : int, defaults to 200
+        The number of cells in the global leaderboard
+    per_field_k : int, defaults to 10
+        The number of cells kept for each field (or pair of fields)
+    score : str, defaults to 'z'
+        Either 'z' to rank cells by their squared z-score, as in `compute_stats.compute_z_test`, or 'chi2' to rank them by their
+        Pearson's chi-squared summand, as in `compute_stats.compute_chi2_test`
+    adjust : Boolean, defaults to True
+        Set to False to skip the Benjamini–Hochberg adjustment, in which case the scores of the other cells are not kept
+    chunksize : int, defaults to 1000000
+        The number of rows of a comparison table scored at once
+    """
+    def __init__(self, k=200, per_field_k=10, score='z', adjust=True, chunksize=1000000):
+        assert score in ['z', 'chi2']
+        self.k = k
+        self.per_field_k = per_field_k
+        self.score = score
+        self.adjust = adjust
+        self.chunksize = chunksize
+        self.heap = list()
+        self.field_heaps = dict()
+        self.all_scores = list()
+        self.num_tests = 0
+        # Breaks ties between equal scores, so that records are never compared
+        self._counter = itertools.count()
+        # The scores of the records on the heaps and their adjusted p-values, computed once after the last update
+        self._adjusted = None
+
+    def _push(self, heap, size, item):
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+    def update(self, pair, comparison_table, count_type=''):
+        r"""Scores the cells of a comparison table, as returned by `analysis.combine_counts`, and pushes the worst-fitting ones onto the heaps.
+
+        The records hold the counts of the first and second table of the pair as `counts_sim` and `counts_real` respectively.
+        """
+        n0, n1 = pop_sizes[pair[0]], pop_sizes[pair[1]]
+        self._adjusted = None
+        name_cols = [col_label for col_label in comparison_table.columns if col_label.startswith('column_name')]
+        val_cols = [col_label for col_label in comparison_table.columns if col_label not in name_cols and not col_label.startswith('counts_')]
+        for start in range(0, comparison_table.shape[0], self.chunksize):
+            chunk = comparison_table.iloc[start:start + self.chunksize]
+            counts0 = chunk['counts_'+pair[0]].values.astype(np.float64)
+            counts1 = chunk['counts_'+pair[1]].values.astype(np.float64)
+            if self.score == 'z':
+                p_ave = (counts0 + counts1) / (n0 + n1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    statistics = (counts0 / n0 - counts1 / n1) / np.sqrt(p_ave * (1 - p_ave) * ((1/n0) + (1/n1)))
+                scores = np.nan_to_num(np.square(statistics))
+            else:
+                expected = n0 * counts1 / n1
+                statistics = np.square(counts0 - expected) / np.where(expected != 0, expected, 0.5)
+                scores = statistics
+            self.num_tests += len(scores)
+            if self.adjust:
+                self.all_scores.append(scores.astype(np.float32))
+
+            # The candidates for the global leaderboard are the k largest scores of the chunk
+            candidates = np.argpartition(-scores, self.k - 1)[:self.k] if len(scores) > self.k else np.arange(len(scores))
+            # The candidates for the per-field leaderboards are the per_field_k largest scores of each field in the chunk
+            fields = pd.factorize(pd.MultiIndex.from_arrays([chunk[col_label] for col_label in name_cols]) if len(name_cols) > 1
+                                  else chunk[name_cols[0]] if name_cols else np.zeros(len(chunk)))[0]
+            order = np.lexsort((-scores, fields))
+            sorted_fields = fields[order]
+            rank = np.arange(len(order)) - np.searchsorted(sorted_fields, sorted_fields)
+            candidates = np.union1d(candidates, order[rank < self.per_field_k])
+
+            for row in candidates:
+                field = tuple(str(chunk[col_label].iat[row]) for col_label in name_cols) or (' x '.join(val_cols),)
+                record = {'count_type': count_type, 'pair': pair,
+                          'field': field[0] if len(field) == 1 else field,
+                          'value': tuple(chunk[col_label].iat[row] for col_label in val_cols) if len(val_cols) > 1 else chunk[val_cols[0]].iat[row],
+                          'counts_sim': int(counts0[row]), 'counts_real': int(counts1[row]),
+                          ('z_test' if self.score == 'z' else 'pearson_chi2_summand'): float(statistics[row]),
+                          'score': float(scores[row])}
+                item = (float(scores[row]), next(self._counter), record)
+                self._push(self.heap, self.k, item)
+                self._push(self.field_heaps.setdefault((count_type, pair, record['field']), list()), self.per_field_k, item)
+
+    def _adjusted_p_values(self, scores):
+        # The Benjamini–Hochberg adjusted p-values of the scores of records on the heaps. Those of every record on the global and
+        # per-field heaps are computed together, so the whole family of tests is only sorted once
+        if self._adjusted is None:
+            selected = np.unique(np.array([item[0] for heap in [self.heap] + list(self.field_heaps.values()) for item in heap], dtype=np.float32))
+            self._adjusted = (selected, benjamini_hochberg(np.concatenate(self.all_scores), selected))
+        selected, adjusted = self._adjusted
+        return adjusted[np.searchsorted(selected, np.asarray(scores, dtype=np.float32))]
+
+    def _frame(self, items):
+        frame = pd.DataFrame([record for score, counter, record in sorted(items, key=lambda item: (-item[0], item[1]))])
+        if frame.empty:
+            return frame
+        frame['p_value'] = _p_values(frame['score'].values)
+        if self.adjust:
+            # The cells are adjusted by the rank of their score in the whole family of tests
+            frame['p_value_bh'] = self._adjusted_p_values(frame['score'].values)
+        return frame
+
+    def leaderboard(self):
+        r"""Returns the global top-k cells as a pandas DataFrame, sorted by score, with p-values (and Benjamini–Hochberg adjusted p-values)."""
+        return self._frame(self.heap)
+
+    def field_leaderboards(self):
+        r"""Returns the per-field top-k cells as a pandas DataFrame, sorted by score within each field."""
+        frames = [self._frame(heap) for heap in self.field_heaps.values()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def rank_cells(count_types, pairs=None, k=200, per_field_k=10, score='z', adjust=True, counts_tables=None):
+    r"""Streams the comparison tables of several count types and pairs through a `Leaderboard`, one count type at a time.
+
+    Parameters
+    ----------
+    count_types : list of str
+        The count types to rank, e.g. `list(params.field_list_dict.keys())`
+    pairs : list of tuples, optional
+        The pairs of table aliases to compare. Defaults to `params.comparison_pairs`.
+    k, per_field_k, score, adjust
+        Passed to `Leaderboard`
+    counts_tables : dictionary, optional
+        Tables of group counts keyed by count type and then by alias. By default, each count type is read with `analysis.read_counts`.
+
+    Returns
+    -------
+    Leaderboard
+        Call its `leaderboard` and `field_leaderboards` methods for the results
+    """
+    pairs = pairs if pairs is not None else comparison_pairs
+    board = Leaderboard(k, per_field_k, score, adjust)
+    for count_type in count_types:
+        keys = list(dict.fromkeys(key for pair in pairs for key in pair))
+        tables = counts_tables[count_type] if counts_tables is not None else read_counts(count_type, keys=keys)
+        for pair, comparison_table in combine_counts(count_type, tables, pairs).items():
+            board.update(pair, comparison_table, count_type)
+        del tables
+    return board
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * source_columns - Returns the names of the columns of an extract of tumour data needed to derive the fields in `params.col_names`
+    * read_population - Reads a local .csv extract of tumour data (e.g. `sim_av_tumour.csv`) into a pandas DataFrame of strings
+    * encode_column - Integer-encodes a column of values, optionally transforming the distinct values (labels) first
+    * encode_population - Integer-encodes every categorical and date field of a table of tumour data
+    * load_population - Reads and integer-encodes a local .csv extract of tumour data
+    * count_values - Computes counts of values over a list of fields in an encoded population
+    * count_value_pairs - Computes counts of value pairs over a list of pairs of fields in an encoded population
+    * count_combinations - Computes the non-zero counts of value tuples over a set of fields in an encoded population, as integer codes
+    * count_value_tuples - Computes counts of value tuples over a list of sets of fields in an encoded population
+    * make_totals - Computes group counts for an encoded population in the same layout as `queries.make_totals_query`
+This module also contains the parameter `field_sources`, which describes how each field is derived from the raw Simulacrum data,
+mirroring the preprocessing steps taken by the SQL queries in `populations.pop_queries`.
+
+An encoded population is a dictionary whose keys are field names and values are pairs `(codes, labels)`, where `labels` is a
+sorted array of the distinct values taken by the field (with null values represented by 'None', as in the SQL queries) and
+`codes` is an integer array giving, for each row, the position of its value in `labels`.
+"""
+
+# Standard library imports
+from itertools import combinations
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from params import col_names, col_name_pairs
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def _to_date(labels):
+    return pd.to_datetime(labels, errors='coerce').strftime('%Y-%m-%d')
+
+
+def _to_month(labels):
+    return pd.to_datetime(labels, errors='coerce').strftime('%Y-%m')
+
+
+# For each field, the name of the column in the raw Simulacrum data it is derived from, and the transformation applied to its values.
+# These are the same preprocessing steps as taken by the SQL queries in `populations.pop_queries`.
+field_sources = {'QUINTILE_2015': ('QUINTILE_2015', lambda labels: labels.str[:1]),
+                 'CREG_CODE': ('CREG_CODE', lambda labels: labels.str[1:]),
+                 'DIAGNOSISDATEBEST': ('DIAGNOSISDATEBEST', _to_date),
+                 'DIAGNOSISMONTHBEST': ('DIAGNOSISDATEBEST', _to_month),
+                 'DATE_FIRST_SURGERY': ('DATE_FIRST_SURGERY', _to_date),
+                 'MONTH_FIRST_SURGERY': ('DATE_FIRST_SURGERY', _to_month)}
+
+
+def source_columns(raw=True):
+    r"""Returns the names of the columns of an extract of tumour data needed to derive the fields in `params.col_names`."""
+    if raw:
+        return list(dict.fromkeys(field_sources.get(col_name, (col_name,))[0] for col_name in col_names))
+    return list(col_names)
+
+
+def read_population(filepath, raw=True, **kwargs):
+    r"""Reads a local .csv extract of tumour data (e.g. `sim_av_tumour.csv`) into a pandas DataFrame of strings.
+
+    Only the columns needed to derive the fields in `params.col_names` are read, and every value is kept as a string
+    so that the values match those obtained from the SQL database via `TO_CHAR`.
+
+    Parameters
+    ----------
+    filepath : str
+        The location of the .csv file
+    raw : Boolean, defaults to True
+        Set to False if the extract already contains the derived fields, e.g. if it was exported using a query in `populations.pop_queries`.
+    **kwargs
+        Additional keyword arguments passed to `pd.read_csv`
+
+    Returns
+    -------
+    pandas DataFrame
+        The table of tumour data, with null values represented by NaN
+    """
+    return pd.read_csv(filepath, usecols=source_columns(raw), dtype=str, **kwargs)
+
+
+def encode_column(series, transform=None):
+    r"""Integer-encodes a column of values, optionally transforming the distinct values (labels) first.
+
+    The transformation is applied to the distinct values only, rather than every row, and values which coincide after
+    the transformation are merged. Null values, including empty strings produced by the transformation, are labelled 'None'.
+
+    Returns
+    -------
+    tuple of numpy arrays
+        The pair `(codes, labels)`, where `labels` are sorted strings and `codes` are row-wise positions in `labels`
+    """
+    codes, labels = pd.factorize(series, sort=True)
+    labels = pd.Index(labels)
+    if transform is not None:
+        labels = pd.Index(transform(labels))
+    # Null values are given the sentinel code -1 by `pd.factorize`, which we point at an extra null label instead
+    codes = np.where(codes < 0, len(labels), codes)
+    labels = pd.Series(list(labels) + [np.nan], dtype=object).replace('', np.nan).fillna('None').astype(str)
+    # Re-encode the (possibly merged) labels and map the row-wise codes through the relabelling
+    relabel, labels = pd.factorize(labels, sort=True)
+    return relabel[codes].astype(np.int32), np.asarray(labels, dtype=str)
+
+
+def encode_population(frame, raw=True):
+    r"""Integer-encodes every categorical and date field of a table of tumour data.
+
+    Parameters
+    ----------
+    frame : pandas DataFrame
+        The table of tumour data, as returned by `read_population`
+    raw : Boolean, defaults to True
+        Set to False if the table already contains the derived fields, in which case no preprocessing is applied.
+
+    Returns
+    -------
+    dictionary
+        The encoded population, a dictionary of `(codes, labels)` pairs keyed by field name
+    """
+    population = dict()
+    for col_name in col_names:
+        source, transform = field_sources.get(col_name, (col_name, None)) if raw else (col_name, None)
+        population[col_name] = encode_column(frame[source], transform)
+    return population
+
+
+def load_population(filepath, raw=True, **kwargs):
+    r"""Reads and integer-encodes a local .csv extract of tumour data. See `read_population` and `encode_population`."""
+    return encode_population(read_population(filepath, raw, **kwargs), raw)
+
+
+def count_values(population, field_list=None, suffix=''):
+    r"""Computes counts of values over a list of fields in an encoded population.
+
+    Returns a pandas DataFrame with columns `column_name, val, counts_{suffix}`, omitting values with zero count.
+    """
+    iterator = field_list if field_list is not None else col_names
+    frames = list()
+    for col_name in iterator:
+        codes, labels = population[col_name]
+        counts = np.bincount(codes, minlength=len(labels))
+        nonzero = np.flatnonzero(counts)
+        frames.append(pd.DataFrame({'column_name': col_name, 'val': labels[nonzero], 'counts_'+suffix: counts[nonzero]}))
+    return pd.concat(frames, ignore_index=True)
+
+
+# The largest number of cells in a pairwise table we count with a dense `np.bincount`, beyond which we use `np.unique`
+max_dense_cells = 2**26
+
+
+def count_value_pairs(population, field_list=None, suffix=''):
+    r"""Computes counts of value pairs over a list of pairs of fields in an encoded population.
+
+    The codes of each pair of fields are combined into a single integer code, which is counted in one vectorized pass.
+    Returns a pandas DataFrame with columns `column_name1, column_name2, val1, val2, counts_{suffix}`, omitting value pairs with zero count.
+    """
+    iterator = field_list if field_list is not None else col_name_pairs
+    frames = list()
+    for col_name1, col_name2 in iterator:
+        codes1, labels1 = population[col_name1]
+        codes2, labels2 = population[col_name2]
+        combined = codes1.astype(np.int64) * len(labels2) + codes2
+        if len(labels1) * len(labels2) <= max_dense_cells:
+            counts = np.bincount(combined, minlength=len(labels1) * len(labels2))
+            combined = np.flatnonzero(counts)
+            counts = counts[combined]
+        else:
+            combined, counts = np.unique(combined, return_counts=True)
+        frames.append(pd.DataFrame({'column_name1': col_name1, 'column_name2': col_name2,
+                                    'val1': labels1[combined // len(labels2)], 'val2': labels2[combined % len(labels2)],
+                                    'counts_'+suffix: counts}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def count_combinations(population, field_set):
+    r"""Computes the non-zero counts of value tuples over a set of fields in an encoded population, as integer codes.
+
+    The codes of the fields are combined into a single integer code per row, which is counted with a dense `np.bincount`
+    if the table has at most `max_dense_cells` cells, and with `np.unique` otherwise.
+
+    Returns
+    -------
+    tuple of numpy arrays
+        The pair `(codes, counts)`, where `codes` is a 2D array with one row per non-zero value tuple and one column per field,
+        giving the positions of the values in the labels of each field, and `counts` are the corresponding counts
+    """
+    codes = [population[col_name][0] for col_name in field_set]
+    shape = tuple(len(population[col_name][1]) for col_name in field_set)
+    num_cells = np.prod(shape, dtype=np.float64)
+    if num_cells < 2**62:
+        combined = np.ravel_multi_index(codes, shape)
+        if num_cells <= max_dense_cells:
+            counts = np.bincount(combined, minlength=int(num_cells))
+            combined = np.flatnonzero(counts)
+            counts = counts[combined]
+        else:
+            combined, counts = np.unique(combined, return_counts=True)
+        codes = np.column_stack(np.unravel_index(combined, shape))
+    else:
+        codes, counts = np.unique(np.column_stack(codes), axis=0, return_counts=True)
+    return codes.astype(np.int32), counts
+
+
+def count_value_tuples(population, field_list, suffix=''):
+    r"""Computes counts of value tuples over a list of sets of fields in an encoded population.
+
+    Returns a pandas DataFrame with columns `column_name1, ..., column_name{k}, val1, ..., val{k}, counts_{suffix}`,
+    omitting value tuples with zero count. Every set of fields in `field_list` should have the same number of fields.
+    """
+    frames = list()
+    for field_set in field_list:
+        codes, counts = count_combinations(population, field_set)
+        frame = pd.DataFrame({'column_name{}'.format(i+1): col_name for i, col_name in enumerate(field_set)}, index=pd.RangeIndex(len(counts)))
+        for i, col_name in enumerate(field_set):
+            frame['val{}'.format(i+1)] = population[col_name][1][codes[:, i]]
+        frame['counts_'+suffix] = counts
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_totals(population, suffix='', field_list=None, num_variates=1):
+    r"""Computes group counts for an encoded population, as an offline alternative to `queries.make_totals_query`.
+
+    Parameters
+    ----------
+    population : dictionary
+        The encoded population, as returned by `encode_population` or `load_population`
+    suffix : str, optional
+        A suffix added to the 'counts' column name in the final output
+    field_list : list, optional
+        The fields (or sets of fields) to group by. Defaults to `col_names` (or `col_name_pairs`, or all combinations of `num_variates` fields).
+    num_variates : int, defaults to 1
+        Select the number of variables counts are grouped by (over all distinct combinations).
+
+    Returns
+    -------
+    pandas DataFrame
+        The table of group counts, in the same layout as the result of the corresponding SQL query
+    """
+    if num_variates == 1:
+        return count_values(population, field_list, suffix)
+    elif num_variates == 2:
+        return count_value_pairs(population, field_list, suffix)
+    elif num_variates > 2:
+        return count_value_tuples(population, field_list if field_list is not None else combinations(col_names, num_variates), suffix)
+    else:
+        print('The keyword `num_variates` currently only accepts positive integers')
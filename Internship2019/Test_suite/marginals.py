@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following:
+    * MarginalTables - Stores the counts of value tuples for sets of fields (k-way marginals) as sparse arrays over shared per-field labels
+    * dependence_scores - Measures how far the fields in each stored set are from independence, using a generalized Cramér's V
+    * candidate_field_sets - Selects the sets of k+1 fields all of whose k-field subsets show dependence
+    * compute_marginals - Computes pruned k-way marginals for one or more encoded populations, level by level
+    * get_marginals_from_db - Extracts k-way marginals for a cohort from the SQL database
+    * compute_chi2_test - Compute Pearson's chi-squared test statistics for every set of fields, from the sparse marginals of two populations
+
+There are 465 pairs of the 31 categorical fields, but 4,495 triples and 31,465 sets of four fields, so higher-order marginals
+are not enumerated naively. Instead, in the manner of the Apriori algorithm, a set of k+1 fields is only counted if each of its
+subsets of k fields shows some dependence (a generalized Cramér's V of at least `threshold`) in at least one population.
+Sets of fields whose lower-order marginals already look independent are pruned, since their own marginal is expected to be close
+to the product of smaller ones. The non-zero cells of each marginal are held as integer codes, rather than as a long-format table
+repeating the field names and values as strings on every row; `MarginalTables.to_long` converts any subset of the sets of fields
+into the long format (`column_name1, ..., column_name{k}, val1, ..., val{k}, counts_*`) for use with `compute_stats.compute_z_test`.
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from compute_stats import pop_sizes
+from contingency import _sorted_labels
+from local_counts import count_combinations
+from materialize import population_query
+from params import categorical_cols
+from queries import make_totals_query
+from write_results import stream_query
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+class MarginalTables(object):
+    r"""Stores the counts of value tuples for sets of fields (k-way marginals) as sparse arrays over shared per-field labels.
+
+    Parameters
+    ----------
+    labels : dictionary
+        Maps each field name to a numpy array of its distinct values (labels), shared by every set of fields involving the field
+    cells : dictionary
+        Maps each set of fields (a tuple) to a pair `(codes, counts)`, where `codes` is a 2D integer array with one column per field
+        giving positions in the labels of that field, and `counts` is a 2D array with one column per entry of `count_cols`
+    count_cols : list of str
+        The names of the counts columns, e.g. `['counts_sim2', 'counts_av2017']`
+    """
+    def __init__(self, labels, cells, count_cols):
+        self.labels = labels
+        self.cells = cells
+        self.count_cols = list(count_cols)
+
+    @classmethod
+    def from_population(cls, population, field_sets, suffix=''):
+        r"""Counts the value tuples over each set of fields in an encoded population (see `local_counts.encode_population`)."""
+        cells = dict()
+        for field_set in field_sets:
+            codes, counts = count_combinations(population, field_set)
+            cells[tuple(field_set)] = (codes, counts.astype(np.uint32)[:, np.newaxis])
+        labels = {col_name: population[col_name][1] for field_set in cells for col_name in field_set}
+        return cls(labels, cells, ['counts_'+suffix])
+
+    @classmethod
+    def from_long(cls, frame, count_cols=None):
+        r"""Builds the marginal tables from a table of counts in long format, with columns `column_name1, ..., column_name{k}, val1, ..., val{k}`.
+
+        `count_cols` defaults to every column whose name begins with 'counts_'.
+        """
+        if count_cols is None:
+            count_cols = [col_label for col_label in frame.columns if col_label.startswith('counts_')]
+        num_variates = sum(col_label.startswith('column_name') for col_label in frame.columns)
+        names = [np.asarray(frame['column_name{}'.format(i+1)], dtype=object).astype(str) for i in range(num_variates)]
+        vals = [np.asarray(frame['val{}'.format(i+1)], dtype=object) for i in range(num_variates)]
+
+        # Build the shared dictionary of labels for each field, and encode the values of every row
+        positions = [pd.Series(np.arange(len(frame))).groupby(names[i]).indices for i in range(num_variates)]
+        labels, codes = dict(), np.zeros((len(frame), num_variates), dtype=np.int32)
+        for field in set().union(*positions):
+            index = [positions[i].get(field, np.array([], dtype=np.int64)) for i in range(num_variates)]
+            labels[field] = _sorted_labels(np.concatenate([vals[i][index[i]] for i in range(num_variates)]))
+            lookup = pd.Index(labels[field])
+            for i in range(num_variates):
+                codes[index[i], i] = lookup.get_indexer(vals[i][index[i]])
+
+        # Group the rows by set of fields
+        set_codes, field_sets = pd.factorize(pd.MultiIndex.from_arrays(names))
+        order = np.argsort(set_codes, kind='stable')
+        boundaries = np.searchsorted(set_codes[order], np.arange(len(field_sets) + 1))
+        counts = np.column_stack([frame[col_label].values for col_label in count_cols])[order]
+        cells = {tuple(field_set): (codes[order[start:stop]], counts[start:stop])
+                 for field_set, start, stop in zip(field_sets, boundaries[:-1], boundaries[1:])}
+        return cls(labels, cells, count_cols)
+
+    @classmethod
+    def combine(cls, tables_list):
+        r"""Joins the marginal tables of several populations on set of fields and value tuple, filling in zero counts.
+
+        The sets of fields present in any of the tables are kept, and the labels of each field are merged.
+        The counts columns of the result are the concatenation of the counts columns of the tables, in order.
+        """
+        labels = dict()
+        for col_name in set().union(*[tables.labels for tables in tables_list]):
+            labels[col_name] = _sorted_labels(np.concatenate([tables.labels[col_name] for tables in tables_list if col_name in tables.labels]))
+        relabel = [{col_name: pd.Index(labels[col_name]).get_indexer(field_labels) for col_name, field_labels in tables.labels.items()}
+                   for tables in tables_list]
+        widths = [len(tables.count_cols) for tables in tables_list]
+        offsets = np.cumsum([0] + widths)
+        cells = dict()
+        for field_set in dict.fromkeys(field_set for tables in tables_list for field_set in tables.cells):
+            codes_list, counts_list = list(), list()
+            for position, tables in enumerate(tables_list):
+                if field_set not in tables.cells:
+                    continue
+                codes, counts = tables.cells[field_set]
+                codes_list.append(np.column_stack([relabel[position][col_name][codes[:, i]] for i, col_name in enumerate(field_set)]))
+                padded = np.zeros((len(counts), offsets[-1]), dtype=counts.dtype)
+                padded[:, offsets[position]:offsets[position + 1]] = counts
+                counts_list.append(padded)
+            codes, inverse = np.unique(np.concatenate(codes_list), axis=0, return_inverse=True)
+            counts = np.zeros((len(codes), offsets[-1]), dtype=np.uint32)
+            np.add.at(counts, inverse.ravel(), np.concatenate(counts_list))
+            cells[field_set] = (codes.astype(np.int32), counts)
+        return cls(labels, cells, [col_label for tables in tables_list for col_label in tables.count_cols])
+
+    def to_long(self, field_sets=None):
+        r"""Converts the marginal tables for the given sets of fields (by default all of them) to a table of counts in long format.
+
+        The sets of fields should have the same number of fields. The result has the layout of a comparison table
+        (see `analysis.combine_counts`), so it may be passed to e.g. `compute_stats.compute_z_test`.
+        """
+        frames = list()
+        for field_set in (field_sets if field_sets is not None else self.field_sets):
+            codes, counts = self.cells[tuple(field_set)]
+            frame = pd.DataFrame({'column_name{}'.format(i+1): col_name for i, col_name in enumerate(field_set)}, index=pd.RangeIndex(len(codes)))
+            for i, col_name in enumerate(field_set):
+                frame['val{}'.format(i+1)] = self.labels[col_name][codes[:, i]]
+            for position, col_label in enumerate(self.count_cols):
+                frame[col_label] = counts[:, position]
+            frames.append(frame)
+        frame = pd.concat(frames, ignore_index=True)
+        name_cols = [col_label for col_label in frame.columns if col_label.startswith('column_name')]
+        frame[name_cols] = frame[name_cols].astype('category')
+        return frame
+
+    @property
+    def field_sets(self):
+        r"""The list of sets of fields for which counts are stored."""
+        return list(self.cells.keys())
+
+    def margin(self, field_set, fields, count_col=None):
+        r"""Returns the marginal of a set of fields over a subset of its fields as `(codes, counts)`, summing out the other fields."""
+        codes, counts = self.cells[tuple(field_set)]
+        counts = counts[:, 0 if count_col is None else self.count_cols.index(count_col)]
+        columns = [list(field_set).index(col_name) for col_name in fields]
+        codes, inverse = np.unique(codes[:, columns], axis=0, return_inverse=True)
+        return codes, np.bincount(inverse.ravel(), weights=counts, minlength=len(codes)).astype(np.int64)
+
+    def nbytes(self):
+        r"""Returns the number of bytes used by the arrays of codes and counts."""
+        return sum(codes.nbytes + counts.nbytes for codes, counts in self.cells.values())
+
+
+def dependence_scores(tables):
+    r"""Measures how far the fields in each stored set are from independence, using a generalized Cramér's V.
+
+    For each set of fields and each counts column, Pearson's chi-squared statistic is computed for the marginal against the
+    product of its one-way margins. Since the expected counts over all cells sum to the population size n, the statistic is
+    `n * (sum(p^2 / q) - 1)` summed over the non-zero cells only, where p is the observed proportion and q the product of
+    the one-way proportions. The statistic is scaled to `sqrt(chi2 / (n * (m - 1)))`, where m is the smallest number of
+    observed values of a field in the set, which for pairs of fields is Cramér's V.
+
+    Returns
+    -------
+    pandas DataFrame
+        Indexed by set of fields, with one column of scores per counts column
+    """
+    scores = dict()
+    for field_set, (codes, counts) in tables.cells.items():
+        row = list()
+        for position in range(counts.shape[1]):
+            observed = counts[:, position].astype(np.float64)
+            num_rows = observed.sum()
+            if num_rows == 0:
+                row.append(np.nan)
+                continue
+            proportions = observed / num_rows
+            independent = np.ones(len(observed))
+            num_values = list()
+            for i in range(codes.shape[1]):
+                one_way = np.bincount(codes[:, i], weights=proportions)
+                independent *= one_way[codes[:, i]]
+                num_values.append(np.count_nonzero(one_way))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chi2 = num_rows * (np.sum(np.square(proportions)[observed > 0] / independent[observed > 0]) - 1)
+                row.append(np.sqrt(max(chi2, 0) / (num_rows * (min(num_values) - 1))) if min(num_values) > 1 else 0.0)
+        scores[field_set] = row
+    return pd.DataFrame.from_dict(scores, orient='index', columns=tables.count_cols)
+
+
+def candidate_field_sets(scores, threshold=0.1):
+    r"""Selects the sets of k+1 fields all of whose k-field subsets show dependence, as measured by `dependence_scores`.
+
+    A set of k fields shows dependence if its score is at least `threshold` in at least one counts column.
+    Candidates are formed by extending each dependent set with a field which comes later in `params.categorical_cols`
+    (or in alphabetical order for other fields), and kept only if each of their k-field subsets is dependent.
+    """
+    dependent = {frozenset(field_set) for field_set, row in scores.iterrows() if (row >= threshold).any()}
+    field_order = {col_name: position for position, col_name in enumerate(categorical_cols)}
+
+    def sort_key(col_name):
+        return (field_order.get(col_name, len(field_order)), col_name)
+
+    fields = sorted(set().union(*dependent), key=sort_key) if dependent else []
+    candidates = dict()
+    for field_set in dependent:
+        last = max(field_set, key=sort_key)
+        for col_name in fields:
+            if sort_key(col_name) <= sort_key(last):
+                continue
+            candidate = field_set | {col_name}
+            if all(candidate - {subset_field} in dependent for subset_field in candidate):
+                candidates[candidate] = tuple(sorted(candidate, key=sort_key))
+    return sorted(candidates.values(), key=lambda field_set: [sort_key(col_name) for col_name in field_set])
+
+
+def compute_marginals(populations, field_list=None, max_variates=3, threshold=0.1):
+    r"""Computes pruned k-way marginals for one or more encoded populations, level by level.
+
+    All pairs of fields in `field_list` are counted first. At each subsequent level, the candidate sets of fields are those
+    selected by `candidate_field_sets` from the dependence scores of the previous level, across all of the populations,
+    so that every population is counted over the same sets of fields.
+
+    Parameters
+    ----------
+    populations : dictionary
+        Maps table aliases (e.g. 'sim2', 'av2017') to encoded populations, as returned by `local_counts.load_population`
+    field_list : list of str, optional
+        The fields to consider. Defaults to `params.categorical_cols`.
+    max_variates : int, defaults to 3
+        The largest number of fields in a set
+    threshold : float, defaults to 0.1
+        The smallest generalized Cramér's V for which a set of fields is regarded as dependent and extended
+
+    Returns
+    -------
+    dictionary
+        Maps each number of fields k (from 2 to `max_variates`) to a `MarginalTables` object with one counts column per population
+    """
+    fields = list(field_list if field_list is not None else categorical_cols)
+    field_sets = [(fields[i], fields[j]) for i in range(len(fields)) for j in range(i+1, len(fields))]
+    marginals = dict()
+    for num_variates in range(2, max_variates + 1):
+        if not field_sets:
+            break
+        marginals[num_variates] = MarginalTables.combine([MarginalTables.from_population(population, field_sets, key)
+                                                          for key, population in populations.items()])
+        print('Counted {} sets of {} fields ({:.1f} MB)'.format(len(field_sets), num_variates, marginals[num_variates].nbytes() / 2**20))
+        field_sets = candidate_field_sets(dependence_scores(marginals[num_variates]), threshold)
+    return marginals
+
+
+def get_marginals_from_db(key, db, field_sets, method='grouping_sets', arraysize=100000):
+    r"""Extracts k-way marginals for a cohort from the SQL database, as a `MarginalTables` object.
+
+    The sets of fields should have the same number of fields, e.g. as selected by `candidate_field_sets`.
+    The counts are obtained with `queries.make_totals_query`, from the cohort's materialized table if there is one.
+    """
+    sql = make_totals_query(population_query(key), key, field_sets, len(field_sets[0]), method=method)
+    return MarginalTables.from_long(stream_query(sql, db, arraysize))
+
+
+def compute_chi2_test(pair, tables):
+    r"""Compute Pearson's chi-squared test statistics for every set of fields, from the sparse marginals of two populations.
+
+    This is the equivalent of `compute_stats.compute_chi2_test` for k-way marginals, computed directly from the sparse cells
+    of a `MarginalTables` object with the counts columns of both populations (see `MarginalTables.combine`).
+    Returns a pandas DataFrame indexed by set of fields, with the same columns as `compute_stats.compute_chi2_test`.
+    """
+    position0, position1 = tables.count_cols.index('counts_'+pair[0]), tables.count_cols.index('counts_'+pair[1])
+    results = dict()
+    for field_set, (codes, counts) in tables.cells.items():
+        counts0, counts1 = counts[:, position0].astype(np.float64), counts[:, position1].astype(np.float64)
+        # Only the cells observed in either population are included, as in a comparison table from `analysis.combine_counts`
+        observed = (counts0 > 0) | (counts1 > 0)
+        expected = pop_sizes[pair[0]] * counts1[observed] / pop_sizes[pair[1]]
+        results[field_set] = [observed.sum(), np.sum(np.square(counts0[observed] - expected) / np.where(expected != 0, expected, 0.5))]
+    results = pd.DataFrame.from_dict(results, orient='index', columns=['category_size', 'pearson_chi2_test'])
+    num_variates = max((len(field_set) for field_set in tables.cells), default=0)
+    results.index = pd.MultiIndex.from_tuples(results.index, names=['column_name{}'.format(i+1) for i in range(num_variates)])
+    results['degrees_of_freedom'] = results['category_size'] - 1
+    results['normalized_score'] = (results['pearson_chi2_test'] - results['degrees_of_freedom']) / np.sqrt(2 * results['degrees_of_freedom'])
+    results['Wilson–Hilferty_score'] = (np.cbrt(results['pearson_chi2_test']/results['degrees_of_freedom'])
+                                        - (1 - 2/(9 * results['degrees_of_freedom']))) / (2/(9 * results['degrees_of_freedom']))
+    return results
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * materialize_population - Runs the population query for a cohort once, storing the result in a table in the SQL database
+    * population_query - Returns the SQL query to use for a cohort, reading from its materialized table where there is one
+    * drop_population - Drops the materialized table for a cohort
+    * export_population - Writes the materialized table for a cohort to a local .csv file, for use with `local_counts` or `streaming`
+This module also contains the dictionary `materialized_tables`, which records the table name and number of rows for each materialized cohort.
+
+The population queries in `populations.pop_queries` filter, join and format the source tables, which is the most expensive
+part of every extraction. Materializing a cohort runs its population query once, so that all of the count queries for that
+cohort (e.g. via `write_results.get_totals_from_db`) read from the stored result instead of repeating the joins.
+The table is a regular table rather than a session temporary table, so it can be shared by the pooled connections used in `scheduler`.
+"""
+
+# Third-party imports
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import DatabaseError
+
+# Local packages
+from populations import pop_queries
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# Records the table name and number of rows for each materialized cohort, keyed by table alias
+materialized_tables = dict()
+
+# The template for the name of the table holding a materialized cohort
+table_name_template = 'SIMTEST_POP_{}'
+
+
+def materialize_population(key, db, table_name=None):
+    r"""Runs the population query for a cohort once, storing the result in a table in the SQL database.
+
+    Any existing table of the same name is replaced. The number of rows in the table is recorded in `materialized_tables`,
+    and subsequent calls to `population_query(key)` read from the table.
+
+    Parameters
+    ----------
+    key : str
+        The alias of the cohort, a key of `populations.pop_queries`
+    db : An instance of an `sqlalchemy.engine`
+        This is the connection to your database management system.
+    table_name : str, optional
+        The name of the table to create. Defaults to `table_name_template` filled in with the upper case alias.
+
+    Returns
+    -------
+    int
+        The number of rows in the materialized table
+    """
+    table_name = table_name if table_name is not None else table_name_template.format(key.upper())
+    print('Materializing the {} population into the table {}...'.format(key, table_name))
+    with db.begin() as connection:
+        try:
+            connection.execute(text('DROP TABLE {} PURGE'.format(table_name)))
+        except DatabaseError:
+            # The table does not exist yet
+            pass
+    with db.begin() as connection:
+        connection.execute(text('CREATE TABLE {} NOLOGGING AS {}'.format(table_name, pop_queries[key])))
+        num_rows = connection.execute(text('SELECT COUNT(*) FROM {}'.format(table_name))).scalar()
+    materialized_tables[key] = {'table_name': table_name, 'num_rows': int(num_rows)}
+    print('Materialized {} rows!'.format(num_rows))
+    return int(num_rows)
+
+
+def population_query(key):
+    r"""Returns the SQL query to use for a cohort, reading from its materialized table if there is one, and otherwise the full population query."""
+    if key in materialized_tables:
+        return 'SELECT * FROM {}'.format(materialized_tables[key]['table_name'])
+    return pop_queries[key]
+
+
+def drop_population(key, db):
+    r"""Drops the materialized table for a cohort, so that subsequent queries use the full population query again."""
+    table = materialized_tables.pop(key)
+    with db.begin() as connection:
+        connection.execute(text('DROP TABLE {} PURGE'.format(table['table_name'])))
+
+
+def export_population(key, db, filepath, chunksize=500000):
+    r"""Writes the materialized table for a cohort to a local .csv file, one chunk of rows at a time.
+
+    The file contains the derived fields of the population query, so it should be read with `raw=False`,
+    e.g. `local_counts.load_population(filepath, raw=False)` or `streaming.accumulate_counts(filepath, raw=False)`.
+
+    Returns
+    -------
+    int
+        The number of rows written
+    """
+    num_rows = 0
+    for chunk in pd.read_sql_query(population_query(key), db, chunksize=chunksize):
+        # Oracle reports column names in upper case, which SQLAlchemy returns in lower case
+        chunk.columns = [col_label.upper() for col_label in chunk.columns]
+        # Integer columns containing nulls are read as floats, which we convert back so that e.g. AGE is written as '65' rather than '65.0'
+        for col_label in chunk.columns[chunk.dtypes == float]:
+            if (chunk[col_label].dropna() % 1 == 0).all():
+                chunk[col_label] = chunk[col_label].astype('Int64')
+        chunk.to_csv(filepath, mode='a' if num_rows else 'w', header=not num_rows, index=False)
+        num_rows += chunk.shape[0]
+    return num_rows
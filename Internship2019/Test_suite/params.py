@@ -7,6 +7,12 @@ This file contains the following module parameters:
     * key_list - Aliases for tables of CAS/Simulacrum data. Frequently used as keys in dictionary data structures throughout
     * comparison_pairs - Pairs of keys from key_list representing pairs of tables which will be compared. Used as keys for comparison tables and plots
     * filepath_dictionary - Contains names of filepaths where local copies of group counts data can be stored
+    * columnar_filepath_dictionary - Contains names of directories where local copies of group counts data can be stored in columnar format
+    * cache_directory - The directory where the content-addressed cache of group counts data is stored (see the `cache` module)
+    * db_snapshots - Optional labels for the database snapshot behind each table alias, included in cache keys
+    * registry_filepath - The file where the cohort registry is stored (see the `registry` module)
+    * benchmark_filepath - The file where the baseline results of the synthetic benchmark are stored (see the `benchmark` module)
+    * report_filepath - The file where the HTML report of a comparison run is written (see the `report` module)
     
 Column name related parameters, mostly encapsulated in the variable `field_list_dict` which stores various lists of column names and pairs of column names:
     * categorical_cols - A list of non-index column names for categorical/discrete value fields in SIM_AV_TUMOUR, plus two derived categorical fields.
@@ -14,6 +20,7 @@ Column name related parameters, mostly encapsulated in the variable `field_list_
     * date_cols - A list of column names for date value fields in SIM_AV_TUMOUR.
 Other parameters:
     * col_names - The concatenation of the two lists `categorical_cols` and `date_cols`.
+    * column_schema - The type of the values in each column ('str', 'int' or 'date'), used to cast and sort values.
     * col_name_pairs - List of pairs of non-index columns present in SIM_AV_TUMOUR in the Simulacrum.
 """
 
@@ -51,6 +58,11 @@ field_list_dict = {'univariate_categorical': categorical_cols,
 # List of non-index columns present in SIM_AV_TUMOUR in the Simulacrum.
 col_names = categorical_cols + date_cols
 
+# The type of the values in each column, which determines how values are cast and sorted when cleaning tables of group counts.
+# 'str' values are sorted alphabetically, 'int' values numerically and 'date' values (in YYYY-MM-DD format) chronologically.
+column_schema = dict([(col_name, 'str') for col_name in categorical_cols] + [(col_name, 'date') for col_name in date_cols])
+column_schema['AGE'] = 'int'
+
 # List of pairs of non-index columns present in SIM_AV_TUMOUR in the Simulacrum.
 col_name_pairs = [(col_names[i], col_names[j]) for i in range(len(col_names)) for j in range(i+1, len(col_names))]
 
@@ -64,5 +76,17 @@ filepath_templates = {'univariate_categorical': r"results\{}_univariate_categori
                       'surgery_date_cross_diagnosis_date': r"results\{}_bivariate_counts_double_dates.csv"
                       }
 
-filepath_dictionary = {count_type: {key: template.format(key.upper()) for key in ['sim1', 'sim2', 'av2015', 'av2017']} for count_type, template in filepath_templates.items()}
+filepath_dictionary = {count_type: {key: template.format(key.upper()) for key in key_list} for count_type, template in filepath_templates.items()}
+# Directory names used for storing local copies of grouped counts data in the columnar format of the `storage` module
+columnar_filepath_dictionary = {count_type: {key: filepath[:-len('.csv')] for key, filepath in filepaths.items()} for count_type, filepaths in filepath_dictionary.items()}
 
+# Directory for the content-addressed cache of group counts data, keyed by population query, field list and count type
+cache_directory = 'results/cache'
+# Labels for the database snapshot behind each table alias. Change a label to invalidate the cached counts for that table
+db_snapshots = {'sim1': '', 'sim2': '', 'av2015': '', 'av2017': ''}
+# File where the cohort registry is stored. Cohorts added with `registry.register_cohort` extend `key_list` and the dictionaries above
+registry_filepath = 'results/registry.json'
+# File where the baseline timings and memory usage of the synthetic benchmark are stored (see the `benchmark` module)
+benchmark_filepath = 'results/benchmark_baseline.json'
+# File where the HTML report of a comparison run is written (see the `report` module)
+report_filepath = 'results/report.html'
@@ -4,18 +4,31 @@
 """
 This file can be imported as a module and contains the following functions:
     * plot_univariate_categorical_results - Plot grouped bar charts of z-test statistics by field values
+    * make_heatmap_grid - Arrange the z-test statistics of a pair of fields into a grid of values, with a single vectorized pivot
     * plot_bivariate_categorical_results - Plot heatmaps of z-test statistics by field value pairs
+    * write_bivariate_heatmaps - Build heatmaps of z-test statistics for many pairs of fields across worker processes, and write them to disk
+    * plot_categorical_date_results - Plot heatmaps of z-test statistics by field value and date, at a resolution chosen for the dates on view
+    * plot_date_date_results - Plot heatmaps of z-test statistics by date of first surgery and date of diagnosis, at a resolution chosen for the dates on view
     * make_hovertext - Create a Series of hovertext strings for a list of columns in a DataFrame for use in Plotly
     * plot_univariate_chi2_test_results - Plot grouped bar charts of chi-squared test statistics by field
 This module also contains the parameter `marker_colour` which is a dictionary defining how bar charts are coloured based on the pair of source cohort tables being compared.
+Pairs not in `marker_colour` (e.g. those set with `registry.set_comparisons`) are coloured by their position in the plot, from the default plotly palette.
 """
 
+# Standard library imports
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 # Third-party imports
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+from plotly.colors import qualitative
 
 # Local packages
+import instrument
+from compute_stats import compute_chi2_matrices
+from tiles import choose_resolution, tile_date_cols
 from params import field_list_dict
 
 
@@ -33,6 +46,12 @@ __status__ = 'Development'
 marker_colour = {('sim1', 'av2015'): 'blue', ('sim2', 'av2017'): 'lightskyblue'}
 
 
+def _colour_of(pair, position):
+    # The colour of the bars of a pair, falling back on the default plotly palette for pairs not in `marker_colour`
+    return marker_colour.get(pair, qualitative.Plotly[position % len(qualitative.Plotly)])
+
+
+@instrument.instrumented()
 def plot_univariate_categorical_results(results_dict, col_name):
     r"""Produces grouped bar charts of z-test statistics by field values.
 
@@ -54,13 +73,14 @@ def plot_univariate_categorical_results(results_dict, col_name):
     """
     fig = go.Figure()
     # For each pair of source tables to compare, plot the z-test statistics by value in a given field, highlighting high absolute values
-    for pair, comparison_table in results_dict.items():
+    for position, (pair, comparison_table) in enumerate(results_dict.items()):
+        colour = _colour_of(pair, position)
         frame = comparison_table.query("column_name == '{}'".format(col_name))
         m = frame.z_test.abs() < 2
         fig.add_trace(go.Bar(name=pair[0]+' vs. '+pair[1], x=frame.val, y=frame.z_test,
-                             marker_color=marker_colour[pair],
+                             marker_color=colour,
                              marker_line_width=frame.z_test.mask(m, 0).mask(~m, 1),
-                             marker_line_color=frame.z_test.mask(m, marker_colour[pair]).mask(~m, 'red')))
+                             marker_line_color=frame.z_test.mask(m, colour).mask(~m, 'red')))
     # Change the bar mode, set axis titles
     fig.update_layout(barmode='group', xaxis_title=col_name, yaxis_title='z-test statistic', title='Univariate z-test results')
     # Plot columns which are not 'AGE' as categories to avoid automatically being cast as numerical values
@@ -69,6 +89,50 @@ def plot_univariate_categorical_results(results_dict, col_name):
     return fig
 
 
+def make_heatmap_grid(comparison_table, col_name1, col_name2, value_col='z_test'):
+    r"""Arrange the z-test statistics of a pair of fields into a grid of values, with a single vectorized pivot.
+
+    The rows of the pair of fields are selected with one mask, and their x- and y-values are factorized into sorted integer codes,
+    which index the cells of the grid directly. Cells with no row (structural zeros in both source datasets) are left as NaN.
+    Null values are kept as the last row or column of the grid, as in the sorted values of the original nested loop.
+
+    Parameters
+    ----------
+    comparison_table : pandas DataFrame
+        A table of z-test results for the bivariate categorical counts of a pair of source tables
+    col_name1 : str
+        The field whose values are on the x-axis (the columns of the grid)
+    col_name2 : str
+        The field whose values are on the y-axis (the rows of the grid)
+    value_col : str, defaults to 'z_test'
+        The column of values in the grid
+
+    Returns
+    -------
+    tuple
+        The sorted x-values, the sorted y-values, and a 2D numpy array of values with one row per y-value and one column per x-value
+    """
+    if (col_name1, col_name2) in field_list_dict['bivariate_categorical']:
+        x_val_col, y_val_col = 'val1', 'val2'
+        row_mask = (comparison_table['column_name1'] == col_name1) & (comparison_table['column_name2'] == col_name2)
+    else:
+        x_val_col, y_val_col = 'val2', 'val1'
+        row_mask = (comparison_table['column_name1'] == col_name2) & (comparison_table['column_name2'] == col_name1)
+    return _pivot(comparison_table.loc[row_mask.values], x_val_col, y_val_col, value_col, keep_nulls=True)
+
+
+def _pivot(frame, x_col, y_col, value_col, keep_nulls=False):
+    # Factorizes the x- and y-values into sorted codes, which index the cells of a grid of values directly.
+    # Null values are dropped, unless `keep_nulls`, in which case they are coded after the other values
+    x_codes, x_vals = pd.factorize(frame[x_col], sort=True, use_na_sentinel=not keep_nulls)
+    y_codes, y_vals = pd.factorize(frame[y_col], sort=True, use_na_sentinel=not keep_nulls)
+    z_vals = np.full((len(y_vals), len(x_vals)), np.nan)
+    valid = (x_codes >= 0) & (y_codes >= 0)
+    z_vals[y_codes[valid], x_codes[valid]] = frame[value_col].values[valid]
+    return pd.Series(x_vals), pd.Series(y_vals), z_vals
+
+
+@instrument.instrumented()
 def plot_bivariate_categorical_results(results_dict, col_name1, col_name2, display=True):
     r"""Produces heatmaps of z-test statistics by field value pairs.
 
@@ -92,39 +156,14 @@ def plot_bivariate_categorical_results(results_dict, col_name1, col_name2, displ
         The Figure objects containing our plots, one per table of z-test results
 
     """
+    # These conditional statements ensure that `col_name1` is plotted on the x-axis, and `col_name2` on the y-axis
+    if (col_name1, col_name2) not in field_list_dict['bivariate_categorical'] and (col_name2, col_name1) not in field_list_dict['bivariate_categorical']:
+        print('This column name pair cannot be found')
+        return
     # Create a plot for each table of z-test statistics comparing two source tables
     fig = {pair: go.Figure() for pair in results_dict.keys()}
     for pair, comparison_table in results_dict.items():
-        # Locate the rows of the comparison table where the column names match our inputs
-        row_mask = comparison_table[['column_name1', 'column_name2']].isin([col_name1, col_name2]).all(axis=1)
-        frame = comparison_table.loc[row_mask, ['val1', 'val2', 'z_test']]
-        # These conditional statements ensure that `col_name1` is plotted on the x-axis, and `col_name2` on the y-axis
-        if (col_name1, col_name2) in field_list_dict['bivariate_categorical']:
-            x_val_col, y_val_col = 'val1', 'val2'
-        elif (col_name2, col_name1) in field_list_dict['bivariate_categorical']:
-            x_val_col, y_val_col = 'val2', 'val1'
-        else:
-            print('This column name pair cannot be found')    
-            return
-        # Obtain the lists of unique x-values and y-values
-        frame = frame.sort_values(by=[x_val_col, y_val_col])
-        x_vals = frame[x_val_col].drop_duplicates()
-        y_vals = frame[y_val_col].drop_duplicates()
-        # The z-values are used to colour the heatmap and are stored in a 2D-array. Rows for y-values, columns for x-values.
-        z_vals = list()        
-        for y_val in y_vals:
-            z_row = list()
-            y_subframe = frame.loc[frame[y_val_col] == y_val, [x_val_col, 'z_test']]
-            for x_val in x_vals:
-                x_y_subframe = y_subframe.loc[y_subframe[x_val_col] == x_val, 'z_test']
-                # Check that there is any data (a z-test statistic) for the given x,y-pair
-                if x_y_subframe.shape[0] == 1:
-                    # If there is, then add it to our array
-                    z_row.append(x_y_subframe.iloc[0])
-                else:
-                    # Otherwise add a null value which represents a structural zero present in both source datasets
-                    z_row.append(np.nan)
-            z_vals.append(z_row) 
+        x_vals, y_vals, z_vals = make_heatmap_grid(comparison_table, col_name1, col_name2)
         # Plot the heatmap based on the x,y,z-values we extracted from the results table
         fig[pair].add_trace(go.Heatmap(name=pair[0]+' vs. '+pair[1], z=z_vals, x=x_vals, y=y_vals, 
                                        colorscale='Picnic', zmin=-7, zmax=7, colorbar={"title": "z-test statistic"}))
@@ -135,10 +174,10 @@ def plot_bivariate_categorical_results(results_dict, col_name1, col_name2, displ
         # Special axis settings to order ages numerically rather than alphanumerically as strings
         if col_name1 == 'AGE':
             fig[pair].update_xaxes({'categoryorder': 'array', 
-                                    'categoryarray': [str(number) for number in sorted(x_vals.astype('uint8'))]})
+                                    'categoryarray': [str(number) for number in sorted(x_vals.dropna().astype('uint8'))]})
         elif col_name2 == 'AGE':
             fig[pair].update_yaxes({'categoryorder': 'array', 
-                                    'categoryarray': [str(number) for number in sorted(y_vals.astype('uint8'))]})
+                                    'categoryarray': [str(number) for number in sorted(y_vals.dropna().astype('uint8'))]})
     if display == True:
     # Display the plots!
         for key, plot in fig.items():
@@ -148,6 +187,64 @@ def plot_bivariate_categorical_results(results_dict, col_name1, col_name2, displ
         return fig
 
 
+def _write_heatmaps(arguments):
+    # Builds the heatmaps of one pair of fields and writes them to disk, for use with `ProcessPoolExecutor.map`
+    col_name1, col_name2, results_dict, directory, file_format = arguments
+    fig = plot_bivariate_categorical_results(results_dict, col_name1, col_name2, display=False)
+    filepaths = list()
+    for pair, figure in (fig or dict()).items():
+        filepath = os.path.join(directory, 'z_test_heatmap_{}_vs_{}_{}_vs_{}.{}'.format(col_name1, col_name2, pair[0], pair[1], file_format))
+        if file_format == 'html':
+            # The plotly.js library is written once to the directory and shared by every heatmap
+            figure.write_html(filepath, include_plotlyjs='directory')
+        else:
+            figure.write_image(filepath)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def write_bivariate_heatmaps(results_dict, field_pairs=None, directory='images/heatmaps', file_format='html', max_workers=None):
+    r"""Builds heatmaps of z-test statistics for many pairs of fields across worker processes, and writes them to disk.
+
+    Each table of z-test results is split by pair of fields once, and each worker process is sent only the rows of the pairs
+    of fields it plots, for which it builds the heatmaps with `plot_bivariate_categorical_results`.
+
+    Parameters
+    ----------
+    results_dict : dictionary of pandas DataFrame objects
+        The dataframes of z-test results from which we draw the data to plot
+    field_pairs : list of tuples, optional
+        The pairs of fields to plot. Defaults to every pair in `field_list_dict['bivariate_categorical']`.
+    directory : str, defaults to 'images/heatmaps'
+        The directory in which the heatmaps are written, one file per pair of fields and table of z-test results
+    file_format : str, defaults to 'html'
+        Either 'html', or a static image format such as 'png' (which requires the `kaleido` package)
+    max_workers : int, optional
+        The number of worker processes. Defaults to the number of processors on the machine.
+
+    Returns
+    -------
+    list of str
+        The filepaths of the heatmaps written
+    """
+    field_pairs = field_pairs if field_pairs is not None else field_list_dict['bivariate_categorical']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # The positions of the rows of each pair of fields in each table of z-test results
+    indices = {pair: comparison_table.groupby(['column_name1', 'column_name2'], observed=True, sort=False).indices
+               for pair, comparison_table in results_dict.items()}
+    empty = np.array([], dtype=np.int64)
+    tasks = list()
+    for col_name1, col_name2 in field_pairs:
+        sub_tables = {pair: comparison_table[['column_name1', 'column_name2', 'val1', 'val2', 'z_test']].iloc[
+                          np.concatenate([indices[pair].get((col_name1, col_name2), empty), indices[pair].get((col_name2, col_name1), empty)])]
+                      for pair, comparison_table in results_dict.items()}
+        tasks.append((col_name1, col_name2, sub_tables, directory, file_format))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        filepaths = list(executor.map(_write_heatmaps, tasks))
+    return [filepath for pair_filepaths in filepaths for filepath in pair_filepaths]
+
+
 def make_hovertext(table, column_labels):
     r"""Create a Series of hovertext strings for a list of columns in a DataFrame for use in Plotly.
     
@@ -157,6 +254,7 @@ def make_hovertext(table, column_labels):
     return string_series
 
 
+@instrument.instrumented()
 def plot_univariate_chi2_test_results(results_dict, by='Wilson–Hilferty_score'):
     r"""Produces grouped bar charts of chi-squared test statistics by field.
 
@@ -177,12 +275,12 @@ def plot_univariate_chi2_test_results(results_dict, by='Wilson–Hilferty_score'
     fig = go.Figure()
     # For each pair of source tables to compare, plot a horizontal bar chart of the chi-squared test statistics
     # 
-    for pair, results_table in results_dict.items():
+    for position, (pair, results_table) in enumerate(results_dict.items()):
         fig.add_trace(go.Bar(name=pair[0]+' vs. '+pair[1],
                              orientation='h',
                              x=results_table[by],
                              y=results_table.index, 
-                             marker_color=marker_colour[pair],
+                             marker_color=_colour_of(pair, position),
                              hoverinfo="name+y+text",
                              hovertext=make_hovertext(results_table, ['pearson_chi2_test', 'degrees_of_freedom', 'normalized_score', 'Wilson–Hilferty_score'])))
     # Change the bar mode, set axis titles, and sort the bar lengths
@@ -195,6 +293,7 @@ def plot_univariate_chi2_test_results(results_dict, by='Wilson–Hilferty_score'
     return fig
 
 
+@instrument.instrumented()
 def plot_bivariate_chi2_results(results_dict, by='Wilson–Hilferty_score', display=True):
     r"""Produces heatmaps of chi-squared test statistics by field value pairs.
 
@@ -204,7 +303,10 @@ def plot_bivariate_chi2_results(results_dict, by='Wilson–Hilferty_score', disp
     Parameters
     ----------
     results_dict : dictionary of pandas DataFrame objects
-        The dataframes of chi-squared test results from which we draw the data to plot
+        The dataframes of bivariate chi-squared test results from which we draw the data to plot, or the dictionaries
+        of field-by-field matrices computed from them by `compute_stats.compute_chi2_matrices`
+    by : str. Defaults to 'Wilson–Hilferty_score'
+        The column of chi-squared test results used to colour the heatmap
     display : Boolean. Defaults to True
         Set display to False to return the dictionary of heatmaps directly, otherwise running the function immediately displays the plots upon completion.
         
@@ -216,37 +318,13 @@ def plot_bivariate_chi2_results(results_dict, by='Wilson–Hilferty_score', disp
     """
     # Create a plot for each table of chi-squared test statistics comparing two source tables
     fig = {pair: go.Figure() for pair in results_dict.keys()}
-    for pair, results_table in results_dict.items():
-        # Create the hovertext strings for each pair of fields
-        hovertext_table = make_hovertext(results_table, ['pearson_chi2_test', 'degrees_of_freedom', 'normalized_score', 'Wilson–Hilferty_score'])
-        # Reset indices to make it easier to select the data
-        results_table = results_table.reset_index()
-        hovertext_table = hovertext_table.reset_index()
-        # Get the list of values for the x,y-axes
-        x_vals = y_vals = field_list_dict['univariate_categorical']
+    for pair, results in results_dict.items():
+        # The symmetric field-by-field matrices of statistics and hovertext, computed here unless they are passed in
+        matrices = results if isinstance(results, dict) else compute_chi2_matrices(results)
+        x_vals = y_vals = list(matrices[by].columns)
         # The z-values are used to colour the heatmap and are stored in a 2D-array. Rows for y-values, columns for x-values.
-        z_vals = list()
-        hovertext_array = list()
-        for y_val in y_vals:
-            z_row = list()
-            hovertext_row = list()
-            for x_val in x_vals:
-                string_query = "column_name1 in ['{0}', '{1}'] and column_name2 in ['{0}', '{1}']".format(x_val, y_val)
-                x_y_subframe = results_table.query(string_query)                
-                # Equivalently, ...                
-#                 row_mask = results_table[['column_name1', 'column_name2']].isin([x_val, y_val]).all(axis=1)
-#                 x_y_subframe = results_table.loc[row_mask]
-                # Check that there is any data for the given x,y-pair
-                if x_y_subframe.shape[0] == 1:
-                    # If there is, then add it to our array
-                    z_row.append(x_y_subframe[by].iloc[0])
-                    hovertext_row.append(hovertext_table.query(string_query)[0].iloc[0])
-                else:
-                    # Otherwise add a null value
-                    z_row.append(np.nan)
-                    hovertext_row.append("")
-            z_vals.append(z_row)
-            hovertext_array.append(hovertext_row)
+        z_vals = matrices[by].values
+        hovertext_array = matrices['hovertext'].values
         # Plot the heatmap based on the x,y,z-values we extracted from the results table
         fig[pair].add_trace(go.Heatmap(name=pair[0]+' vs. '+pair[1], z=z_vals, x=x_vals, y=y_vals, 
                                        hovertext=hovertext_array,                                       
@@ -277,3 +355,105 @@ def plot_bivariate_chi2_results(results_dict, by='Wilson–Hilferty_score', disp
         return
     else:
         return fig
+
+
+def _date_heatmap(pair, x_vals, y_vals, z_vals):
+    # A heatmap trace of z-test statistics. The size of the grid is bounded by the choice of resolution, so no WebGL trace is needed
+    return go.Heatmap(name=pair[0]+' vs. '+pair[1], z=z_vals, x=x_vals, y=y_vals,
+                   colorscale='Picnic', zmin=-7, zmax=7, colorbar={"title": "z-test statistic"})
+
+
+def _in_range(frame, col_label, date_range):
+    # The rows of a table whose dates in the given column are within a range of dates
+    if date_range is None:
+        return frame
+    dates = frame[col_label]
+    return frame.loc[((dates >= pd.Timestamp(date_range[0])) & (dates <= pd.Timestamp(date_range[1]))).values]
+
+
+@instrument.instrumented()
+def plot_categorical_date_results(tiles_dict, col_name, count_type='categorical_cross_diagnosis_date', date_range=None, max_columns=1000, display=True):
+    r"""Produces heatmaps of z-test statistics by field value and date, at a resolution chosen for the dates on view.
+
+    The resolution (day, week, month or quarter) is the finest whose heatmap has at most `max_columns` dates within `date_range`,
+    as chosen by `tiles.choose_resolution`. One heatmap is created for each pair of source tables in the input dictionary.
+
+    Parameters
+    ----------
+    tiles_dict : dictionary
+        The precomputed roll-ups of each comparison table, as returned by `tiles.compute_tiles`, keyed by pair of source tables
+    col_name : str
+        The field whose values are on the y-axis
+    count_type : str, defaults to 'categorical_cross_diagnosis_date'
+        Either 'categorical_cross_diagnosis_date' or 'categorical_cross_surgery_date'
+    date_range : tuple, optional
+        The first and last dates on view. Defaults to the whole range of dates.
+    max_columns : int, defaults to 1000
+        The largest number of dates (columns) in each heatmap
+    display : Boolean. Defaults to True
+        Set display to False to return the dictionary of heatmaps directly, otherwise running the function immediately displays the plots upon completion.
+
+    Returns
+    -------
+    A dictionary of plotly.graph_objects Figures
+        The Figure objects containing our plots, one per pair of source tables
+    """
+    date_col = tile_date_cols[count_type][0]
+    fig = dict()
+    for pair, tiles in tiles_dict.items():
+        level = choose_resolution(tiles, date_col, date_range, max_columns)
+        table = tiles[level]
+        frame = _in_range(table.loc[(table['column_name1'] == col_name).values], date_col, date_range)
+        x_vals, y_vals, z_vals = _pivot(frame, date_col, 'val1', 'z_test')
+        fig[pair] = go.Figure(_date_heatmap(pair, x_vals, y_vals.astype(str), z_vals))
+        fig[pair].update_layout(title='{} vs. {} ({} resolution)'.format(pair[0], pair[1], level),
+                                xaxis={'title': count_type.replace('categorical_cross_', '')},
+                                yaxis={'title': col_name, 'type': 'category', 'categoryorder': 'category descending'})
+    if display == True:
+    # Display the plots!
+        for key, plot in fig.items():
+            plot.show()
+        return
+    else:
+        return fig
+
+
+@instrument.instrumented()
+def plot_date_date_results(tiles_dict, date_range=None, max_columns=500, display=True):
+    r"""Produces heatmaps of z-test statistics by date of first surgery and date of diagnosis, at a resolution chosen for the dates on view.
+
+    The resolution (day, week, month or quarter) is the finest whose heatmap has at most `max_columns` dates of first surgery
+    within `date_range`, and at most `max_columns` dates of diagnosis, as chosen by `tiles.choose_resolution`.
+
+    Parameters
+    ----------
+    tiles_dict : dictionary
+        The precomputed roll-ups of each comparison table for the 'surgery_date_cross_diagnosis_date' count type,
+        as returned by `tiles.compute_tiles`, keyed by pair of source tables
+    date_range : tuple, optional
+        The first and last dates of first surgery on view. Defaults to the whole range of dates.
+    max_columns : int, defaults to 500
+        The largest number of dates along each axis of each heatmap
+    display : Boolean. Defaults to True
+        Set display to False to return the dictionary of heatmaps directly, otherwise running the function immediately displays the plots upon completion.
+
+    Returns
+    -------
+    A dictionary of plotly.graph_objects Figures
+        The Figure objects containing our plots, one per pair of source tables
+    """
+    x_col, y_col = tile_date_cols['surgery_date_cross_diagnosis_date']
+    fig = dict()
+    for pair, tiles in tiles_dict.items():
+        level = choose_resolution(tiles, x_col, date_range, max_columns, other_date_col=y_col)
+        x_vals, y_vals, z_vals = _pivot(_in_range(tiles[level], x_col, date_range), x_col, y_col, 'z_test')
+        fig[pair] = go.Figure(_date_heatmap(pair, x_vals, y_vals, z_vals))
+        fig[pair].update_layout(title='{} vs. {} ({} resolution)'.format(pair[0], pair[1], level),
+                                xaxis_title=x_col, yaxis_title=y_col)
+    if display == True:
+    # Display the plots!
+        for key, plot in fig.items():
+            plot.show()
+        return
+    else:
+        return fig
@@ -5,11 +5,17 @@
 This file can be imported as a module and contains the following functions:
     * get_cols_query - returns an SQL query to get the column names of a table in a database
     * make_totals_query - returns an SQL query to get counts of values in a list of columns
+    * make_grouping_sets_query - returns an SQL query to get counts of values in a list of columns in a single scan using GROUPING SETS
     * all_counts_query - returns an SQL query to get linked value counts from a list of columns in a pair of datasets.
     * compute_stats_query - returns an SQL query to compute statistics based on value counts from a pair of datasets.
 """
 
 
+# Standard library imports
+from itertools import combinations
+
+# Local packages
+from materialize import population_query
 from params import col_names, col_name_pairs
 
 
@@ -31,13 +37,20 @@ def get_cols_query(owner, table, condition=""):
     return query
 
 
-def make_totals_query(pop_query, suffix='', field_list=None, num_variates=1, standalone=True):
+def make_totals_query(pop_query, suffix='', field_list=None, num_variates=1, standalone=True, method='grouping_sets'):
     r"""If `num_variates` == 1: Compose a large SQL query to obtain counts of values in a list of columns.
     Concatenates subqueries which obtain value counts for the passed columns within the passed table (defined by query).
     
     If `num_variates` == 2: Compose a very large SQL query to obtain counts of value pairs over pairs of fields in a table.
     Concatenates subqueries which obtain counts of value pairs for distinct pairs of columns within the passed table (defined by query).
     
+    If `num_variates` > 2: Likewise obtain counts of value tuples over sets of `num_variates` fields, with columns
+    `column_name1, ..., column_name{k}, val1, ..., val{k}, counts_{suffix}`. The field sets should usually be passed in `field_list`,
+    e.g. as selected by `marginals.candidate_field_sets`, since there are very many combinations of `num_variates` fields.
+    
+    If `method` == 'grouping_sets' (the default), the query is instead composed by `make_grouping_sets_query`,
+    which returns the same counts in the same layout from a single scan of the population table.
+    
     Parameters
     ----------
     pop_query : str
@@ -45,9 +58,11 @@ def make_totals_query(pop_query, suffix='', field_list=None, num_variates=1, sta
     suffix : str, optional
         A suffix added to the 'counts' column name in the final output
     num_variates : int, defaults to 1
-        Select whether counts are grouped by 1 variable or 2 variables (over all distinct combinations). 
+        Select the number of variables counts are grouped by (over all distinct combinations). 
     standalone : Boolean, defaults to True
         Set to False if the output will be a subquery, in order to avoid nested WITH statements.
+    method : str, defaults to 'grouping_sets'
+        Either 'grouping_sets' (one scan of the population table) or 'union_all' (one scan per field or pair of fields).
     
     Returns
     -------
@@ -55,6 +70,12 @@ def make_totals_query(pop_query, suffix='', field_list=None, num_variates=1, sta
         An SQL query prepped for input into pd.read_sql_query
     
     """    
+    if method == 'grouping_sets':
+        return make_grouping_sets_query(pop_query, suffix, field_list, num_variates, standalone)
+    elif method != 'union_all':
+        print("The keyword `method` currently only accepts values in ['grouping_sets', 'union_all']")
+        return ''
+    
     # This is the template for the subquery obtaining group counts, 
     # along with a 'UNION ALL' statement to join the smaller tables together
     if num_variates == 1:
@@ -77,9 +98,19 @@ COUNT(*) AS counts_{suffix}
 FROM population_{suffix}
 GROUP BY {col_name1}, {col_name2}
 UNION ALL
+'''.replace('\n', ' ').replace('{suffix}', suffix)
+
+    elif num_variates > 2:
+        template = '''SELECT
+{names},
+{vals},
+COUNT(*) AS counts_{suffix}
+FROM population_{suffix}
+GROUP BY {fields}
+UNION ALL
 '''.replace('\n', ' ').replace('{suffix}', suffix)
     else:
-        print('The keyword `num_variates` currently only accepts values in [1,2]')  
+        print('The keyword `num_variates` currently only accepts positive integers')  
         return ''
     
     # Here we initiliaze our long string of SQL code
@@ -98,27 +129,114 @@ UNION ALL
         iterator = field_list if field_list is not None else col_name_pairs
         for pair in iterator:
             sql += template.format(col_name1=pair[0], col_name2=pair[1])
+
+    elif num_variates > 2:
+        # For each set of columns in our list, we add a copy of the subquery template with the column names filled in
+        iterator = field_list if field_list is not None else combinations(col_names, num_variates)
+        for field_set in iterator:
+            sql += template.format(names=', '.join("'{}' AS column_name{}".format(col_name, i+1) for i, col_name in enumerate(field_set)),
+                                   vals=', '.join("NVL(TO_CHAR({}), 'None') AS val{}".format(col_name, i+1) for i, col_name in enumerate(field_set)),
+                                   fields=', '.join(field_set))
     
     # We truncate the last few characters of the string to remove the final 'UNION ALL' statement
     sql = sql.rstrip('UNION ALL')
     return sql
 
 
-def all_counts_query(sim_pop_query, real_pop_query, standalone=True):
+def make_grouping_sets_query(pop_query, suffix='', field_list=None, num_variates=1, standalone=True):
+    r"""Compose an SQL query to obtain counts of values (or value tuples) over a list of fields (or sets of fields) in a single scan.
+
+    All of the requested marginals are computed by one `GROUP BY GROUPING SETS` aggregation over the population table.
+    The `GROUPING_ID` of each aggregated row identifies the field (or pair of fields) it was grouped by, and is used to unpack
+    the rows into the same long format as the 'union_all' method of `make_totals_query`:
+    `column_name, val, counts_{suffix}` if `num_variates` == 1, or `column_name1, ..., column_name{k}, val1, ..., val{k}, counts_{suffix}`
+    if `num_variates` == k > 1.
+
+    Parameters
+    ----------
+    pop_query : str
+        The SQL Select statement to obtain the table for which we want to find aggregate information
+    suffix : str, optional
+        A suffix added to the 'counts' column name in the final output
+    field_list : list, optional
+        The fields (or sets of fields) to group by. Defaults to `col_names` (or `col_name_pairs`, or all combinations of `num_variates` fields).
+    num_variates : int, defaults to 1
+        Select the number of variables counts are grouped by (over all distinct combinations).
+    standalone : Boolean, defaults to True
+        Set to False if the output will be a subquery, in order to avoid nested WITH statements.
+
+    Returns
+    -------
+    str
+        An SQL query prepped for input into pd.read_sql_query
+
+    """
+    if num_variates == 1:
+        field_sets = [(col_name,) for col_name in (field_list if field_list is not None else col_names)]
+        name_cols = ['column_name']
+    elif num_variates == 2:
+        field_sets = [tuple(pair) for pair in (field_list if field_list is not None else col_name_pairs)]
+        name_cols = ['column_name1', 'column_name2']
+    elif num_variates > 2:
+        field_sets = [tuple(field_set) for field_set in (field_list if field_list is not None else combinations(col_names, num_variates))]
+        name_cols = ['column_name{}'.format(i+1) for i in range(num_variates)]
+    else:
+        print('The keyword `num_variates` currently only accepts positive integers')
+        return ''
+    # Each grouping set must map to a distinct GROUPING_ID, so we drop repeated sets (in any field order) while preserving order
+    unique_field_sets = dict()
+    for field_set in field_sets:
+        unique_field_sets.setdefault(frozenset(field_set), field_set)
+    field_sets = list(unique_field_sets.values())
+    # The distinct fields appearing in the grouping sets, in order of first appearance
+    fields = list(dict.fromkeys(col_name for field_set in field_sets for col_name in field_set))
+    # GROUPING_ID(f_1, ..., f_n) has the bit 2^(n-i) set whenever the field f_i is aggregated over (not in the grouping set)
+    bit = {col_name: 2**(len(fields) - 1 - i) for i, col_name in enumerate(fields)}
+    grouping_ids = [2**len(fields) - 1 - sum(bit[col_name] for col_name in field_set) for field_set in field_sets]
+
+    # The CASE expressions unpack each aggregated row into its field names and values
+    select_list = list()
+    for position, name_col in enumerate(name_cols):
+        select_list.append('CASE grouping_id {} END AS {}'.format(
+            ' '.join("WHEN {} THEN '{}'".format(grouping_id, field_set[position])
+                     for grouping_id, field_set in zip(grouping_ids, field_sets)), name_col))
+    for position, name_col in enumerate(name_cols):
+        select_list.append('CASE grouping_id {} END AS {}'.format(
+            ' '.join("WHEN {} THEN NVL(TO_CHAR({}), 'None')".format(grouping_id, field_set[position])
+                     for grouping_id, field_set in zip(grouping_ids, field_sets)), name_col.replace('column_name', 'val')))
+    select_list.append('counts_{}'.format(suffix))
+
+    # Here we initiliaze our long string of SQL code
+    sql = '' if not standalone else 'WITH population_{suffix} AS ({pop_query}) '.format(suffix=suffix, pop_query=pop_query)
+    sql += '''SELECT {select_list}
+FROM (SELECT GROUPING_ID({fields}) AS grouping_id, {fields}, COUNT(*) AS counts_{suffix}
+FROM population_{suffix}
+GROUP BY GROUPING SETS ({grouping_sets}))'''.replace('\n', ' ').format(
+        select_list=', '.join(select_list),
+        fields=', '.join(fields),
+        suffix=suffix,
+        grouping_sets=', '.join('({})'.format(', '.join(field_set)) for field_set in field_sets))
+    return sql
+
+
+def all_counts_query(sim_key, real_key, standalone=True, method='grouping_sets'):
     r"""Returns SQL query to get linked value counts from a list of columns in a pair of datasets.
     
-    Composes an SQL query to obtain value counts for the passed list of columns within the passed tables (defined by query),
+    Composes an SQL query to obtain value counts for the passed list of columns within the passed cohorts,
     joined along matching column names and values. The standalone keyword argument can be set to False to use the resulting
-    table as part of a larger analysis.
+    table as part of a larger analysis. The population of each cohort is read with `materialize.population_query`,
+    i.e. from its materialized table if there is one.
     
     Parameters
     ----------
-    sim_pop_query : str
-        The SQL Select statement for the table of simulated tumour data
-    real_pop_query : str
-        The SQL Select statement for the table of real tumour data
+    sim_key : str
+        The alias of the cohort of simulated tumour data, e.g. 'sim2'
+    real_key : str
+        The alias of the cohort of real tumour data, e.g. 'av2017'
     standalone : Boolean, defaults to True
         Set to False to omit the final SELECT statement, so that further subqueries may be appended.
+    method : str, defaults to 'grouping_sets'
+        The method used by `make_totals_query` to compute the value counts in each table.
     
     Returns
     -------
@@ -126,6 +244,7 @@ def all_counts_query(sim_pop_query, real_pop_query, standalone=True):
         An SQL query prepped for input into pd.read_sql_query
     
     """    
+    sim_pop_query, real_pop_query = population_query(sim_key), population_query(real_key)
     sql_combined_totals = '''WITH population_real AS ({real_pop_query}),
 population_sim AS ({sim_pop_query}),
 r AS ({real_totals_query}),
@@ -140,26 +259,26 @@ FROM r FULL OUTER JOIN s
 ON r.column_name = s.column_name AND NVL(r.val, 'None') = NVL(s.val, 'None'))
 '''.replace('\n', ' ').format(real_pop_query=real_pop_query, 
                               sim_pop_query=sim_pop_query,
-                              real_totals_query=make_totals_query(real_pop_query, 'real', standalone=False),
-                              sim_totals_query=make_totals_query(sim_pop_query, 'sim', standalone=False))
+                              real_totals_query=make_totals_query(real_pop_query, 'real', standalone=False, method=method),
+                              sim_totals_query=make_totals_query(sim_pop_query, 'sim', standalone=False, method=method))
     
     if standalone:
         sql_combined_totals += "SELECT * FROM all_counts"
     return sql_combined_totals
 
 
-def compute_stats_query(sim_pop_query, real_pop_query, standalone=True):
+def compute_stats_query(sim_key, real_key, standalone=True):
     r"""Returns SQL query to compute statistics based on value counts from a pair of datasets.
     
-    Composes an SQL query to obtain value counts, compute test statistics for the passed list of columns within the passed tables (defined by query),
-    joined along matching column names and values. 
+    Composes an SQL query to obtain value counts, compute test statistics for the passed list of columns within the passed cohorts,
+    joined along matching column names and values. The populations are read as in `all_counts_query`.
     
     Parameters
     ----------
-    sim_pop_query : str
-        The SQL Select statement for the table of simulated tumour data
-    real_pop_query : str
-        The SQL Select statement for the table of real tumour data
+    sim_key : str
+        The alias of the cohort of simulated tumour data, e.g. 'sim1'
+    real_key : str
+        The alias of the cohort of real tumour data, e.g. 'av2015'
     standalone : Boolean, defaults to True
         Set to False to omit the final SELECT statement, so that further subqueries may be appended.
     
@@ -206,5 +325,5 @@ FROM proportions, pop_sizes)
     if standalone:
         analysis_subquery += "SELECT * FROM results"
 
-    complete_query = all_counts_query(sim_pop_query, real_pop_query, standalone=False) + ',' + analysis_subquery
+    complete_query = all_counts_query(sim_key, real_key, standalone=False) + ',' + analysis_subquery
     return complete_query
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * register_cohort - Adds a cohort (e.g. a new Simulacrum release or AV snapshot) to the registry
+    * set_comparisons - Sets the comparison graph, i.e. the list of pairs of cohorts to compare
+    * save_registry - Writes the registry to `params.registry_filepath`
+    * load_registry - Reads the registry from `params.registry_filepath`, registering every cohort and comparison in it
+    * extract_pop_size - Counts the number of rows in a cohort's population from the SQL database
+    * extract_cohort - Extracts any missing group counts and the population size of a cohort, once
+    * combine_all_counts - Joins the tables of group counts of many cohorts into a single table, with one counts column per cohort
+    * compare_many - Evaluates every comparison in a comparison graph from a single read and join of each cohort's counts
+This module also contains the dictionary `registry`, which records the cohorts and the comparison graph.
+
+Cohorts used to be fixed by `params.key_list`, `params.comparison_pairs`, `populations.pop_queries` and `compute_stats.pop_sizes`.
+Registering a cohort records its population query, kind ('sim' or 'real'), snapshot label and population size in the registry,
+and adds it to those dictionaries in place, along with the filepaths for its counts, so every other module picks it up.
+The registry is saved as a .json file, so each cohort's counts and population size are extracted once, and a new comparison
+(e.g. sim3 vs av2019, or sim2 vs sim3) reuses the stored counts of both cohorts rather than extracting them again.
+"""
+
+# Standard library imports
+import json
+import os
+
+# Third-party imports
+import numpy as np
+from sqlalchemy import text
+
+# Local packages
+import cache
+import materialize
+from analysis import read_counts, align_counts, join_cols
+from compute_stats import pop_sizes, compute_all_tests
+from params import (key_list, comparison_pairs, field_list_dict, filepath_templates, filepath_dictionary,
+                    columnar_filepath_dictionary, db_snapshots, registry_filepath)
+from populations import pop_queries
+from scheduler import run_extraction
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# The registered cohorts keyed by table alias, and the comparison graph as a list of pairs of aliases (simulated first)
+registry = {'cohorts': dict(), 'comparisons': list()}
+
+
+def register_cohort(key, pop_query=None, kind=None, snapshot=None, pop_size=None, description=''):
+    r"""Adds a cohort (e.g. a new Simulacrum release or AV snapshot) to the registry.
+
+    The cohort is added to `params.key_list`, `populations.pop_queries`, `params.db_snapshots` and `compute_stats.pop_sizes`
+    (if its size is known), and filepaths for its counts are added to `params.filepath_dictionary` and `params.columnar_filepath_dictionary`.
+    Registering an alias which is already registered updates the given attributes.
+
+    Parameters
+    ----------
+    key : str
+        The alias of the cohort, e.g. 'sim3'
+    pop_query : str, optional
+        The SQL query for the cohort's population, in the format of the queries in `populations.pop_queries`.
+        Defaults to the existing query for the alias.
+    kind : str, optional
+        Either 'sim' or 'real'. Defaults to 'sim' if the alias begins with 'sim', and 'real' otherwise.
+    snapshot : str, optional
+        A label for the database snapshot behind the cohort, included in cache keys
+    pop_size : int, optional
+        The number of rows in the cohort's population, if known. Otherwise use `extract_cohort` to count them.
+    description : str, optional
+        A free text description of the cohort
+
+    Returns
+    -------
+    dictionary
+        The registry entry for the cohort
+    """
+    entry = registry['cohorts'].setdefault(key, {'pop_query': pop_queries.get(key), 'kind': None, 'snapshot': db_snapshots.get(key, ''),
+                                                 'pop_size': pop_sizes.get(key), 'description': ''})
+    for attribute, value in [('pop_query', pop_query), ('kind', kind), ('snapshot', snapshot), ('pop_size', pop_size), ('description', description)]:
+        if value is not None and value != '':
+            entry[attribute] = value
+    if entry['kind'] is None:
+        entry['kind'] = 'sim' if key.startswith('sim') else 'real'
+    if entry['pop_query'] is None:
+        raise ValueError('No population query for the cohort {}'.format(key))
+    if key not in key_list:
+        key_list.append(key)
+    pop_queries[key] = entry['pop_query']
+    db_snapshots[key] = entry['snapshot']
+    if entry['pop_size'] is not None:
+        pop_sizes[key] = int(entry['pop_size'])
+    for count_type, template in filepath_templates.items():
+        filepath_dictionary[count_type].setdefault(key, template.format(key.upper()))
+        columnar_filepath_dictionary[count_type].setdefault(key, filepath_dictionary[count_type][key][:-len('.csv')])
+    return entry
+
+
+def set_comparisons(pairs):
+    r"""Sets the comparison graph, i.e. the list of pairs of cohorts to compare (simulated first), updating `params.comparison_pairs` in place."""
+    for pair in pairs:
+        for key in pair:
+            if key not in registry['cohorts']:
+                register_cohort(key)
+    registry['comparisons'] = [tuple(pair) for pair in pairs]
+    comparison_pairs[:] = registry['comparisons']
+
+
+def save_registry(filepath=registry_filepath):
+    r"""Writes the registry to a .json file, by default `params.registry_filepath`."""
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filepath, 'w') as registry_file:
+        json.dump({'cohorts': registry['cohorts'], 'comparisons': [list(pair) for pair in registry['comparisons']]}, registry_file, indent=2)
+    return filepath
+
+
+def load_registry(filepath=registry_filepath):
+    r"""Reads the registry from a .json file, by default `params.registry_filepath`, registering every cohort and comparison in it.
+
+    If the file does not exist, the cohorts in `params.key_list` and pairs in `params.comparison_pairs` are registered instead.
+    Returns the registry.
+    """
+    if os.path.exists(filepath):
+        with open(filepath) as registry_file:
+            stored = json.load(registry_file)
+    else:
+        stored = {'cohorts': {key: dict() for key in key_list}, 'comparisons': [list(pair) for pair in comparison_pairs]}
+    for key, entry in stored['cohorts'].items():
+        register_cohort(key, **entry)
+    set_comparisons(stored['comparisons'])
+    return registry
+
+
+def extract_pop_size(key, db):
+    r"""Counts the number of rows in a cohort's population from the SQL database, using its materialized table if there is one."""
+    if key in materialize.materialized_tables:
+        return materialize.materialized_tables[key]['num_rows']
+    with db.connect() as connection:
+        return int(connection.execute(text('SELECT COUNT(*) FROM ({})'.format(materialize.population_query(key)))).scalar())
+
+
+def extract_cohort(key, db, count_types=None, save=True, **kwargs):
+    r"""Extracts any missing group counts and the population size of a cohort, once.
+
+    Counts are extracted (with `scheduler.run_extraction`) only for the count types which have neither a cache entry for the
+    cohort's current query nor a file at the cohort's filepath, and the population size only if it is not yet recorded.
+
+    Parameters
+    ----------
+    key : str
+        The alias of a registered cohort
+    db : An instance of an `sqlalchemy.engine`
+        This is the connection to your database management system.
+    count_types : list of str, optional
+        The count types to extract. Defaults to all count types.
+    save : Boolean, defaults to True
+        Set to False to skip saving the registry afterwards
+    **kwargs
+        Additional keyword arguments passed to `scheduler.run_extraction`, e.g. `max_workers`
+
+    Returns
+    -------
+    dictionary
+        The results of the extraction jobs which were run, as returned by `scheduler.run_extraction`
+    """
+    entry = register_cohort(key)
+    count_types = count_types if count_types is not None else list(field_list_dict.keys())
+    missing = [count_type for count_type in count_types
+               if cache.lookup(count_type, key) is None and not os.path.exists(filepath_dictionary[count_type][key])]
+    results = run_extraction(db, count_types=missing, keys=[key], **kwargs) if missing else dict()
+    if entry['pop_size'] is None:
+        register_cohort(key, pop_size=extract_pop_size(key, db))
+    if save:
+        save_registry()
+    return results
+
+
+def combine_all_counts(count_type, counts_tables):
+    r"""Joins the tables of group counts of many cohorts into a single table, with one counts column per cohort and zeros filled in.
+
+    Every comparison between the cohorts is a selection of two counts columns of this table, so each table is joined only once
+    however many comparisons it takes part in. The tables are aligned in one pass with `analysis.align_counts`.
+    """
+    return align_counts(counts_tables, join_cols[count_type])
+
+
+def compare_many(count_type, pairs=None, grouping=None, tests=('z', 'chi2', 'ks'), counts_tables=None):
+    r"""Evaluates every comparison in a comparison graph from a single read and join of each cohort's counts.
+
+    The counts of each cohort taking part in any comparison are read once and joined once (see `combine_all_counts`).
+    The comparison table of each pair is then the rows of the joined table where either cohort has a non-zero count,
+    which is the same table as returned by `analysis.combine_counts`, and is passed to `compute_stats.compute_all_tests`.
+
+    Parameters
+    ----------
+    count_type : str
+        The count type to compare, a key of `params.field_list_dict`
+    pairs : list of tuples, optional
+        The comparison graph. Defaults to the registered comparisons (`params.comparison_pairs`).
+    grouping : str, optional
+        Passed to `compute_stats.compute_all_tests`. Defaults to 'univariate' for univariate count types and 'bivariate' otherwise.
+    tests : tuple of str, defaults to ('z', 'chi2', 'ks')
+        Passed to `compute_stats.compute_all_tests`
+    counts_tables : dictionary, optional
+        Tables of group counts keyed by alias. By default, they are read with `analysis.read_counts`.
+
+    Returns
+    -------
+    dictionary
+        Maps each pair to its results bundle, as returned by `compute_stats.compute_all_tests`, with the comparison table under the key 'table'
+    """
+    pairs = [tuple(pair) for pair in (pairs if pairs is not None else comparison_pairs)]
+    grouping = grouping if grouping is not None else 'univariate' if count_type.startswith('univariate') else 'bivariate'
+    keys = list(dict.fromkeys(key for pair in pairs for key in pair))
+    if counts_tables is None:
+        counts_tables = read_counts(count_type, keys=keys)
+    combined = combine_all_counts(count_type, {key: counts_tables[key] for key in keys})
+    results = dict()
+    for pair in pairs:
+        count_cols = ['counts_'+pair[1], 'counts_'+pair[0]]
+        mask = np.logical_or(combined[count_cols[0]].values > 0, combined[count_cols[1]].values > 0)
+        table = combined.loc[mask, join_cols[count_type] + count_cols].reset_index(drop=True)
+        results[pair] = compute_all_tests(pair, table, grouping, tests)
+        results[pair]['table'] = table
+    return results
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * make_sections - Lists the sections of a report and the figure builders of `plots` which draw each of them
+    * render_section - Builds the figures of a section of a report and serializes them as Plotly JSON
+    * build_report - Renders the figures of a complete comparison run in parallel into one self-contained HTML report
+
+The report is a single .html file, which can be opened without a live kernel. It holds one copy of the Plotly JS library,
+a summary table of the chi-squared test results of each comparison, and one section per field. The figures of each section
+are stored as Plotly JSON in a `<script type="application/json">` element, and are only drawn with `Plotly.newPlot` when the
+section is scrolled into view (with an `IntersectionObserver`), so opening and paging through a report of hundreds of figures
+stays fast. The sections are rendered across worker processes, and each worker is sent only the rows of the results it plots.
+"""
+
+# Standard library imports
+import html
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Third-party imports
+import numpy as np
+from plotly.offline import get_plotlyjs
+
+# Local packages
+import plots
+from params import field_list_dict, report_filepath
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# The page of the report. Each section is drawn the first time it comes within 400 pixels of the window.
+_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{font-family: sans-serif; margin: 0 2em;}}
+nav {{column-width: 14em; margin-bottom: 2em;}}
+nav a {{display: block;}}
+section.lazy {{min-height: 450px; border-top: 1px solid #ccc;}}
+table {{border-collapse: collapse; font-size: small;}}
+td, th {{padding: 2px 8px; text-align: right;}}
+</style>
+<script type="text/javascript">{plotly_js}</script>
+</head>
+<body>
+<h1>{title}</h1>
+<nav>{contents}</nav>
+{summary}
+{sections}
+<script type="text/javascript">
+function renderSection(section) {{
+    var figures = JSON.parse(section.querySelector('script.figure-data').textContent);
+    var container = section.querySelector('div.figures');
+    figures.forEach(function (figure) {{
+        var div = document.createElement('div');
+        container.appendChild(div);
+        Plotly.newPlot(div, figure.data, figure.layout, {{responsive: true}});
+    }});
+}}
+var sections = document.querySelectorAll('section.lazy');
+if ('IntersectionObserver' in window) {{
+    var observer = new IntersectionObserver(function (entries) {{
+        entries.forEach(function (entry) {{
+            if (entry.isIntersecting) {{
+                observer.unobserve(entry.target);
+                renderSection(entry.target);
+            }}
+        }});
+    }}, {{rootMargin: '400px'}});
+    sections.forEach(function (section) {{ observer.observe(section); }});
+}} else {{
+    sections.forEach(renderSection);
+}}
+</script>
+</body>
+</html>
+"""
+
+_section_template = """<section class="lazy" id="{anchor}">
+<h2>{heading}</h2>
+<div class="figures"></div>
+<script type="application/json" class="figure-data">{figures}</script>
+</section>"""
+
+
+def _rows_of(results_dict, mask_function):
+    # The rows of each table of results selected by a function of the table, keeping only what a section plots
+    return {pair: table.loc[mask_function(table)] for pair, table in results_dict.items()}
+
+
+def make_sections(z_results, chi2_results=None, field_pairs=None, date_tiles=None):
+    r"""Lists the sections of a report and the figure builders of `plots` which draw each of them.
+
+    Parameters
+    ----------
+    z_results : dictionary
+        Tables of z-test results (e.g. from `compute_stats.compute_z_test`) keyed by count type and then by pair of table aliases.
+        The 'univariate_categorical' tables are drawn for every field, and the 'bivariate_categorical' tables for each pair in `field_pairs`.
+    chi2_results : dictionary, optional
+        Tables of chi-squared test results (from `compute_stats.compute_chi2_test`) keyed by 'univariate' and/or 'bivariate'
+        and then by pair of table aliases, drawn in the overview
+    field_pairs : list of tuples, optional
+        The pairs of fields whose bivariate heatmaps are drawn, in the section of their first field.
+        Defaults to every pair in `field_list_dict['bivariate_categorical']` if there are bivariate z-test results.
+    date_tiles : dictionary, optional
+        Roll-ups from `tiles.compute_tiles` keyed by count type ('categorical_cross_*_date' or 'surgery_date_cross_diagnosis_date')
+        and then by pair of table aliases
+
+    Returns
+    -------
+    list of tuples
+        For each section, its heading and a list of `(builder, args, kwargs)` calls of the figure builders in `plots`
+    """
+    chi2_results = chi2_results or dict()
+    date_tiles = date_tiles or dict()
+    sections = list()
+    overview = list()
+    if 'univariate' in chi2_results:
+        overview.append(('plot_univariate_chi2_test_results', (chi2_results['univariate'],), dict()))
+    if 'bivariate' in chi2_results:
+        overview.append(('plot_bivariate_chi2_results', (chi2_results['bivariate'],), {'display': False}))
+    if 'surgery_date_cross_diagnosis_date' in date_tiles:
+        overview.append(('plot_date_date_results', (date_tiles['surgery_date_cross_diagnosis_date'],), {'display': False}))
+    if overview:
+        sections.append(('Overview', overview))
+
+    univariate = z_results.get('univariate_categorical', dict())
+    bivariate = z_results.get('bivariate_categorical', dict())
+    field_pairs = field_pairs if field_pairs is not None else field_list_dict['bivariate_categorical'] if bivariate else list()
+    # The positions of the rows of each pair of fields in each table of bivariate z-test results, found once
+    indices = {pair: table.groupby(['column_name1', 'column_name2'], observed=True, sort=False).indices for pair, table in bivariate.items()}
+    empty = np.array([], dtype=np.int64)
+    for col_name in field_list_dict['univariate_categorical']:
+        calls = list()
+        if univariate:
+            calls.append(('plot_univariate_categorical_results',
+                          (_rows_of(univariate, lambda table: (table['column_name'] == col_name).values), col_name), dict()))
+        for col_name1, col_name2 in field_pairs:
+            if col_name1 == col_name:
+                sub_tables = {pair: table[['column_name1', 'column_name2', 'val1', 'val2', 'z_test']].iloc[
+                                  np.concatenate([indices[pair].get((col_name1, col_name2), empty), indices[pair].get((col_name2, col_name1), empty)])]
+                              for pair, table in bivariate.items()}
+                calls.append(('plot_bivariate_categorical_results', (sub_tables, col_name1, col_name2), {'display': False}))
+        for count_type in ['categorical_cross_diagnosis_date', 'categorical_cross_surgery_date']:
+            if count_type in date_tiles:
+                tiles_dict = {pair: {level: table.loc[(table['column_name1'] == col_name).values] for level, table in tiles.items()}
+                              for pair, tiles in date_tiles[count_type].items()}
+                calls.append(('plot_categorical_date_results', (tiles_dict, col_name, count_type), {'display': False}))
+        if calls:
+            sections.append((col_name, calls))
+    return sections
+
+
+def render_section(section):
+    r"""Builds the figures of a section of a report and serializes them as Plotly JSON.
+
+    `section` is a heading and a list of calls, as listed by `make_sections`. Returns the heading and a list of JSON strings, one per figure.
+    """
+    heading, calls = section
+    figures = list()
+    for builder, args, kwargs in calls:
+        fig = getattr(plots, builder)(*args, **kwargs)
+        # Builders of heatmaps return a dictionary of figures, one per pair of source tables
+        figures.extend(fig.values() if isinstance(fig, dict) else [fig] if fig is not None else [])
+    return heading, [figure.to_json() for figure in figures]
+
+
+def _summary_tables(chi2_results, by='Wilson–Hilferty_score', num_rows=20):
+    # HTML tables of the worst-fitting fields (or pairs of fields) of each comparison, by chi-squared test score
+    tables = list()
+    for grouping, results_dict in sorted((chi2_results or dict()).items()):
+        for pair, results in results_dict.items():
+            tables.append('<h3>{} chi-squared test results, {} vs. {}</h3>\n{}'.format(
+                grouping.capitalize(), pair[0], pair[1], results.sort_values(by=by, ascending=False).head(num_rows).to_html(float_format='{:.3g}'.format)))
+    return '\n'.join(tables)
+
+
+def build_report(z_results, chi2_results=None, field_pairs=None, date_tiles=None, filepath=report_filepath,
+                 title='Simulacrum test suite report', max_workers=None):
+    r"""Renders the figures of a complete comparison run in parallel into one self-contained HTML report.
+
+    Parameters
+    ----------
+    z_results, chi2_results, field_pairs, date_tiles
+        The results to draw, passed to `make_sections`
+    filepath : str, defaults to `params.report_filepath`
+        The .html file to write
+    title : str, defaults to 'Simulacrum test suite report'
+        The title of the report
+    max_workers : int, optional
+        The number of worker processes. Defaults to the number of processors on the machine.
+
+    Returns
+    -------
+    str
+        The filepath of the report
+    """
+    sections = make_sections(z_results, chi2_results, field_pairs, date_tiles)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rendered = list(executor.map(render_section, sections))
+    contents, section_html = list(), list()
+    for position, (heading, figures) in enumerate(rendered):
+        anchor = 'section-{}'.format(position)
+        contents.append('<a href="#{}">{}</a>'.format(anchor, html.escape(heading)))
+        # Escape '</' so that no figure can close the script element holding it
+        section_html.append(_section_template.format(anchor=anchor, heading=html.escape(heading),
+                                                     figures='[' + ','.join(figures).replace('</', '<\\/') + ']'))
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filepath, 'w', encoding='utf-8') as report_file:
+        report_file.write(_template.format(title=html.escape(title), plotly_js=get_plotlyjs(), contents='\n'.join(contents),
+                                           summary=_summary_tables(chi2_results), sections='\n'.join(section_html)))
+    return filepath
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * chi2_statistic - Compute Pearson's chi-squared test statistic, as in `compute_stats.compute_chi2_test`, for a batch of count vectors
+    * ks_statistic - Compute the two-sample Kolmogorov-Smirnov test statistic for a batch of ordered count vectors
+    * resample_group - Estimate the p-value of a test statistic for one field (or pair of fields) by Monte Carlo resampling
+    * compute_resampled_p_values - Estimate p-values for every field (or pair of fields) in a comparison table, across worker processes
+
+The p-values reported in `compute_stats` rely on asymptotic approximations (e.g. the Wilson–Hilferty transformation and the
+asymptotic Kolmogorov distribution), which break down for sparse categories. Here, under the null hypothesis that both
+populations are drawn from the same distribution over the values of a field, both sets of counts are resampled from a
+multinomial distribution with the pooled proportions, in batches of NumPy operations. The p-value is the proportion of
+resamples whose test statistic is at least as large as the observed one, `(1 + #{T_resampled >= T_observed}) / (1 + num_resamples)`.
+Each field (or pair of fields) is given an independent random number stream spawned from a single seed, so the results
+do not depend on the number of worker processes.
+"""
+
+# Standard library imports
+from concurrent.futures import ProcessPoolExecutor
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from compute_stats import pop_sizes
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def chi2_statistic(counts0, counts1, n0, n1):
+    r"""Compute Pearson's chi-squared test statistic, as in `compute_stats.compute_chi2_test`, for a batch of count vectors.
+
+    `counts0` and `counts1` are arrays whose last axis runs over the values of a field. The expected counts for the first
+    population are based on the proportions in the second (reference) population, with zero expected counts replaced by 0.5.
+    """
+    expected = n0 * counts1 / n1
+    return (np.square(counts0 - expected) / np.where(expected != 0, expected, 0.5)).sum(axis=-1)
+
+
+def ks_statistic(counts0, counts1, n0, n1):
+    r"""Compute the two-sample Kolmogorov-Smirnov test statistic for a batch of count vectors ordered by value along the last axis."""
+    return np.abs(np.cumsum(counts0, axis=-1) / n0 - np.cumsum(counts1, axis=-1) / n1).max(axis=-1)
+
+
+statistics = {'chi2': chi2_statistic, 'ks': ks_statistic}
+
+
+def resample_group(counts0, counts1, n0, n1, statistic='chi2', num_resamples=10000, batch_size=None, seed=None):
+    r"""Estimate the p-value of a test statistic for one field (or pair of fields) by Monte Carlo resampling.
+
+    Parameters
+    ----------
+    counts0, counts1 : numpy arrays
+        The counts of each value of the field in the two populations
+    n0, n1 : int
+        The sizes of the two populations
+    statistic : str, defaults to 'chi2'
+        Either 'chi2' (Pearson's chi-squared) or 'ks' (Kolmogorov-Smirnov, for counts ordered by value)
+    num_resamples : int, defaults to 10000
+        The number of multinomial resamples drawn under the null hypothesis
+    batch_size : int, optional
+        The number of resamples drawn in each batch of NumPy operations. By default, batches hold about a million cells.
+    seed : None, int or numpy.random.SeedSequence
+        Seeds the random number generator
+
+    Returns
+    -------
+    tuple
+        The observed test statistic and the resampled p-value
+    """
+    function = statistics[statistic]
+    counts0, counts1 = np.asarray(counts0, dtype=np.float64), np.asarray(counts1, dtype=np.float64)
+    observed = function(counts0, counts1, n0, n1)
+    # Resample from the pooled proportions. The counts of values outside the table (e.g. other fields) are not needed,
+    # since categories in the comparison table cover the whole population of each field.
+    pooled = (counts0 + counts1) / (counts0 + counts1).sum()
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size if batch_size is not None else max(1, min(num_resamples, 2**20 // max(1, len(pooled))))
+    num_exceeding = 0
+    for start in range(0, num_resamples, batch_size):
+        size = min(batch_size, num_resamples - start)
+        resampled0 = rng.multinomial(int(counts0.sum()), pooled, size=size)
+        resampled1 = rng.multinomial(int(counts1.sum()), pooled, size=size)
+        num_exceeding += int((function(resampled0, resampled1, n0, n1) >= observed * (1 - 1e-12)).sum())
+    return observed, (1 + num_exceeding) / (1 + num_resamples)
+
+
+def _resample_group(arguments):
+    # Unpacks the arguments for `resample_group`, for use with `ProcessPoolExecutor.map`
+    return resample_group(*arguments)
+
+
+def compute_resampled_p_values(pair, comparison_table, grouping='univariate', statistic='chi2', num_resamples=10000,
+                               batch_size=None, max_workers=None, seed=0):
+    r"""Estimate p-values for every field (or pair of fields) in a comparison table by Monte Carlo resampling, across worker processes.
+
+    Parameters
+    ----------
+    pair : tuple of str
+        The pair of table aliases being compared, e.g. ('sim2', 'av2017')
+    comparison_table : pandas DataFrame
+        The joined table of counts for the pair, as returned by `analysis.combine_counts`
+    grouping : str, defaults to 'univariate'
+        Either 'univariate' or 'bivariate'. The fields (or pairs of fields, or field and value for 'ks') are grouped
+        as in `compute_stats.compute_chi2_test` and `compute_stats.compute_ks_test`.
+    statistic : str, defaults to 'chi2'
+        Either 'chi2' or 'ks'
+    num_resamples : int, defaults to 10000
+        The number of resamples per field (or pair of fields)
+    batch_size : int, optional
+        The number of resamples drawn in each batch of NumPy operations
+    max_workers : int, optional
+        The number of worker processes. Defaults to the number of processors on the machine.
+    seed : int, defaults to 0
+        The seed from which an independent random number stream is spawned for each field (or pair of fields)
+
+    Returns
+    -------
+    pandas DataFrame
+        Indexed by field (or pair of fields), with columns for the observed statistic, the resampled p-value and the number of resamples
+    """
+    assert grouping in ['univariate', 'bivariate'] and statistic in statistics
+    if statistic == 'chi2':
+        group_cols, sort_cols = (['column_name'], []) if grouping == 'univariate' else (['column_name1', 'column_name2'], [])
+    else:
+        group_cols, sort_cols = (['column_name'], ['val']) if grouping == 'univariate' else (['column_name1', 'val1'], ['val2'])
+    count_cols = ['counts_'+key for key in pair]
+    table = comparison_table[group_cols + sort_cols + count_cols]
+    if sort_cols:
+        # The KS statistic needs the counts of each group in order of value
+        table = table.sort_values(by=group_cols + sort_cols)
+    groups = table.groupby(by=group_cols, sort=True, observed=True).indices
+    counts = table[count_cols].values
+    n0, n1 = pop_sizes[pair[0]], pop_sizes[pair[1]]
+    seeds = np.random.SeedSequence(seed).spawn(len(groups))
+    tasks = [(counts[positions, 0], counts[positions, 1], n0, n1, statistic, num_resamples, batch_size, group_seed)
+             for positions, group_seed in zip(groups.values(), seeds)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        outcomes = list(executor.map(_resample_group, tasks, chunksize=max(1, len(tasks) // 64)))
+    index = pd.MultiIndex.from_tuples(list(groups.keys()), names=group_cols) if len(group_cols) > 1 else pd.Index(list(groups.keys()), name=group_cols[0])
+    results = pd.DataFrame(outcomes, index=index, columns=[statistic+'_statistic', 'p_value_resampled'])
+    results['num_resamples'] = num_resamples
+    return results
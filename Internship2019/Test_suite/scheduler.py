@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * is_transient_error - Decides whether an exception raised while extracting group counts is worth retrying
+    * run_job - Runs a single extraction job, retrying on transient errors
+    * run_extraction - Runs extraction jobs over count types and cohorts concurrently on a thread pool
+
+An extraction job is a pair `(count_type, key)`, which is passed to `write_results.write_counts_to_csv`.
+Jobs share a single `sqlalchemy.engine`, whose connection pool bounds the number of concurrent database sessions.
+Use `database.connect(username, password, pool_size=max_workers)` to size the pool to match the thread pool.
+"""
+
+# Standard library imports
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Third-party imports
+from sqlalchemy import exc
+
+# Local packages
+from materialize import materialize_population
+from params import key_list, field_list_dict
+from write_results import write_counts_to_csv
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def is_transient_error(error):
+    r"""Decides whether an exception raised while extracting group counts is worth retrying.
+
+    Dropped connections, timeouts and other operational errors reported by the database driver are treated as transient,
+    whereas errors in the SQL itself (e.g. `sqlalchemy.exc.ProgrammingError`) are not.
+    """
+    if isinstance(error, exc.DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, (exc.OperationalError, exc.TimeoutError, exc.DisconnectionError))
+
+
+def run_job(count_type, key, db, retries=3, backoff=30):
+    r"""Runs a single extraction job, retrying on transient errors.
+
+    Parameters
+    ----------
+    count_type : str
+        The type of fields or pairs of fields that we would like to group by for counting
+    key : str
+        A key indicating the table in the SQL database from which we calculate group counts
+    db : An instance of an `sqlalchemy.engine`
+        This is the connection to your database management system.
+    retries : int, defaults to 3
+        The number of times a job is retried after a transient error before giving up
+    backoff : float, defaults to 30
+        The number of seconds to wait before the first retry, doubling after each subsequent attempt
+
+    Returns
+    -------
+    Boolean
+        Returns True if the job was executed successfully, otherwise the last exception is raised
+    """
+    for attempt in range(retries + 1):
+        try:
+            return write_counts_to_csv(count_type, key, db)
+        except Exception as error:
+            if attempt == retries or not is_transient_error(error):
+                raise
+            print('Transient error in job ({}, {}): {}. Retrying in {} seconds...'.format(count_type, key, error, backoff * 2**attempt))
+            time.sleep(backoff * 2**attempt)
+
+
+def run_extraction(db, count_types=None, keys=None, max_workers=4, max_per_key=2, retries=3, backoff=30, materialize=False):
+    r"""Runs extraction jobs over count types and cohorts concurrently on a thread pool.
+
+    One job is scheduled for each pair `(count_type, key)`. At most `max_workers` jobs run at once, and at most `max_per_key`
+    of those read from the same cohort, so that no single source table is hit by every running query.
+    Progress is reported as each job finishes, and a failed job does not stop the remaining jobs.
+    If `materialize` is True, each cohort's population query is first run once into a table (see `materialize.materialize_population`),
+    and every job for that cohort reads from the table.
+
+    Parameters
+    ----------
+    db : An instance of an `sqlalchemy.engine`
+        This is the connection to your database management system. Its pool should allow at least `max_workers` connections.
+    count_types : list of str, optional
+        The keys of `field_list_dict` to extract. Defaults to all count types.
+    keys : list of str, optional
+        The cohorts to extract. Defaults to `key_list`.
+    max_workers : int, defaults to 4
+        The maximum number of jobs running concurrently
+    max_per_key : int, defaults to 2
+        The maximum number of jobs running concurrently against the same cohort
+    retries : int, defaults to 3
+        The number of times a job is retried after a transient error
+    backoff : float, defaults to 30
+        The number of seconds to wait before the first retry, doubling after each subsequent attempt
+    materialize : Boolean, defaults to False
+        Set to True to materialize each cohort once before running its jobs
+
+    Returns
+    -------
+    dictionary
+        Maps each job `(count_type, key)` to True if it succeeded, or to the exception which caused it to fail
+    """
+    count_types = count_types if count_types is not None else list(field_list_dict.keys())
+    keys = keys if keys is not None else key_list
+    jobs = [(count_type, key) for count_type in count_types for key in keys]
+    key_limits = {key: threading.BoundedSemaphore(max_per_key) for key in keys}
+    if materialize:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda key: materialize_population(key, db), keys))
+
+    def capped_job(count_type, key):
+        with key_limits[key]:
+            return run_job(count_type, key, db, retries, backoff)
+
+    results = dict()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(capped_job, *job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job] = future.result()
+                status = 'done'
+            except Exception as error:
+                results[job] = error
+                status = 'FAILED ({})'.format(error)
+            print('[{}/{}] ({}, {}) {} after {:.0f}s'.format(len(results), len(jobs), job[0], job[1], status, time.time() - start))
+    return results
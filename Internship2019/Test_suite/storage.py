@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * save_counts_table - Writes a table of group counts to a directory of NumPy arrays, with dictionary-encoded text columns
+    * load_counts_table - Reads a table of group counts from a directory of NumPy arrays, memory-mapping the arrays
+    * convert_counts - Converts the .csv files of group counts for a given count type into the columnar format
+
+The columnar format is an alternative to .csv for storing tables of group counts. Each table is stored as a directory containing
+one `.npy` file per column and a `schema.json` file. Text columns are dictionary-encoded, with the integer codes stored in the
+`.npy` file and the labels in the schema; counts and dates are stored as typed arrays. Integer and float labels are stored as JSON
+numbers and other labels as JSON strings, so a column mixing types (e.g. the ages and the text codes in the `val` column of a table
+cleaned by `write_results.clean_counts`) is rebuilt with the same values. Loading maps the arrays into memory
+without parsing or copying, and rebuilds the same DataFrame as `analysis.read_counts` with categorical text columns.
+"""
+
+# Standard library imports
+import json
+import os
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from params import columnar_filepath_dictionary
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def _json_label(label):
+    # A label as a JSON value, keeping integers and floats as numbers so that e.g. the label 1 is not confused with '1'
+    if isinstance(label, (bool, np.bool_)):
+        return bool(label)
+    if isinstance(label, (int, np.integer)):
+        return int(label)
+    if isinstance(label, (float, np.floating)):
+        return float(label)
+    return str(label)
+
+
+def save_counts_table(frame, directory):
+    r"""Writes a table of group counts to a directory of NumPy arrays, with dictionary-encoded text columns.
+
+    Parameters
+    ----------
+    frame : pandas DataFrame
+        The table of group counts, e.g. as returned by `analysis.read_counts`
+    directory : str
+        The directory in which the table is stored. It is created if it does not exist.
+
+    Returns
+    -------
+    str
+        The directory in which the table was stored
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    schema = {'num_rows': frame.shape[0], 'columns': list()}
+    for position, col_label in enumerate(frame.columns):
+        column = frame[col_label]
+        filename = 'column_{}.npy'.format(position)
+        if pd.api.types.is_datetime64_any_dtype(column) or pd.api.types.is_numeric_dtype(column):
+            values = column.values.astype('datetime64[ns]') if pd.api.types.is_datetime64_any_dtype(column) else column.values
+            schema['columns'].append({'name': col_label, 'kind': 'array', 'file': filename})
+        else:
+            # Dictionary-encode text (and mixed) columns. Null values are given the code -1, as in `pd.Categorical`
+            categorical = pd.Categorical(column) if not isinstance(column.dtype, pd.CategoricalDtype) else column.values
+            labels = categorical.categories
+            code_dtype = np.int8 if len(labels) < 2**7 else np.int16 if len(labels) < 2**15 else np.int32
+            values = categorical.codes.astype(code_dtype)
+            schema['columns'].append({'name': col_label, 'kind': 'category', 'file': filename,
+                                      'labels': [str(label) for label in labels] if pd.api.types.is_datetime64_any_dtype(labels)
+                                      else [_json_label(label) for label in labels],
+                                      'label_kind': 'datetime' if pd.api.types.is_datetime64_any_dtype(labels) else 'value'})
+        np.save(os.path.join(directory, filename), np.ascontiguousarray(values), allow_pickle=False)
+    with open(os.path.join(directory, 'schema.json'), 'w') as schema_file:
+        json.dump(schema, schema_file, indent=2)
+    return directory
+
+
+def load_counts_table(directory, mmap_mode='r'):
+    r"""Reads a table of group counts from a directory of NumPy arrays, memory-mapping the arrays.
+
+    Parameters
+    ----------
+    directory : str
+        The directory in which the table is stored, as written by `save_counts_table`
+    mmap_mode : str or None, defaults to 'r'
+        Passed to `np.load`. The default maps the arrays read-only without copying; set to None to read them into memory.
+
+    Returns
+    -------
+    pandas DataFrame
+        The table of group counts, with categorical text columns and typed count and date columns
+    """
+    with open(os.path.join(directory, 'schema.json')) as schema_file:
+        schema = json.load(schema_file)
+    columns = dict()
+    for column in schema['columns']:
+        values = np.load(os.path.join(directory, column['file']), mmap_mode=mmap_mode, allow_pickle=False)
+        if column['kind'] == 'category':
+            # Labels of mixed types are kept as objects, so that e.g. 1 and '1' stay distinct categories
+            labels = pd.to_datetime(column['labels']) if column['label_kind'] == 'datetime' else pd.Index(column['labels'], tupleize_cols=False)
+            columns[column['name']] = pd.Categorical.from_codes(values, categories=labels)
+        else:
+            columns[column['name']] = values
+    return pd.DataFrame(columns, columns=[column['name'] for column in schema['columns']], copy=False)
+
+
+def convert_counts(count_type, counts_tables=None):
+    r"""Converts the tables of group counts for a given count type into the columnar format.
+
+    The tables are read with `analysis.read_counts` unless passed in `counts_tables`, and written to the directories
+    given by `params.columnar_filepath_dictionary`. Returns a dictionary of the directories written, keyed by table alias.
+    """
+    if counts_tables is None:
+        # Imported here since the `analysis` module itself reads the columnar format using this module
+        from analysis import read_counts
+        counts_tables = read_counts(count_type)
+    return {key: save_counts_table(frame, columnar_filepath_dictionary[count_type][key]) for key, frame in counts_tables.items()}
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following:
+    * iter_population_chunks - Reads a local .csv or .parquet extract of tumour data in fixed-size chunks of rows
+    * CountAccumulator - Accumulates univariate and bivariate group counts over chunks of an extract of tumour data
+    * accumulate_counts - Computes group counts over a local extract of tumour data, one chunk at a time
+    * write_counts_to_csv - Writes group counts from a CountAccumulator to a .csv file
+
+Peak memory use is bounded by the size of a chunk plus the size of the count accumulators, rather than the size of the extract,
+so that population extracts which do not fit in memory can be counted. The results are written in the same format as `write_results.write_counts_to_csv`.
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from local_counts import field_sources, source_columns, encode_column, read_population
+from params import filepath_dictionary, field_list_dict
+from write_results import clean_counts
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+def iter_population_chunks(filepath, chunksize=500000, raw=True):
+    r"""Reads a local .csv or .parquet extract of tumour data in fixed-size chunks of rows.
+
+    Every value is read as a string (or null), as in `local_counts.read_population`.
+
+    Parameters
+    ----------
+    filepath : str
+        The location of the extract. Files ending in '.parquet' or '.pq' are read with `pyarrow`, otherwise as .csv.
+    chunksize : int, defaults to 500000
+        The number of rows in each chunk
+    raw : Boolean, defaults to True
+        Set to False if the extract already contains the derived fields, e.g. if it was exported using a query in `populations.pop_queries`.
+
+    Yields
+    ------
+    pandas DataFrame
+        A chunk of the table of tumour data, with null values represented by NaN or None
+    """
+    if filepath.lower().endswith(('.parquet', '.pq')):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(filepath)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=source_columns(raw)):
+            # Cast to strings in Arrow, so that integers with nulls are not turned into floats along the way
+            yield pd.DataFrame({name: pc.cast(batch.column(name), pa.string()).to_pandas() for name in batch.schema.names})
+    else:
+        for chunk in read_population(filepath, raw, chunksize=chunksize):
+            yield chunk
+
+
+class CountAccumulator(object):
+    r"""Accumulates univariate and bivariate group counts over chunks of an extract of tumour data.
+
+    The distinct values of each field are assigned integer codes in order of first appearance. For each field the accumulator
+    holds a 1D array of counts by code, and for each pair of fields a dense 2D array of counts by pair of codes. These arrays
+    are updated in place, and only grow when a chunk contains values not seen before.
+
+    Parameters
+    ----------
+    count_types : list of str, optional
+        The keys of `field_list_dict` to accumulate counts for. Defaults to all count types.
+    raw : Boolean, defaults to True
+        Set to False if the chunks already contain the derived fields, in which case no preprocessing is applied.
+    """
+    def __init__(self, count_types=None, raw=True):
+        self.count_types = count_types if count_types is not None else list(field_list_dict.keys())
+        self.raw = raw
+        self.pairs = list(dict.fromkeys(tuple(pair) for count_type in self.count_types
+                                        for pair in field_list_dict[count_type] if isinstance(pair, tuple)))
+        self.fields = list(dict.fromkeys([col_name for count_type in self.count_types
+                                          for col_name in field_list_dict[count_type] if not isinstance(col_name, tuple)]
+                                         + [col_name for pair in self.pairs for col_name in pair]))
+        self.labels = {col_name: list() for col_name in self.fields}
+        self.lookup = {col_name: dict() for col_name in self.fields}
+        self.counts = {col_name: np.zeros(0, dtype=np.uint64) for col_name in self.fields}
+        self.pair_counts = {pair: np.zeros((0, 0), dtype=np.uint64) for pair in self.pairs}
+        self.num_rows = 0
+
+    def _encode(self, col_name, chunk):
+        # Encode the chunk locally, then map the (few) distinct chunk labels to the accumulator's codes
+        source, transform = field_sources.get(col_name, (col_name, None)) if self.raw else (col_name, None)
+        codes, chunk_labels = encode_column(chunk[source], transform)
+        lookup, labels = self.lookup[col_name], self.labels[col_name]
+        for label in chunk_labels:
+            if label not in lookup:
+                lookup[label] = len(labels)
+                labels.append(label)
+        return np.array([lookup[label] for label in chunk_labels], dtype=np.int64)[codes]
+
+    def update(self, chunk):
+        r"""Updates the accumulated counts with a chunk of tumour data (a pandas DataFrame), and returns the accumulator."""
+        codes = {col_name: self._encode(col_name, chunk) for col_name in self.fields}
+        for col_name in self.fields:
+            size = len(self.labels[col_name])
+            if self.counts[col_name].shape[0] < size:
+                self.counts[col_name] = np.pad(self.counts[col_name], (0, size - self.counts[col_name].shape[0]), mode='constant')
+            self.counts[col_name] += np.bincount(codes[col_name], minlength=size).astype(np.uint64)
+        for pair in self.pairs:
+            shape = (len(self.labels[pair[0]]), len(self.labels[pair[1]]))
+            counts = self.pair_counts[pair]
+            if counts.shape != shape:
+                counts = self.pair_counts[pair] = np.pad(counts, [(0, shape[0] - counts.shape[0]), (0, shape[1] - counts.shape[1])], mode='constant')
+            combined = codes[pair[0]] * shape[1] + codes[pair[1]]
+            counts += np.bincount(combined, minlength=shape[0] * shape[1]).astype(np.uint64).reshape(shape)
+        self.num_rows += chunk.shape[0]
+        return self
+
+    def totals(self, count_type, suffix=''):
+        r"""Returns the accumulated group counts for a given count type, in the same layout as `write_results.get_totals_from_db`."""
+        frames = list()
+        if count_type in ['univariate_categorical', 'univariate_dates']:
+            for col_name in field_list_dict[count_type]:
+                labels, counts = np.asarray(self.labels[col_name], dtype=object), self.counts[col_name]
+                nonzero = np.flatnonzero(counts)
+                frames.append(pd.DataFrame({'column_name': col_name, 'val': labels[nonzero], 'counts_'+suffix: counts[nonzero]}))
+        else:
+            for col_name1, col_name2 in field_list_dict[count_type]:
+                labels1, labels2 = np.asarray(self.labels[col_name1], dtype=object), np.asarray(self.labels[col_name2], dtype=object)
+                counts = self.pair_counts[(col_name1, col_name2)]
+                rows, cols = np.nonzero(counts)
+                frames.append(pd.DataFrame({'column_name1': col_name1, 'column_name2': col_name2,
+                                            'val1': labels1[rows], 'val2': labels2[cols], 'counts_'+suffix: counts[rows, cols]}))
+        return pd.concat(frames, ignore_index=True)
+
+
+def accumulate_counts(filepath, count_types=None, chunksize=500000, raw=True):
+    r"""Computes group counts over a local extract of tumour data, one chunk at a time.
+
+    Parameters
+    ----------
+    filepath : str
+        The location of the .csv or .parquet extract
+    count_types : list of str, optional
+        The keys of `field_list_dict` to compute counts for. Defaults to all count types.
+    chunksize : int, defaults to 500000
+        The number of rows read into memory at a time
+    raw : Boolean, defaults to True
+        Set to False if the extract already contains the derived fields, e.g. if it was exported using a query in `populations.pop_queries`.
+
+    Returns
+    -------
+    CountAccumulator
+        The accumulated counts over the whole extract
+    """
+    accumulator = CountAccumulator(count_types, raw)
+    for chunk in iter_population_chunks(filepath, chunksize, raw):
+        accumulator.update(chunk)
+        print('Counted {} rows...'.format(accumulator.num_rows))
+    return accumulator
+
+
+def write_counts_to_csv(accumulator, count_type, key):
+    r"""Writes group counts from a CountAccumulator to a .csv file.
+
+    Cleans and sorts the accumulated counts for the given count type with `write_results.clean_counts`, and writes the results
+    to the file given by `filepath_dictionary`, exactly as `write_results.write_counts_to_csv` does.
+
+    Returns
+    -------
+    Boolean
+        Returns True if the function was executed successfully
+    """
+    frame = clean_counts(accumulator.totals(count_type, key), count_type, key)
+    print('Data cleaned and sorted!\n Saving the results...')
+    frame.to_csv(filepath_dictionary[count_type][key], index=False)
+    print('Saved successfully at {} ! Function complete!'.format(filepath_dictionary[count_type][key]))
+    return True
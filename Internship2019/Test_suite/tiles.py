@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file can be imported as a module and contains the following functions:
+    * roll_up - Aggregates a comparison table of a date count type to a coarser resolution of its dates, e.g. weeks
+    * compute_tiles - Precomputes roll-ups of a comparison table at every resolution, with their z-test statistics
+    * choose_resolution - Chooses the finest resolution whose grid fits within a number of columns, for a given range of dates
+This module also contains the parameters `resolutions`, the date resolutions from finest to coarsest, and `tile_date_cols`,
+the columns of dates in each date count type.
+
+The `categorical_cross_*_date` and `surgery_date_cross_diagnosis_date` count types have daily resolution over several years,
+so heatmaps of them at full resolution have thousands of columns (or millions of cells). Here, each comparison table is rolled up
+to weeks, months and quarters once, by mapping its distinct dates to the start of their period and aligning the counts on the
+coarser dates with `analysis.align_counts`, which sums the counts of the days in each period. The z-tests are then computed
+at each resolution from the summed counts, so the z-scores of coarser cells are not averages of daily z-scores.
+The plotting functions in `plots` choose a resolution for the range of dates on view with `choose_resolution`.
+"""
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local packages
+from analysis import align_counts, join_cols
+from compute_stats import compute_z_test
+
+
+__author__ = 'Edward Pearce'
+__copyright__ = 'Copyright 2019, Simulacrum Test Suite'
+__credits__ = ['Edward Pearce']
+__license__ = 'MIT'
+__version__ = '1.0.0'
+__maintainer__ = 'Edward Pearce'
+__email__ = 'edward.pearce@phe.gov.uk'
+__status__ = 'Development'
+
+
+# Date resolutions from finest to coarsest, with their pandas period frequencies
+resolutions = {'day': 'D', 'week': 'W', 'month': 'M', 'quarter': 'Q'}
+# The columns of dates in the comparison tables of each date count type
+tile_date_cols = {'categorical_cross_diagnosis_date': ['val2'],
+                  'categorical_cross_surgery_date': ['val2'],
+                  'surgery_date_cross_diagnosis_date': ['DATE_FIRST_SURGERY', 'DIAGNOSISDATEBEST']}
+
+
+def _period_starts(dates, frequency):
+    # Maps dates to the start dates of their periods, converting each distinct date only once
+    codes, uniques = pd.factorize(pd.Series(dates), sort=True)
+    starts = pd.DatetimeIndex(uniques).to_period(frequency).start_time.values
+    # Null dates (code -1) stay null
+    return np.r_[starts, np.datetime64('NaT')].astype('datetime64[ns]')[np.where(codes < 0, len(starts), codes)]
+
+
+def roll_up(pair, comparison_table, count_type, resolution='week'):
+    r"""Aggregates a comparison table of a date count type to a coarser resolution of its dates, e.g. weeks.
+
+    Parameters
+    ----------
+    pair : tuple of str
+        The pair of table aliases being compared, e.g. ('sim2', 'av2017')
+    comparison_table : pandas DataFrame
+        The joined table of counts for the pair, as returned by `analysis.combine_counts`
+    count_type : str
+        One of the count types in `tile_date_cols`
+    resolution : str, defaults to 'week'
+        One of the keys of `resolutions`. Each date is replaced by the first day of its period.
+
+    Returns
+    -------
+    pandas DataFrame
+        The table of counts summed over the days in each period, with the same columns as `comparison_table`
+    """
+    on = join_cols[count_type]
+    table = comparison_table[on + ['counts_'+key for key in pair]].copy()
+    if resolution != 'day':
+        for col_label in tile_date_cols[count_type]:
+            table[col_label] = _period_starts(table[col_label].values, resolutions[resolution])
+    return align_counts({key: table[on + ['counts_'+key]] for key in pair[::-1]}, on)
+
+
+def compute_tiles(pair, comparison_table, count_type, levels=('day', 'week', 'month', 'quarter')):
+    r"""Precomputes roll-ups of a comparison table at every resolution, with their z-test statistics.
+
+    Returns a dictionary keyed by resolution, whose values are the rolled-up tables augmented by `compute_stats.compute_z_test`.
+    """
+    return {level: compute_z_test(pair, roll_up(pair, comparison_table, count_type, level)) for level in levels}
+
+
+def choose_resolution(tiles, date_col, date_range=None, max_columns=1000, other_date_col=None):
+    r"""Chooses the finest resolution whose grid fits within a number of columns, for a given range of dates.
+
+    Parameters
+    ----------
+    tiles : dictionary
+        The tables of each resolution, as returned by `compute_tiles`
+    date_col : str
+        The column of dates along the axis on view
+    date_range : tuple, optional
+        The first and last dates of `date_col` on view. Defaults to the whole range of dates.
+    max_columns : int, defaults to 1000
+        The largest number of distinct dates (columns of the heatmap) to draw
+    other_date_col : str, optional
+        A column of dates along the other axis (e.g. the date of diagnosis), which is also capped at `max_columns` distinct dates
+        among the rows on view
+
+    Returns
+    -------
+    str
+        The chosen resolution, or the coarsest resolution in `tiles` if none fit
+    """
+    levels = [level for level in resolutions if level in tiles]
+    for level in levels:
+        table = tiles[level]
+        if date_range is not None:
+            dates = table[date_col]
+            table = table.loc[((dates >= pd.Timestamp(date_range[0])) & (dates <= pd.Timestamp(date_range[1]))).values]
+        if all(table[col_label].nunique() <= max_columns for col_label in [date_col, other_date_col] if col_label is not None):
+            return level
+    return levels[-1]
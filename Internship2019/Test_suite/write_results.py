@@ -3,16 +3,27 @@
 
 """
 This file can be imported as a module and contains the following functions:
+    * stream_query - Reads the result of an SQL query in batches with a server-side cursor, casting each batch to its final data type.
     * get_totals_from_db - Reads group counts from a table in an SQL database into a pandas DataFrame.
+    * get_totals_from_population - Computes group counts from a local encoded population into a pandas DataFrame.
     * write_counts_to_csv - Writes group counts from a table in an SQL database to a .csv file.
+    * clean_counts - Sets data types, cleans and sorts values in a table of group counts.
+The stages of extraction (running the query, fetching, cleaning and saving) are recorded by the `instrument` module when it is enabled.
 """
 
 
+import shutil
+from contextlib import closing
+
+import numpy as np
 import pandas as pd
 
+import cache
+import instrument
 import queries
-from populations import pop_queries
-from params import filepath_dictionary, field_list_dict
+import local_counts
+import materialize
+from params import filepath_dictionary, field_list_dict, column_schema
 
 
 __author__ = 'Edward Pearce'
@@ -25,10 +36,93 @@ __email__ = 'edward.pearce@phe.gov.uk'
 __status__ = 'Production'
 
 
-def get_totals_from_db(count_type, key, db):
+# The value columns holding dates in each type of table of group counts, which are parsed when streaming query results
+date_val_cols = {'univariate_categorical': [],
+                 'univariate_dates': ['val'],
+                 'bivariate_categorical': [],
+                 'categorical_cross_diagnosis_date': ['val2'],
+                 'categorical_cross_surgery_date': ['val2'],
+                 'surgery_date_cross_diagnosis_date': ['val1', 'val2']}
+
+
+def stream_query(sql, db, arraysize=100000, date_cols=()):
+    r"""Reads the result of an SQL query in batches with a server-side cursor, casting each batch to its final data type.
+    
+    Rather than building a DataFrame of Python strings, each batch of rows is converted straight away into typed arrays:
+    columns whose names begin with 'counts' are cast to `uint32`, columns in `date_cols` are parsed as dates, and
+    all other columns are dictionary-encoded as category codes. Only the current batch is held as Python objects.
+    
+    Parameters
+    ----------
+    sql : str
+        The SQL query to run
+    db: An instance of an `sqlalchemy.engine`
+        This is the connection to your database management system.
+    arraysize : int, defaults to 100000
+        The number of rows fetched from the database in each round trip (and cast in each batch)
+    date_cols : list of str, optional
+        The (lower case) names of the columns holding dates in 'YYYY-MM-DD' format
+    
+    Returns
+    -------
+    pandas DataFrame
+        The result of the query, with categorical, `uint32` and datetime columns
+    """
+    raw_connection = db.raw_connection()
+    try:
+        # The cursor is closed even if the query or a fetch fails
+        with closing(raw_connection.cursor()) as cursor:
+            cursor.arraysize = arraysize
+            with instrument.stage('execute_query'):
+                cursor.execute(sql)
+            col_labels = [description[0].lower() for description in cursor.description]
+            # For each column we keep a list of typed arrays, one per batch, and for categorical columns the labels seen so far
+            arrays = {col_label: list() for col_label in col_labels}
+            lookups = {col_label: dict() for col_label in col_labels}
+            with instrument.stage('fetch') as current:
+                num_rows = 0
+                while True:
+                    rows = cursor.fetchmany(arraysize)
+                    if not rows:
+                        break
+                    num_rows += len(rows)
+                    for col_label, values in zip(col_labels, zip(*rows)):
+                        if col_label.startswith('counts'):
+                            arrays[col_label].append(np.asarray(values, dtype=np.uint32))
+                        elif col_label in date_cols:
+                            arrays[col_label].append(pd.to_datetime(pd.Series(values, dtype=object), format='%Y-%m-%d', errors='coerce').values)
+                        else:
+                            codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+                            lookup = lookups[col_label]
+                            for label in uniques:
+                                lookup.setdefault(label, len(lookup))
+                            # Null values (code -1) keep the code -1, which `pd.Categorical` reads as a null value
+                            arrays[col_label].append(np.array([lookup[label] for label in uniques] + [-1], dtype=np.int32)[codes])
+                current.set(rows_out=num_rows)
+    finally:
+        raw_connection.close()
+    
+    frame = dict()
+    for col_label in col_labels:
+        values = np.concatenate(arrays.pop(col_label)) if arrays[col_label] else np.array([])
+        if col_label.startswith('counts') or col_label in date_cols:
+            frame[col_label] = values
+        else:
+            # Order the categories alphabetically, so that sorting by a categorical column agrees with sorting by string
+            labels = np.array(list(lookups[col_label].keys()), dtype=object)
+            order = np.argsort(labels.astype(str), kind='stable')
+            # The last entry maps the code -1 of null values to itself
+            rank = np.full(len(order) + 1, -1, dtype=np.int32)
+            rank[order] = np.arange(len(order), dtype=np.int32)
+            frame[col_label] = pd.Categorical.from_codes(rank[values.astype(np.int32)], categories=labels[order])
+    return pd.DataFrame(frame, columns=col_labels)
+
+
+def get_totals_from_db(count_type, key, db, method='grouping_sets', arraysize=None):
     r"""Reads group counts from a table in an SQL database into a pandas DataFrame.
     
     It is necessary to have access to the SQL database (via an `sqlalchemy.engine` object) to use this function.
+    If the cohort has been materialized with `materialize.materialize_population`, the counts are computed from the materialized table.
     
     Parameters
     ----------
@@ -38,6 +132,44 @@ def get_totals_from_db(count_type, key, db):
         The table in the SQL database for which we calculate the group counts is indicated by the `key` variable.
     db: An instance of an `sqlalchemy.engine`
         This is the connection to your database management system.
+    method : str, defaults to 'grouping_sets'
+        The query generation method passed to `queries.make_totals_query`. 
+        'grouping_sets' computes all group counts in a single scan of the table, 'union_all' scans once per field (or pair of fields).
+    arraysize : int, optional
+        If given, the results are fetched in batches of this many rows with `stream_query`, instead of with `pd.read_sql_query`.
+
+    Returns
+    -------
+    pandas DataFrame
+        Returns the table of group counts as a pandas DataFrame
+    """
+    if count_type in ['univariate_categorical', 'univariate_dates']:
+        num_variates = 1
+    elif count_type in ['bivariate_categorical', 'categorical_cross_diagnosis_date', 'categorical_cross_surgery_date', 'surgery_date_cross_diagnosis_date']:
+        num_variates = 2
+    sql = queries.make_totals_query(materialize.population_query(key), key, field_list=field_list_dict[count_type], num_variates=num_variates, method=method)
+    if arraysize is not None:
+        return stream_query(sql, db, arraysize, date_cols=date_val_cols[count_type])
+    with instrument.stage('read_sql_query') as current:
+        frame = pd.read_sql_query(sql, db)
+        current.set(rows_out=frame.shape[0])
+    return frame
+
+
+def get_totals_from_population(count_type, key, population):
+    r"""Computes group counts from a local encoded population into a pandas DataFrame.
+    
+    This is an offline alternative to `get_totals_from_db`, which does not require access to the SQL database.
+    The resulting table has the same layout as the one returned by `get_totals_from_db`.
+    
+    Parameters
+    ----------
+    count_type : str
+        The list of fields or pairs of fields which we group by for counting is indicated by the `count_type`variable.
+    key : str
+        The alias of the source table, used to name the counts column.
+    population : dictionary
+        The encoded population, as returned by `local_counts.load_population` (e.g. for a local copy of `sim_av_tumour.csv`)
 
     Returns
     -------
@@ -48,13 +180,17 @@ def get_totals_from_db(count_type, key, db):
         num_variates = 1
     elif count_type in ['bivariate_categorical', 'categorical_cross_diagnosis_date', 'categorical_cross_surgery_date', 'surgery_date_cross_diagnosis_date']:
         num_variates = 2
-    return pd.read_sql_query(queries.make_totals_query(pop_queries[key], key, field_list=field_list_dict[count_type], num_variates=num_variates), db)
+    return local_counts.make_totals(population, key, field_list=field_list_dict[count_type], num_variates=num_variates)
 
 
-def write_counts_to_csv(count_type, key, db):
+def write_counts_to_csv(count_type, key, db=None, population=None, arraysize=100000, use_cache=True):
     r"""Writes group counts from a table in an SQL database to a .csv file.
     
     Obtains a chosen set of group counts from an SQL table, cleans and sorts values, and writes the results to a .csv file.
+    If an encoded `population` is passed, the group counts are instead computed locally, without access to the SQL database.
+    
+    Group counts extracted from the SQL database are also stored in the cache (see the `cache` module). If the cache already holds
+    the counts for the current population query and field list, they are copied from the cache rather than extracted again.
     
     Parameters
     ----------
@@ -62,6 +198,14 @@ def write_counts_to_csv(count_type, key, db):
         The type of fields or pairs of fields that we would like to group by for counting
     key : str
         A key indicating the table in the SQL database from which we calculate group counts
+    db : An instance of an `sqlalchemy.engine`, optional
+        This is the connection to your database management system.
+    population : dictionary, optional
+        An encoded population, as returned by `local_counts.load_population`, used in place of the SQL database.
+    arraysize : int, defaults to 100000
+        The number of rows fetched from the database at a time. Set to None to read the results with `pd.read_sql_query` instead.
+    use_cache : Boolean, defaults to True
+        Set to False to extract the counts from the SQL database even if they are already in the cache.
     
     Returns
     -------
@@ -69,43 +213,96 @@ def write_counts_to_csv(count_type, key, db):
         Returns True if the function was executed successfully
     
     """
+    if population is None and use_cache:
+        cached_filepath = cache.lookup(count_type, key)
+        if cached_filepath is not None:
+            with instrument.stage('copy_from_cache', count_type, key):
+                shutil.copyfile(cached_filepath, filepath_dictionary[count_type][key])
+            print('Found {} counts for {} in the cache at {} ! Function complete!'.format(count_type, key, cached_filepath))
+            return True
+    
     # Read the raw table of counts data
-    print('Getting the data from {} - calculating {} counts in SQL...'.format(key, count_type))
-    frame = get_totals_from_db(count_type, key, db)
+    with instrument.stage('extract', count_type, key) as current:
+        if population is not None:
+            print('Getting the data from {} - calculating {} counts locally...'.format(key, count_type))
+            frame = get_totals_from_population(count_type, key, population)
+        else:
+            print('Getting the data from {} - calculating {} counts in SQL...'.format(key, count_type))
+            frame = get_totals_from_db(count_type, key, db, arraysize=arraysize)
+        current.set(rows_out=frame.shape[0])
     print('Totals pulled from database successfully! ({} rows, {} columns)'.format(frame.shape[0], frame.shape[1]))
     
-    print('Setting data types and cleaning values...')
-    if count_type in ['univariate_categorical', 'univariate_dates']:
-        frame['column_name'] = frame['column_name'].astype('category')
-        frame['counts_'+key] = frame['counts_'+key].astype('uint32')
-        if count_type == 'univariate_categorical':
-            frame['val'] = frame.apply(lambda row: int(row['val']) if row['column_name'] == 'AGE' else row['val'], axis=1)
-        elif count_type == 'univariate_dates':
-            frame['val'] = pd.to_datetime(frame['val'], infer_datetime_format=True, errors='coerce')
-        
-        print('Sorting values...')
-        frame = pd.concat([frame.loc[frame.column_name == col_name].sort_values(by='val') for col_name in field_list_dict[count_type]])
-
-    elif count_type in ['bivariate_categorical', 'categorical_cross_diagnosis_date', 'categorical_cross_surgery_date', 'surgery_date_cross_diagnosis_date']:
-        frame[['column_name1', 'column_name2']] = frame[['column_name1', 'column_name2']].astype('category')
-        frame['counts_'+key] = frame['counts_'+key].astype('uint32')
-        
-        if count_type == 'bivariate_categorical':
-            # By design, 'AGE' should always be in column_name2 when it appears in a pair
-            frame['val1'] = frame.apply(lambda row: int(row['val1']) if row['column_name1'] == 'AGE' else row['val1'], axis=1)
-            frame['val2'] = frame.apply(lambda row: int(row['val2']) if row['column_name2'] == 'AGE' else row['val2'], axis=1)
-        elif count_type in ['categorical_cross_diagnosis_date', 'categorical_cross_surgery_date']:
-            # By design, date fields should always be in column_name2 when appearing in the pairs
-            frame['val1'] = frame.apply(lambda row: int(row['val1']) if row['column_name1'] == 'AGE' else row['val1'], axis=1)
-            frame['val2'] = pd.to_datetime(frame['val2'], infer_datetime_format=True, errors='coerce')
-        elif count_type == 'surgery_date_cross_diagnosis_date':
-            frame['val1'] = pd.to_datetime(frame['val1'], infer_datetime_format=True, errors='coerce')
-            frame['val2'] = pd.to_datetime(frame['val2'], infer_datetime_format=True, errors='coerce')
-        
-        print('Sorting values...')
-        frame = pd.concat([frame.loc[(frame.column_name1 == pair[0]) & (frame.column_name2 == pair[1])]
-                                   .sort_values(by=['val1', 'val2']) for pair in field_list_dict[count_type]])
+    frame = clean_counts(frame, count_type, key)
     print('Data cleaned and sorted!\n Saving the results...')
-    frame.to_csv(filepath_dictionary[count_type][key], index=False)
+    with instrument.stage('save', count_type, key, rows_in=frame.shape[0]):
+        if population is None:
+            # The copy keeps the modification time of the cache entry, so the file is not taken for newer counts by `analysis.read_counts`
+            shutil.copy2(cache.store(frame, count_type, key), filepath_dictionary[count_type][key])
+        else:
+            frame.to_csv(filepath_dictionary[count_type][key], index=False)
     print('Saved successfully at {} ! Function complete!'.format(filepath_dictionary[count_type][key]))
     return True
+
+
+@instrument.instrumented()
+def clean_counts(frame, count_type, key):
+    r"""Sets data types, cleans and sorts values in a table of group counts.
+    
+    Parameters
+    ----------
+    frame : pandas DataFrame
+        The raw table of group counts, as returned by `get_totals_from_db` or `get_totals_from_population`
+    count_type : str
+        The type of fields or pairs of fields that the counts are grouped by
+    key : str
+        The alias of the source table, used to name the counts column
+    
+    Returns
+    -------
+    pandas DataFrame
+        The table of group counts with typed values, sorted by field (or pair of fields) in the order given by `field_list_dict`,
+        and then by value. Values are cast and ordered according to the type of their field in `params.column_schema`.
+    
+    """
+    print('Setting data types and cleaning values...')
+    if count_type in ['univariate_categorical', 'univariate_dates']:
+        name_cols, val_cols = ['column_name'], ['val']
+        # The position of each row's field in the field list, which is the primary sort key
+        position = pd.Index(field_list_dict[count_type]).get_indexer(frame['column_name'])
+    else:
+        name_cols, val_cols = ['column_name1', 'column_name2'], ['val1', 'val2']
+        position = pd.MultiIndex.from_tuples(field_list_dict[count_type]).get_indexer(
+            pd.MultiIndex.from_arrays([frame['column_name1'], frame['column_name2']]))
+    frame[name_cols] = frame[name_cols].astype('category')
+    frame['counts_'+key] = frame['counts_'+key].astype('uint32')
+    
+    # Cast each value column according to the declared type of the field in each row, and compute a key to sort values within fields
+    sort_keys = list()
+    for name_col, val_col in zip(name_cols, val_cols):
+        value_types = frame[name_col].map(column_schema).astype(object).values
+        if (value_types == 'date').all():
+            frame[val_col] = pd.to_datetime(frame[val_col], format='%Y-%m-%d', errors='coerce')
+            sort_key = frame[val_col].values.astype('datetime64[ns]').astype(np.int64).astype(float)
+            sort_key[frame[val_col].isnull().values] = np.inf
+        else:
+            values = frame[val_col].astype(object).values
+            # Text values are ordered alphabetically, by their rank among all the distinct values in the column
+            codes, uniques = pd.factorize(values, sort=True)
+            sort_key = codes.astype(float)
+            is_int = value_types == 'int'
+            if is_int.any():
+                numbers = pd.to_numeric(pd.Series(values[is_int]), errors='coerce').values
+                sort_key[is_int] = numbers
+                values = values.copy()
+                values[is_int] = [int(number) for number in numbers]
+                frame[val_col] = values
+            sort_key[np.isnan(sort_key) | (codes < 0)] = np.inf
+        sort_keys.append(sort_key)
+    
+    print('Sorting values...')
+    # Sort by field (or pair of fields) in the order of the field list, then by value, in a single pass. 
+    # Rows for fields which are not in the field list are dropped.
+    order = np.lexsort(sort_keys[::-1] + [position])
+    order = order[position[order] >= 0]
+    frame = frame.iloc[order]
+    return frame